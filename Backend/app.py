@@ -1,6 +1,6 @@
 import os
-from flask import Flask, request, jsonify, send_file
-from datetime import datetime
+from flask import Flask, request, jsonify, send_file, make_response, Response, g
+from datetime import datetime, timezone
 from stellar_sdk import Keypair, Server, TransactionBuilder, Network, Asset, exceptions
 import firebase_admin
 from firebase_admin import credentials, firestore
@@ -9,30 +9,283 @@ from flask_cors import CORS
 from dotenv import load_dotenv
 from bitcoinlib.wallets import Wallet
 from eth_account import Account
-from util_wallet import calculate_crypto_amounts, get_crypto_data, keep_payment, calculate_inr_balances, get_stellar_balance, send_payment_and_show_balances, get_exchange_rate, get_crypto_price_in_inr
+from util_wallet import calculate_crypto_amounts, get_crypto_data, keep_payment, calculate_inr_balances, get_stellar_balance, send_payment_and_show_balances, get_exchange_rate, get_exchange_rates, get_crypto_price_in_inr, HORIZON_URL, fee_strategy
+from metrics import init_metrics, track_upstream
+from outbound import timed_get, horizon_client, scheduler, UpstreamBusy
+from shared_cache import open_cache
 import uuid
 from concurrent.futures import ThreadPoolExecutor
 import segno
 import io
 import uuid
 import requests
+import time
+import math
+import json
+import hashlib
+import functools
+from decimal import Decimal
+import numpy as np
+from settlement import SettlementEngine, min_account_balance
+from quotes import QuoteStore
+from assets import ASSETS, ASSET_SYMBOLS
+from price_history import PriceHistory
+from ledger_index import LedgerIndex, LedgerIngestor
 
 load_dotenv()
 
 app = Flask(__name__)
 CORS(app)
+init_metrics(app)
 
 cred = credentials.Certificate(os.getenv('GOOGLE_APPLICATION_CREDENTIALS'))
 firebase_admin.initialize_app(cred)
 db = firestore.client()
 admin_rec_acc = os.getenv('ADMIN_RECEIVER_KEY')
 
-server = Server(horizon_url="https://horizon-testnet.stellar.org")
+server = Server(horizon_url=HORIZON_URL, client=horizon_client)
+
+# Hot state shared by all workers when SHARED_CACHE_SOCKET points at the cache daemon
+# (see gunicorn.conf.py); otherwise an in-process cache with the same interface
+cache = open_cache()
+scheduler.share_buckets(cache)
+fee_strategy.share_stats(cache)
 network_passphrase = Network.TESTNET_NETWORK_PASSPHRASE
 
+# Minimum XLM a wallet must keep: 2 base reserves plus the largest fee bump of its own payment
+MIN_ACCOUNT_BALANCE = min_account_balance(fee_strategy.max_fee)
+CONVERSION_FEE_PERCENTAGE = 2.5
+
+# Upper bound on rows returned by /prices/history in one response
+MAX_HISTORY_POINTS = 5000
+
+QR_CACHE_TTL = 86400
+WALLET_DIRECTORY_TTL = 300
+IDEMPOTENCY_TTL = 86400
+
+# /transactions status for a conversion's settlement_status; a failed one had its INR taken back
+TRANSACTION_STATUSES = {'pending': 'pending', 'failed': 'failed'}
+# How long a request holds its Idempotency-Key before a retry may run it again
+IDEMPOTENCY_LOCK_TTL = 120
+
+price_history = PriceHistory(
+    os.getenv('PRICE_HISTORY_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'price_history')),
+    raw_retention=float(os.getenv('PRICE_HISTORY_RAW_RETENTION_SECONDS', 7 * 86400)),
+    downsample_interval=float(os.getenv('PRICE_HISTORY_DOWNSAMPLE_SECONDS', 300)),
+    retention=float(os.getenv('PRICE_HISTORY_RETENTION_SECONDS', 365 * 86400))
+)
+
+def fetch_price_snapshot():
+    crypto_data = get_crypto_data()
+    try:
+        price_history.record({symbol: info['price_inr'] for symbol, info in crypto_data.items()})
+    except Exception as e:
+        print("Price history error:", e)
+    # INR prices don't need exchange rates, so an exchangerate-api outage only affects other currencies
+    try:
+        fiat_rates = get_exchange_rates('INR')
+    except Exception as e:
+        print("Exchange rate error, snapshot has INR prices only:", e)
+        fiat_rates = {}
+    return crypto_data, fiat_rates
+
+quote_store = QuoteStore(
+    fetch_snapshot=fetch_price_snapshot,
+    cache=cache,
+    quote_ttl=float(os.getenv('QUOTE_TTL_SECONDS', '30')),
+    snapshot_ttl=float(os.getenv('PRICE_SNAPSHOT_TTL_SECONDS', '10'))
+)
+
+def currency_error(matrix, currency):
+    """An error response if `currency` can't be priced from this snapshot, else None."""
+    if currency in matrix.fiat_index:
+        return None
+    if not matrix.has_fiat_rates:
+        return jsonify({'error': 'Exchange rates are unavailable right now; only INR can be quoted'}), 503
+    return jsonify({'error': 'Invalid target currency'}), 400
+
+def finite_or_none(value, digits=2):
+    # Assets CoinGecko didn't price are NaN in the snapshot, which JSON can't carry
+    return None if math.isnan(value) else round(value, digits)
+
+def quote_payload(quote, amount=None):
+    payload = {
+        'quote_id': quote.id,
+        'crypto_symbol': quote.crypto_symbol,
+        'target_currency': quote.target_currency,
+        'rate': quote.rate,
+        'price_inr': quote.price_inr,
+        'fee_percentage': CONVERSION_FEE_PERCENTAGE,
+        'snapshot_at': datetime.fromtimestamp(quote.snapshot.taken_at, timezone.utc).isoformat(),
+        'expires_at': datetime.fromtimestamp(quote.expires_at, timezone.utc).isoformat(),
+        'expires_in': round(quote.expires_at - time.time(), 3)
+    }
+    if amount is not None:
+        payload['amount'] = amount
+        payload['converted_value'] = round(amount * quote.rate, 2)
+        payload['net_value_after_fee'] = round(amount * quote.rate * (1 - CONVERSION_FEE_PERCENTAGE / 100), 2)
+    return payload
+
+def lookup_wallet(email):
+    """Firestore id and addresses of a user's wallet. They never change after signup, so they're cached."""
+    key = f'wallets:directory:{email}'
+    entry = cache.get_json(key)
+    if entry is None:
+        with track_upstream('firestore', 'wallets.query'):
+            doc = next(db.collection('wallets').where('email', '==', email).limit(1).stream(), None)
+        if doc is None:
+            return None
+        entry = {'id': doc.id, 'wallet_addresses': doc.to_dict().get('wallet_addresses', {})}
+        cache.set_json(key, entry, WALLET_DIRECTORY_TTL)
+    return entry
+
+def mark_committed():
+    """Tells @idempotent that funds have moved (or may have), so a failure from here on can't be retried."""
+    g.idempotency_committed = True
+
+def idempotent(view):
+    """
+    Replays the stored response when a client retries with the same Idempotency-Key header,
+    so a timed-out /send or /convert can be retried without moving funds twice.
+
+    A 5xx before the view called mark_committed() frees the key for a real retry. After it,
+    the failure is kept as 'failed_after_commit' and replayed, since running the request
+    again could move the funds a second time. Records are pinned in the cache, so memory
+    pressure from other keys can't evict them.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if not idempotency_key:
+            return view(*args, **kwargs)
+        key = f'idempotency:{request.path}:{idempotency_key}'
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+        if not cache.add_json(key, {'state': 'in_progress', 'fingerprint': fingerprint}, IDEMPOTENCY_LOCK_TTL, pinned=True):
+            record = cache.get_json(key) or {}
+            if record.get('fingerprint') != fingerprint:
+                return jsonify({"error": "Idempotency-Key was already used with a different request"}), 422
+            if record.get('state') == 'in_progress':
+                return jsonify({"error": "A request with this Idempotency-Key is still in progress"}), 409
+            response = Response(record['body'], status=record['status'], mimetype='application/json')
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        def store(state, status, body):
+            cache.set_json(key, {'state': state, 'fingerprint': fingerprint, 'status': status, 'body': body},
+                           IDEMPOTENCY_TTL, pinned=True)
+
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception as e:
+            if g.get('idempotency_committed'):
+                store('failed_after_commit', 500, json.dumps({"error": f"Failed after funds were moved: {e}"}))
+            else:
+                cache.delete(key)
+            raise
+        if response.status_code < 500:
+            store('done', response.status_code, response.get_data(as_text=True))
+        elif g.get('idempotency_committed'):
+            store('failed_after_commit', response.status_code, response.get_data(as_text=True))
+        else:
+            # Nothing was committed; let the client retry for real
+            cache.delete(key)
+        return response
+    return wrapper
+
+def resolve_wallet_secret(wallet_id, crypto_symbol):
+    with track_upstream('firestore', 'wallets.get'):
+        snapshot = db.collection('wallets').document(wallet_id).get()
+    return snapshot.to_dict().get('wallet_secrets', {}).get(crypto_symbol)
+
+def record_settlement(entries, transaction_hash):
+    for entry in entries:
+        if not entry.get('reference'):
+            continue
+        try:
+            with track_upstream('firestore', 'transactions.update'):
+                db.collection('transactions').document(entry['reference']).update({
+                    'transaction_hash': transaction_hash,
+                    'settlement_status': 'settled'
+                })
+        except Exception as e:
+            print(f"Failed to record settlement for transaction {entry['reference']}:", e)
+
+def reverse_dead_settlement(entry):
+    """
+    Called for a conversion whose transfer will never settle: marks it failed and takes back
+    the INR it credited. Runs again after a crash, so it checks whether that already happened.
+    """
+    if not entry.get('reference'):
+        return
+    transaction_ref = db.collection('transactions').document(entry['reference'])
+    with track_upstream('firestore', 'transactions.get'):
+        transaction = transaction_ref.get().to_dict()
+    if transaction is None:
+        print(f"Settlement {entry['id']} abandoned but conversion {entry['reference']} was never recorded; needs operator review")
+        return
+    if transaction.get('settlement_status') == 'failed':
+        return
+    # One batch, so the status and the balance can't disagree after a crash
+    batch = db.batch()
+    batch.update(transaction_ref, {'settlement_status': 'failed', 'settlement_error': entry.get('error')})
+    batch.update(db.collection('wallets').document(entry['wallet_id']),
+                 {'inr_balance': firestore.Increment(-transaction.get('net_value_after_fee', 0))})
+    with track_upstream('firestore', 'batch.commit'):
+        batch.commit()
+
+settlement_engine = SettlementEngine(
+    log_path=os.getenv('SETTLEMENT_LOG_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'settlements.jsonl')),
+    destination=admin_rec_acc,
+    resolve_secret=resolve_wallet_secret,
+    on_settled=record_settlement,
+    on_dead=reverse_dead_settlement,
+    horizon_url=HORIZON_URL,
+    window_seconds=float(os.getenv('SETTLEMENT_WINDOW_SECONDS', '5')),
+    max_batch=int(os.getenv('SETTLEMENT_MAX_BATCH', '100')),
+    max_attempts=int(os.getenv('SETTLEMENT_MAX_ATTEMPTS', '5')),
+    fee_strategy=fee_strategy,
+    cache=cache,
+    fee_secret=os.getenv('SETTLEMENT_FEE_SECRET')
+)
+
+def load_wallet_directory():
+    with track_upstream('firestore', 'wallets.stream'):
+        wallets = [doc.to_dict() for doc in db.collection('wallets').stream()]
+    for wallet in wallets:
+        yield wallet.get('email'), wallet.get('wallet_addresses', {})
+
+ledger_index = LedgerIndex(
+    os.getenv('LEDGER_INDEX_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ledger_index.sqlite3'))
+)
+ledger_ingestor = LedgerIngestor(
+    ledger_index,
+    horizon_url=HORIZON_URL,
+    fixture_path=os.getenv('LEDGER_FIXTURE_PATH'),
+    load_accounts=load_wallet_directory,
+    poll_interval=float(os.getenv('LEDGER_POLL_SECONDS', '2'))
+)
+
+@app.before_request
+def start_background_workers():
+    # Started on first request rather than at import so the debug reloader's
+    # watcher process never replays settlements or ingests payments itself
+    fee_strategy.start()
+    settlement_engine.start()
+    ledger_ingestor.start()
+
 def is_valid_stellar_address(address):
     return address.startswith('G') and len(address) == 56
 
+def upstream_busy_response(e):
+    # An upstream is rate limiting us; tell the client when to come back instead of failing with a 500
+    response = jsonify({"error": str(e)})
+    response.headers['Retry-After'] = str(math.ceil(e.retry_after))
+    return response, 503
+
+@app.errorhandler(UpstreamBusy)
+def handle_upstream_busy(e):
+    return upstream_busy_response(e)
+
 @app.route('/')
 def index():
     return jsonify({"message": "Welcome to the Stellar Wallet API!"})
@@ -45,63 +298,133 @@ def convert_crypto():
         crypto_symbol = data.get('crypto_symbol').upper()
         target_currency = data.get('target_currency').upper()
 
-        if crypto_symbol not in ['BTC', 'ETH', 'SOL']:
+        if crypto_symbol not in ASSET_SYMBOLS:
             return jsonify({'error': 'Invalid crypto symbol'}), 400
 
-        if target_currency not in ['INR', 'USD']:
-            return jsonify({'error': 'Invalid target currency'}), 400
+        error = currency_error(quote_store.current_snapshot(), target_currency)
+        if error:
+            return error
 
-        crypto_data = get_crypto_data()
-        crypto_inr_price = crypto_data[crypto_symbol]['price_inr']
+        # Rates come from the shared snapshot, and the quote locks the price shown here
+        # so /convert can settle at exactly this rate
+        try:
+            quote = quote_store.create(crypto_symbol, target_currency)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        converted_price = amount * quote.rate
 
-        if target_currency == 'INR':
-            converted_price = amount * crypto_inr_price
-        else:
-            # Convert crypto INR price to USD
-            inr_to_usd_rate = get_exchange_rate('INR', 'USD')
-            crypto_usd_price = crypto_inr_price * inr_to_usd_rate
-            converted_price = amount * crypto_usd_price
-
-        # Also prepare prices for 1 BTC, 1 ETH, 1 SOL
-        prices = {}
-        for symbol in ['BTC', 'ETH', 'SOL']:
-            price_inr = crypto_data[symbol]['price_inr']
-            if target_currency == 'INR':
-                price = price_inr
-            else:
-                price = price_inr * inr_to_usd_rate
-            prices[symbol] = price
+        # Also prepare prices for 1 unit of every registered asset
+        prices = quote.snapshot.prices_in(target_currency)
 
         response = {
             'converted_value': round(converted_price, 2),
-            'prices_for_1_unit': {
-                'BTC': round(prices['BTC'], 2),
-                'ETH': round(prices['ETH'], 2),
-                'SOL': round(prices['SOL'], 2)
-            }
+            'prices_for_1_unit': {symbol: finite_or_none(price) for symbol, price in prices.items()},
+            'quote_id': quote.id,
+            'expires_at': datetime.fromtimestamp(quote.expires_at, timezone.utc).isoformat()
         }
 
         return jsonify(response)
+    except UpstreamBusy as e:
+        return upstream_busy_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/quote', methods=['POST'])
+def create_quote():
+    try:
+        data = request.get_json()
+        crypto_symbol = data.get('crypto_symbol', '').upper()
+        target_currency = data.get('target_currency', '').upper()
+        amount = data.get('amount')
+
+        if not crypto_symbol or not target_currency:
+            return jsonify({'error': 'crypto_symbol and target_currency are required'}), 400
+        if amount is not None:
+            try:
+                amount = float(amount)
+            except (TypeError, ValueError):
+                return jsonify({'error': 'amount must be a number'}), 400
+
+        error = currency_error(quote_store.current_snapshot(), target_currency)
+        if error:
+            return error
+        try:
+            quote = quote_store.create(crypto_symbol, target_currency)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        return jsonify(quote_payload(quote, amount))
+    except UpstreamBusy as e:
+        return upstream_busy_response(e)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/prices/history', methods=['GET'])
+def get_price_history():
+    symbol = request.args.get('symbol', '').upper()
+    if symbol not in ASSET_SYMBOLS:
+        return jsonify({'error': 'Invalid crypto symbol'}), 400
+
+    try:
+        end = float(request.args.get('end', time.time()))
+        start = float(request.args.get('start', end - 86400))
+        interval = float(request.args['interval']) if 'interval' in request.args else None
+    except ValueError:
+        return jsonify({'error': 'start, end and interval must be numbers (seconds)'}), 400
+
+    if start >= end:
+        return jsonify({'error': 'start must be before end'}), 400
+
+    if interval is not None:
+        if interval <= 0 or (end - start) / interval > MAX_HISTORY_POINTS:
+            return jsonify({'error': f'interval must be positive and give at most {MAX_HISTORY_POINTS} buckets'}), 400
+        candles = price_history.ohlc(symbol, start, end, interval)
+        return jsonify({
+            'symbol': symbol,
+            'currency': 'INR',
+            'interval': interval,
+            'candles': [
+                {'t': t, 'open': o, 'high': h, 'low': l, 'close': c}
+                for t, o, h, l, c in candles.tolist()
+            ]
+        })
+
+    records = price_history.range(symbol, start, end)
+    if len(records) > MAX_HISTORY_POINTS:
+        # Evenly thin the series rather than truncating one end of the range
+        records = records[np.linspace(0, len(records) - 1, MAX_HISTORY_POINTS).astype(np.intp)]
+    return jsonify({
+        'symbol': symbol,
+        'currency': 'INR',
+        'points': np.column_stack((records['ts'], records['close'])).tolist()
+    })
+
 @app.route('/convert', methods=['POST'])
+@idempotent
 def convert_crypto_to_currency():
     try:
         data = request.get_json()
         sender_email = data.get('sender_email')
         password = data.get('password')
         crypto_symbol = data.get('crypto_symbol').upper()
-        amount_crypto = float(data.get('amount'))
+        amount = data.get('amount')
         target_currency = data.get('target_currency').upper()
 
         # Validate input
-        if not all([sender_email, password, crypto_symbol, amount_crypto, target_currency]):
+        if not all([sender_email, password, crypto_symbol, amount, target_currency]):
             return jsonify({"error": "Missing required parameters"}), 400
+        try:
+            amount_crypto = float(amount)
+        except (TypeError, ValueError):
+            return jsonify({"error": "Invalid amount"}), 400
+        # A negative transfer would lower the account's settlement reservation and its netted payment
+        if not math.isfinite(amount_crypto) or amount_crypto <= 0:
+            return jsonify({"error": "Amount must be positive"}), 400
 
         # Fetch user wallet
-        user_query = db.collection('wallets').where('email', '==', sender_email).limit(1).stream()
-        user_doc = next(user_query, None)
+        with track_upstream('firestore', 'wallets.query'):
+            user_query = db.collection('wallets').where('email', '==', sender_email).limit(1).stream()
+            user_doc = next(user_query, None)
         if not user_doc:
             return jsonify({"error": "User not found"}), 404
 
@@ -112,50 +435,64 @@ def convert_crypto_to_currency():
 
         wallet_secrets = user_data.get('wallet_secrets', {})
 
-        # Step 1: Get crypto price in INR
-        crypto_data = get_crypto_data()
-        if crypto_symbol not in crypto_data:
-            return jsonify({"error": f"Unsupported crypto symbol: {crypto_symbol}"}), 400
-
-        crypto_inr_price = crypto_data[crypto_symbol]['price_inr']
+        # Step 1: Lock the price, either from the client's quote or a fresh one
+        # A client's quote is only checked here; it is used up once the transfer is queued below
+        quote_id = data.get('quote_id')
+        if quote_id:
+            quote = quote_store.peek(quote_id)
+            if not quote:
+                return jsonify({"error": "Quote not found or expired"}), 410
+            if quote.crypto_symbol != crypto_symbol or quote.target_currency != target_currency:
+                return jsonify({"error": "Quote does not match the requested conversion"}), 400
+        else:
+            error = currency_error(quote_store.current_snapshot(), target_currency)
+            if error:
+                return error
+            try:
+                quote = quote_store.create(crypto_symbol, target_currency)
+            except ValueError as e:
+                return jsonify({"error": str(e)}), 400
 
         # Step 2: Calculate INR value of crypto
-        amount_in_inr = amount_crypto * crypto_inr_price
+        amount_in_inr = amount_crypto * quote.price_inr
 
-        # Step 3: Convert INR to target currency (if needed)
-        if target_currency == 'INR':
-            final_amount = amount_in_inr
-        else:
-            exchange_rate = get_exchange_rate('INR', target_currency)
-            if not exchange_rate:
-                return jsonify({"error": f"Unable to fetch exchange rate INR -> {target_currency}"}), 500
-            final_amount = amount_in_inr * exchange_rate
+        # Step 3: Convert to target currency at the locked rate
+        final_amount = amount_crypto * quote.rate
 
         # Step 4: Apply 2.5% fee
-        fee_percentage = 2.5
+        fee_percentage = CONVERSION_FEE_PERCENTAGE
         net_amount = final_amount * (1 - fee_percentage / 100)
 
-        # Step 5: Perform crypto transfer to admin
+        # Step 5: Queue the crypto transfer to admin; it is netted with other
+        # conversions and settled on-chain in the background
         sender_secret = wallet_secrets.get(crypto_symbol.lower())
-        if not sender_secret:
+        sender_public = user_data.get('wallet_addresses', {}).get(crypto_symbol.lower())
+        if not sender_secret or not sender_public:
             return jsonify({"error": f"{crypto_symbol} wallet not configured for user"}), 400
 
-        transaction_hash = send_payment_and_show_balances(
-            sender_secret,
-            admin_rec_acc,
-            amount_crypto
+        available = Decimal(str(get_stellar_balance(sender_public))) - MIN_ACCOUNT_BALANCE
+        if quote_id and not quote_store.take(quote_id):
+            # Another request used the quote since it was checked above
+            return jsonify({"error": "Quote not found or expired"}), 410
+        transaction_ref = db.collection('transactions').document()
+        settlement_id = settlement_engine.enqueue(
+            user_doc.id,
+            crypto_symbol.lower(),
+            sender_public,
+            amount_crypto,
+            reference=transaction_ref.id,
+            balance=available
         )
+        if not settlement_id:
+            if quote_id:
+                quote_store.restore(quote)
+            return jsonify({"error": f"Insufficient {crypto_symbol} balance"}), 400
+        mark_committed()
 
-        if not transaction_hash:
-            return jsonify({"error": "Crypto transfer failed"}), 500
-
-        # Step 6: Update user's INR balance
+        # Step 6: Update user's INR balance; an increment, so concurrent conversions don't overwrite each other
         user_doc_ref = db.collection('wallets').document(user_doc.id)
-        user_snapshot = user_doc_ref.get()
-        current_balance = user_snapshot.to_dict().get('inr_balance', 0)
-
-        updated_balance = current_balance + net_amount
-        user_doc_ref.update({'inr_balance': updated_balance})
+        with track_upstream('firestore', 'wallets.update'):
+            user_doc_ref.update({'inr_balance': firestore.Increment(net_amount)})
 
         # Step 7: Save transaction to Firestore
         transaction_record = {
@@ -167,11 +504,16 @@ def convert_crypto_to_currency():
             "net_value_after_fee": net_amount,
             "target_currency": target_currency,
             "transaction_type": "convert",
-            "transaction_hash": transaction_hash,
+            "transaction_hash": None,
+            "settlement_id": settlement_id,
+            "settlement_status": "pending",
+            "quote_id": quote.id,
+            "rate": quote.rate,
             "fee_percentage": fee_percentage,
             "timestamp": firestore.SERVER_TIMESTAMP
         }
-        db.collection('transactions').add(transaction_record)
+        with track_upstream('firestore', 'transactions.set'):
+            transaction_ref.set(transaction_record)
 
         return jsonify({
             "message": "Conversion successful",
@@ -179,78 +521,81 @@ def convert_crypto_to_currency():
             "crypto_symbol": crypto_symbol,
             "net_value_after_fee": net_amount,
             "target_currency": target_currency,
-            "transaction_hash": transaction_hash
+            "settlement_id": settlement_id,
+            "settlement_status": "pending",
+            "quote_id": quote.id,
+            "rate": quote.rate
         }), 200
 
+    except UpstreamBusy as e:
+        return upstream_busy_response(e)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 @app.route('/balance', methods=['POST'])
 def balance():
-    data = request.get_json()
-    wallet_addresses = data.get('wallet_addresses', {})
-    btc_address = wallet_addresses.get('btc')
-    eth_address = wallet_addresses.get('eth')
-    sol_address = wallet_addresses.get('sol')
-    inr_address = wallet_addresses.get('inr', None)  # New
-
-    # Fetch balances from Stellar testnet
-    def get_stellar_balance(address):
-        url = f'https://horizon-testnet.stellar.org/accounts/{address}'
-        response = requests.get(url)
-        if response.status_code != 200:
+    try:
+        data = request.get_json()
+        wallet_addresses = data.get('wallet_addresses', {})
+        inr_address = wallet_addresses.get('inr', None)  # New
+
+        # Fetch balances from Stellar testnet
+        def get_stellar_balance(address):
+            url = f'{HORIZON_URL}/accounts/{address}'
+            response = timed_get('horizon', 'accounts', url)
+            if response.status_code != 200:
+                return 0.0
+            account_data = response.json()
+            balances = account_data.get('balances', [])
+            for balance in balances:
+                if balance.get('asset_type') == 'native':
+                    return float(balance.get('balance', 0.0))
             return 0.0
-        account_data = response.json()
-        balances = account_data.get('balances', [])
-        for balance in balances:
-            if balance.get('asset_type') == 'native':
-                return float(balance.get('balance', 0.0))
-        return 0.0
-
-    btc_balance = get_stellar_balance(btc_address)
-    eth_balance = get_stellar_balance(eth_address)
-    sol_balance = get_stellar_balance(sol_address)
-
-    # Fetch crypto price and 24h change
-    crypto_data = get_crypto_data()
 
-    # Handle INR balance (default 10000 if missing)
-    inr_balance = next((doc.to_dict().get('inr_balance') for doc in db.collection('wallets').where('wallet_addresses.btc', '==', btc_address).stream()), None)
-    if inr_balance is None:
-        inr_balance = 10000.0
-    else:
-        inr_balance = float(inr_balance)
-
-    # Handle USD balance (default 10000 if missing)
-
-    result = {
-        'BTC': {
-            'balance': btc_balance,
-            'price_inr': crypto_data['BTC']['price_inr'],
-            'change_24h': round(crypto_data['BTC']['change_24h'], 2),
-            'inr_value': round(btc_balance * crypto_data['BTC']['price_inr'], 2)
-        },
-        'ETH': {
-            'balance': eth_balance,
-            'price_inr': crypto_data['ETH']['price_inr'],
-            'change_24h': round(crypto_data['ETH']['change_24h'], 2),
-            'inr_value': round(eth_balance * crypto_data['ETH']['price_inr'], 2)
-        },
-        'SOL': {
-            'balance': sol_balance,
-            'price_inr': crypto_data['SOL']['price_inr'],
-            'change_24h': round(crypto_data['SOL']['change_24h'], 2),
-            'inr_value': round(sol_balance * crypto_data['SOL']['price_inr'], 2)
-        },
-        'INR': {
+        crypto_balances = {}
+        for asset in ASSETS:
+            address = wallet_addresses.get(asset.wallet_key)
+            crypto_balances[asset.symbol] = get_stellar_balance(address) if address else 0.0
+
+        # Price and 24h change for every asset come from the shared snapshot in one lookup
+        matrix = quote_store.current_snapshot()
+        prices_inr = matrix.prices_in('INR', crypto_balances)
+        values_inr = matrix.values(crypto_balances, 'INR')
+        changes = matrix.changes(crypto_balances)
+
+        # Handle INR balance (default 10000 if missing); the wallet is identified by its first crypto address
+        lookup_key = next((asset.wallet_key for asset in ASSETS if wallet_addresses.get(asset.wallet_key)), None)
+        inr_balance = None
+        if lookup_key:
+            with track_upstream('firestore', 'wallets.query'):
+                inr_balance = next((doc.to_dict().get('inr_balance') for doc in db.collection('wallets').where(f'wallet_addresses.{lookup_key}', '==', wallet_addresses[lookup_key]).stream()), None)
+        if inr_balance is None:
+            inr_balance = 10000.0
+        else:
+            inr_balance = float(inr_balance)
+
+        # Handle USD balance (default 10000 if missing)
+
+        result = {}
+        for symbol, balance in crypto_balances.items():
+            result[symbol] = {
+                'balance': balance,
+                'price_inr': finite_or_none(prices_inr[symbol], 6),
+                'change_24h': finite_or_none(changes[symbol]),
+                'inr_value': finite_or_none(values_inr[symbol])
+            }
+        result['INR'] = {
             'balance': round(inr_balance, 2),
             'price_inr': 1,  # 1 INR == 1 INR
             'change_24h': 0,  # No fluctuation
             'inr_value': round(inr_balance, 2)
         }
-    }
 
-    return jsonify({'balances': result})
+        return jsonify({'balances': result})
+    except UpstreamBusy as e:
+        return upstream_busy_response(e)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
 @app.route('/create_wallet', methods=['POST'])
 def create_wallet():
@@ -263,9 +608,10 @@ def create_wallet():
         return jsonify({'error': 'Name, email, and password are required'}), 400
 
     try:
-        amounts = calculate_crypto_amounts()
+        amounts = calculate_crypto_amounts(matrix=quote_store.current_snapshot())
         # Check if email already exists
-        user_query = db.collection('wallets').where('email', '==', email).get()
+        with track_upstream('firestore', 'wallets.query'):
+            user_query = db.collection('wallets').where('email', '==', email).get()
         if user_query:
             return jsonify({'error': 'Email already registered'}), 409
 
@@ -278,7 +624,7 @@ def create_wallet():
             secret = keypair.secret
 
             # Fund the account using Friendbot
-            response = requests.get(f'https://horizon-testnet.stellar.org/friendbot?addr={public_key}')
+            response = timed_get('friendbot', 'fund', f'{HORIZON_URL}/friendbot?addr={public_key}')
             if response.status_code != 200:
                 raise Exception(f'Failed to fund {currency} wallet: {response.text}')
 
@@ -289,7 +635,7 @@ def create_wallet():
 
         with ThreadPoolExecutor() as executor:
             futures = []
-            for currency in ['btc', 'eth', 'sol']:
+            for currency in [asset.wallet_key for asset in ASSETS]:
                 futures.append(executor.submit(create_single_wallet, currency, amounts, admin_rec_acc))
 
             for future in futures:
@@ -311,10 +657,16 @@ def create_wallet():
         }
 
         # Add document to Firestore
-        db.collection('wallets').add(wallet_data)
+        with track_upstream('firestore', 'wallets.add'):
+            _, wallet_ref = db.collection('wallets').add(wallet_data)
+        cache.set_json(f'wallets:directory:{email}', {'id': wallet_ref.id, 'wallet_addresses': wallet_addresses},
+                       WALLET_DIRECTORY_TTL)
+        ledger_ingestor.request_backfill(ledger_index.register_accounts(email, wallet_addresses))
 
         return jsonify({'message': 'Wallet created successfully', 'wallet_addresses': wallet_addresses}), 201
 
+    except UpstreamBusy as e:
+        return upstream_busy_response(e)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -330,7 +682,8 @@ def access_wallet():
         return jsonify({'error': 'Email and password are required'}), 400
 
     try:
-        user_query = db.collection('wallets').where('email', '==', email).get()
+        with track_upstream('firestore', 'wallets.query'):
+            user_query = db.collection('wallets').where('email', '==', email).get()
         if not user_query:
             return jsonify({'error': 'Wallet not found'}), 404
 
@@ -359,6 +712,7 @@ def access_wallet():
         return jsonify({'error': str(e)}), 500
 
 @app.route('/send', methods=['POST'])
+@idempotent
 def send_payment():
     try:
         # Parse request body
@@ -375,8 +729,9 @@ def send_payment():
             return jsonify({"error": "Missing required parameters"}), 400
 
         # Query sender wallet info by email
-        sender_query = db.collection('wallets').where('email', '==', sender_email).limit(1).stream()
-        sender_doc = next(sender_query, None)
+        with track_upstream('firestore', 'wallets.query'):
+            sender_query = db.collection('wallets').where('email', '==', sender_email).limit(1).stream()
+            sender_doc = next(sender_query, None)
         if not sender_doc:
             return jsonify({"error": "Sender not found"}), 404
 
@@ -391,16 +746,13 @@ def send_payment():
         if wallet_type not in ['inr'] and not sender_wallet_secret:
             return jsonify({"error": f"Sender does not have a {wallet_type} wallet"}), 404
 
-        # Query receiver wallet info by email
-        receiver_query = db.collection('wallets').where('email', '==', destination_email).limit(1).stream()
-        receiver_doc = next(receiver_query, None)
-        if not receiver_doc:
+        # Look up receiver wallet info by email
+        receiver = lookup_wallet(destination_email)
+        if not receiver:
             return jsonify({"error": "Receiver not found"}), 404
 
-        receiver_data = receiver_doc.to_dict()
-
         # Get receiver's wallet address
-        receiver_wallet_address = receiver_data.get('wallet_addresses', {}).get(wallet_type)
+        receiver_wallet_address = receiver['wallet_addresses'].get(wallet_type)
         if not receiver_wallet_address:
             return jsonify({"error": f"Receiver does not have a {wallet_type} wallet"}), 404
 
@@ -408,11 +760,29 @@ def send_payment():
             # For INR and USD, simulate transaction
             transaction_response = str(uuid.uuid4())
         else:
+            # XLM already promised to a pending settlement can't be spent again
+            sender_public = sender_data.get('wallet_addresses', {}).get(wallet_type)
+            try:
+                send_amount = Decimal(str(amount))
+            except ArithmeticError:
+                return jsonify({"error": "Invalid amount"}), 400
+            if send_amount <= 0:
+                return jsonify({"error": "Amount must be positive"}), 400
+            owed = settlement_engine.pending_amount(sender_public)
+            spendable = Decimal(str(get_stellar_balance(sender_public))) - MIN_ACCOUNT_BALANCE - owed
+            if send_amount > spendable:
+                return jsonify({
+                    "error": f"Insufficient {wallet_type} balance",
+                    "spendable": float(max(spendable, Decimal(0))),
+                    "pending_settlement": float(owed)
+                }), 400
+
             # Blockchain payment
             transaction_response = send_payment_and_show_balances(
                 sender_wallet_secret,
                 receiver_wallet_address,
-                amount
+                amount,
+                on_submit=mark_committed
             )
             if not transaction_response:
                 return jsonify({"error": "Transaction failed"}), 500
@@ -427,7 +797,8 @@ def send_payment():
             "transaction_hash": transaction_response,
             "timestamp": firestore.SERVER_TIMESTAMP
         }
-        db.collection('transactions').add(sender_transaction)
+        with track_upstream('firestore', 'transactions.add'):
+            db.collection('transactions').add(sender_transaction)
 
         # Save transaction to 'transactions' collection for receiver (received)
         receiver_transaction = {
@@ -439,7 +810,8 @@ def send_payment():
             "transaction_hash": transaction_response,
             "timestamp": firestore.SERVER_TIMESTAMP
         }
-        db.collection('transactions').add(receiver_transaction)
+        with track_upstream('firestore', 'transactions.add'):
+            db.collection('transactions').add(receiver_transaction)
 
         # Success response
         return jsonify({
@@ -447,6 +819,8 @@ def send_payment():
             "transaction_hash": transaction_response
         }), 200
 
+    except UpstreamBusy as e:
+        return upstream_busy_response(e)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
        
@@ -461,13 +835,17 @@ def generate_qr():
         return jsonify({"error": "Invalid Stellar address"}), 400
 
     try:
-        stellar_uri = f"stellar:{address}?network=testnet"
-        qr = segno.make(stellar_uri, error='h')
-
-        img_io = io.BytesIO()
-        qr.save(img_io, kind='png', scale=10, dark="#0B0D2B", light="#FFFFFF", border=2)
-        img_io.seek(0)
-        return send_file(img_io, mimetype='image/png')
+        # The image only depends on the address, so every worker can reuse one render
+        png = cache.get(f'qr:{address}')
+        if png is None:
+            stellar_uri = f"stellar:{address}?network=testnet"
+            qr = segno.make(stellar_uri, error='h')
+
+            img_io = io.BytesIO()
+            qr.save(img_io, kind='png', scale=10, dark="#0B0D2B", light="#FFFFFF", border=2)
+            png = img_io.getvalue()
+            cache.set(f'qr:{address}', png, QR_CACHE_TTL)
+        return send_file(io.BytesIO(png), mimetype='image/png')
     
     except Exception as e:
         return jsonify({"error": f"QR generation failed: {str(e)}"}), 500
@@ -481,15 +859,17 @@ def get_transactions():
     # Authenticate user by querying the 'wallets' collection
     wallets_ref = db.collection('wallets')
     query = wallets_ref.where('email', '==', email).where('password', '==', password).limit(1)
-    results = query.stream()
-    user_doc = next(results, None)
+    with track_upstream('firestore', 'wallets.query'):
+        results = query.stream()
+        user_doc = next(results, None)
 
     if not user_doc:
         return jsonify({"error": "Invalid credentials"}), 401
 
     # Retrieve transactions associated with the authenticated user
     transactions_ref = db.collection('transactions').where('email', '==', email)
-    docs = transactions_ref.stream()
+    with track_upstream('firestore', 'transactions.query'):
+        docs = list(transactions_ref.stream())
 
     transactions = []
 
@@ -538,11 +918,55 @@ def get_transactions():
             "name": name,
             "date": date,
             "amount": amount,
-            "status": "completed"  # Assuming all are completed
+            "status": TRANSACTION_STATUSES.get(record.get('settlement_status'), "completed")
+        })
+
+    # Add on-chain payments from the local ledger index that the API didn't record itself,
+    # e.g. ones made from the mobile app. Internal transfers to the admin account are left out.
+    known_hashes = {doc.to_dict().get('transaction_hash') for doc in docs}
+    wallet_addresses = user_doc.to_dict().get('wallet_addresses', {})
+    for payment in reversed(ledger_index.history(wallet_addresses.values())):
+        if payment['tx_hash'] in known_hashes or payment['kind'] != 'payment' or payment['counterparty'] == admin_rec_acc:
+            continue
+        amount = float(payment['amount'])
+        transactions.append({
+            "id": len(transactions) + 1,
+            "type": payment['direction'],
+            "name": payment['counterparty_email'] or payment['counterparty'],
+            "date": datetime.fromtimestamp(payment['created_at'], timezone.utc).strftime('%Y-%m-%d'),
+            "amount": -amount if payment['direction'] == 'sent' else amount,
+            "status": "completed"
         })
 
     return jsonify({"transactions": transactions})
 
+@app.route('/reconcile', methods=['POST'])
+def reconcile_balances():
+    data = request.get_json()
+    email = data.get('email')
+    password = data.get('password')
+
+    with track_upstream('firestore', 'wallets.query'):
+        user_doc = next(db.collection('wallets').where('email', '==', email).where('password', '==', password).limit(1).stream(), None)
+    if not user_doc:
+        return jsonify({"error": "Invalid credentials"}), 401
+
+    accounts = {}
+    for key, address in user_doc.to_dict().get('wallet_addresses', {}).items():
+        if not address or not is_valid_stellar_address(address):
+            continue
+        indexed = ledger_index.indexed_balance(address)
+        onchain = Decimal(str(get_stellar_balance(address)))
+        accounts[key] = {
+            "address": address,
+            "indexed_balance": float(indexed),
+            "onchain_balance": float(onchain),
+            "difference": float(onchain - indexed),
+            "pending_settlement": float(settlement_engine.pending_amount(address))
+        }
+
+    return jsonify({"accounts": accounts})
+
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
    
\ No newline at end of file
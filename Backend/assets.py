@@ -0,0 +1,105 @@
+import os
+import time
+import uuid
+import numpy as np
+
+# Crypto assets the backend prices and creates wallets for, as SYMBOL:coingecko-id pairs.
+# Override with e.g. CRYPTO_ASSETS="BTC:bitcoin,ETH:ethereum,SOL:solana,ADA:cardano"
+DEFAULT_ASSETS = 'BTC:bitcoin,ETH:ethereum,SOL:solana'
+BASE_FIAT = 'INR'
+
+
+class CryptoAsset:
+    __slots__ = ('symbol', 'coingecko_id')
+
+    def __init__(self, symbol, coingecko_id):
+        self.symbol = symbol.upper()
+        self.coingecko_id = coingecko_id.lower()
+
+    @property
+    def wallet_key(self):
+        # Key under wallet_addresses / wallet_secrets in Firestore
+        return self.symbol.lower()
+
+
+def load_assets(spec=None):
+    spec = spec or os.getenv('CRYPTO_ASSETS', DEFAULT_ASSETS)
+    assets = []
+    for item in spec.split(','):
+        symbol, _, coingecko_id = item.strip().partition(':')
+        if not symbol or not coingecko_id:
+            raise ValueError(f"Invalid CRYPTO_ASSETS entry: {item!r}")
+        assets.append(CryptoAsset(symbol, coingecko_id))
+    return tuple(assets)
+
+
+ASSETS = load_assets()
+ASSET_SYMBOLS = tuple(asset.symbol for asset in ASSETS)
+
+
+class ConversionMatrix:
+    """
+    Prices of every asset in every fiat currency, computed once per price update.
+
+    prices[i, j] is the price of one unit of symbols[i] in fiats[j]. It is the outer
+    product of the INR price column and the INR -> fiat rate row, so pricing any set of
+    assets in any set of currencies is a single indexed lookup.
+    """
+    __slots__ = ('id', 'taken_at', 'symbols', 'fiats', 'asset_index', 'fiat_index', 'prices', 'change_24h',
+                 'has_fiat_rates')
+
+    def __init__(self, crypto_data, fiat_rates, symbols=ASSET_SYMBOLS, snapshot_id=None, taken_at=None):
+        """
+        crypto_data: {SYMBOL: {'price_inr': float, 'change_24h': float}}, as from get_crypto_data()
+        fiat_rates: {CURRENCY: units of CURRENCY per 1 INR}, as from get_exchange_rates('INR');
+            empty when the rates couldn't be fetched, which leaves INR prices only
+        snapshot_id/taken_at: set when rebuilding a snapshot another worker took
+        """
+        self.id = snapshot_id or uuid.uuid4().hex
+        self.taken_at = taken_at if taken_at is not None else time.time()
+        self.symbols = tuple(symbols)
+        fiats = [BASE_FIAT] + sorted(c for c in fiat_rates if c != BASE_FIAT)
+        self.fiats = tuple(fiats)
+        self.has_fiat_rates = len(fiats) > 1
+        self.asset_index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        self.fiat_index = {fiat: j for j, fiat in enumerate(self.fiats)}
+
+        nan = float('nan')
+        price_inr = np.array([crypto_data.get(s, {}).get('price_inr', nan) for s in self.symbols], dtype=np.float64)
+        self.change_24h = np.array([crypto_data.get(s, {}).get('change_24h', nan) for s in self.symbols], dtype=np.float64)
+        rates = np.array([1.0] + [fiat_rates[f] for f in fiats[1:]], dtype=np.float64)
+        self.prices = np.outer(price_inr, rates)
+
+    def _asset_rows(self, symbols):
+        try:
+            return np.array([self.asset_index[s] for s in symbols], dtype=np.intp)
+        except KeyError as e:
+            raise ValueError(f"Unsupported crypto symbol: {e.args[0]}")
+
+    def _fiat_column(self, fiat):
+        if fiat not in self.fiat_index:
+            raise ValueError(f"Unsupported target currency: {fiat}")
+        return self.fiat_index[fiat]
+
+    def price(self, symbol, fiat):
+        value = self.prices[self._asset_rows((symbol,))[0], self._fiat_column(fiat)]
+        if np.isnan(value):
+            raise ValueError(f"No price available for {symbol}")
+        return float(value)
+
+    def prices_in(self, fiat, symbols=None):
+        """Price of one unit of each asset in `fiat`, as a {symbol: price} dict."""
+        symbols = self.symbols if symbols is None else tuple(symbols)
+        column = self.prices[self._asset_rows(symbols), self._fiat_column(fiat)]
+        return dict(zip(symbols, column.tolist()))
+
+    def values(self, holdings, fiat):
+        """Values {symbol: amount} holdings in `fiat`, returning {symbol: value}."""
+        symbols = tuple(holdings)
+        amounts = np.fromiter((holdings[s] for s in symbols), dtype=np.float64, count=len(symbols))
+        column = self.prices[self._asset_rows(symbols), self._fiat_column(fiat)]
+        return dict(zip(symbols, (amounts * column).tolist()))
+
+    def changes(self, symbols=None):
+        symbols = self.symbols if symbols is None else tuple(symbols)
+        return dict(zip(symbols, self.change_24h[self._asset_rows(symbols)].tolist()))
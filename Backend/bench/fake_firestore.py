@@ -0,0 +1,198 @@
+import uuid
+import threading
+from datetime import datetime, timezone
+from multiprocessing.managers import BaseManager
+from firebase_admin import firestore
+from google.cloud.firestore_v1.transforms import Increment
+
+# In-memory stand-in for the subset of the Firestore client API used by app.py.
+# Writes are deep-copied and SERVER_TIMESTAMP is resolved on write, like the real server does.
+# Documents live in a DocumentStore: in-process by default, or served by a
+# FirestoreManager so several gunicorn workers see the same data.
+
+
+def _resolve(value):
+    if value is firestore.SERVER_TIMESTAMP:
+        return datetime.now(timezone.utc)
+    if isinstance(value, dict):
+        return {k: _resolve(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_resolve(v) for v in value]
+    return value
+
+
+def _lookup(data, field_path):
+    for part in field_path.split('.'):
+        if not isinstance(data, dict) or part not in data:
+            return None
+        data = data[part]
+    return data
+
+
+class DocumentStore:
+    def __init__(self):
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def get(self, collection, doc_id):
+        with self._lock:
+            return self._collections.get(collection, {}).get(doc_id)
+
+    def set(self, collection, doc_id, data, merge=False):
+        with self._lock:
+            self._set(collection, doc_id, data, merge)
+
+    def update(self, collection, doc_id, data):
+        with self._lock:
+            self._update(collection, doc_id, data)
+
+    def apply(self, writes):
+        """Applies a batch of ('set' | 'update', collection, doc_id, data) writes all or nothing."""
+        with self._lock:
+            for kind, collection, doc_id, data in writes:
+                if kind == 'update' and doc_id not in self._collections.get(collection, {}):
+                    raise KeyError(f'No document to update: {doc_id}')
+            for kind, collection, doc_id, data in writes:
+                if kind == 'set':
+                    self._set(collection, doc_id, data)
+                else:
+                    self._update(collection, doc_id, data)
+
+    def _set(self, collection, doc_id, data, merge=False):
+        docs = self._collections.setdefault(collection, {})
+        if merge and doc_id in docs:
+            docs[doc_id].update(data)
+        else:
+            docs[doc_id] = data
+
+    def _update(self, collection, doc_id, data):
+        docs = self._collections.setdefault(collection, {})
+        if doc_id not in docs:
+            raise KeyError(f'No document to update: {doc_id}')
+        for field, value in data.items():
+            if isinstance(value, Increment):
+                value = (docs[doc_id].get(field) or 0) + value.value
+            docs[doc_id][field] = value
+
+    def query(self, collection, filters, limit=None):
+        with self._lock:
+            matches = []
+            for doc_id, data in self._collections.get(collection, {}).items():
+                if all(_lookup(data, field) == value for field, value in filters):
+                    matches.append((doc_id, data))
+                    if limit is not None and len(matches) >= limit:
+                        break
+            return matches
+
+
+_shared_store = None
+
+
+def _get_shared_store():
+    global _shared_store
+    if _shared_store is None:
+        _shared_store = DocumentStore()
+    return _shared_store
+
+
+class FirestoreManager(BaseManager):
+    pass
+
+
+FirestoreManager.register('store', callable=_get_shared_store)
+
+
+def connect_store(address, authkey):
+    """A proxy to the DocumentStore served by a FirestoreManager started elsewhere."""
+    manager = FirestoreManager(address=address, authkey=authkey)
+    manager.connect()
+    return manager.store()
+
+
+class FakeDocumentSnapshot:
+    def __init__(self, doc_id, data):
+        self.id = doc_id
+        self._data = data
+        self.exists = data is not None
+
+    def to_dict(self):
+        return _resolve(self._data) if self._data is not None else None
+
+
+class FakeDocumentReference:
+    def __init__(self, collection, doc_id):
+        self._collection = collection
+        self.id = doc_id
+
+    def get(self):
+        return FakeDocumentSnapshot(self.id, self._collection.store.get(self._collection.name, self.id))
+
+    def set(self, data, merge=False):
+        self._collection.store.set(self._collection.name, self.id, _resolve(data), merge)
+
+    def update(self, data):
+        self._collection.store.update(self._collection.name, self.id, _resolve(data))
+
+
+class FakeQuery:
+    def __init__(self, collection, filters=(), limit=None):
+        self._collection = collection
+        self._filters = tuple(filters)
+        self._limit = limit
+
+    def where(self, field_path, op, value):
+        if op != '==':
+            raise NotImplementedError(f'Unsupported operator: {op}')
+        return FakeQuery(self._collection, self._filters + ((field_path, value),), self._limit)
+
+    def limit(self, count):
+        return FakeQuery(self._collection, self._filters, count)
+
+    def get(self):
+        matches = self._collection.store.query(self._collection.name, self._filters, self._limit)
+        return [FakeDocumentSnapshot(doc_id, data) for doc_id, data in matches]
+
+    def stream(self):
+        return iter(self.get())
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        super().__init__(self)
+
+    def document(self, doc_id=None):
+        return FakeDocumentReference(self, doc_id or uuid.uuid4().hex)
+
+    def add(self, data):
+        ref = self.document()
+        ref.set(data)
+        return datetime.now(timezone.utc), ref
+
+
+class FakeWriteBatch:
+    def __init__(self, store):
+        self._store = store
+        self._writes = []
+
+    def set(self, ref, data):
+        self._writes.append(('set', ref._collection.name, ref.id, _resolve(data)))
+
+    def update(self, ref, data):
+        self._writes.append(('update', ref._collection.name, ref.id, _resolve(data)))
+
+    def commit(self):
+        self._store.apply(self._writes)
+        self._writes = []
+
+
+class FakeFirestore:
+    def __init__(self, store=None):
+        self.store = store if store is not None else DocumentStore()
+
+    def collection(self, name):
+        return FakeCollection(self.store, name)
+
+    def batch(self):
+        return FakeWriteBatch(self.store)
@@ -0,0 +1,320 @@
+"""
+Load/benchmark harness for the TransCrypt backend.
+
+Starts local stand-ins for Horizon, CoinGecko and exchangerate-api, serves app.py
+against them with an in-memory Firestore, then drives each endpoint at a fixed
+concurrency and reports p50/p95/p99 latency and requests per second.
+
+    cd Backend
+    python -m bench.run --concurrency 8 --requests 200 --output bench-results/latest.json
+    python -m bench.run --baseline bench-results/latest.json
+    python -m bench.run --workers 4    # gunicorn with gunicorn.conf.py instead of one process
+    python -m bench.run --scale 1,2,4  # throughput per worker count
+"""
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import tempfile
+import subprocess
+import threading
+import multiprocessing
+from datetime import datetime, timezone
+import requests
+from stellar_sdk import Keypair
+
+from bench import stubs
+from bench.fake_firestore import FirestoreManager
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ENDPOINTS = ['create_wallet', 'balance', 'send', 'convert', 'transactions', 'generate-qr']
+# The stubs don't rate limit unless asked to, so the app's own limits are lifted by default
+UNLIMITED_OUTBOUND = 'horizon=off,friendbot=off,coingecko=off,exchangerate_api=off'
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    total = len(latencies)
+    return {
+        'requests': total,
+        'errors': errors,
+        'rps': round(total / elapsed, 2) if elapsed else 0.0,
+        'mean_ms': round(sum(latencies) / total * 1000, 2) if total else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'max_ms': round(latencies[-1] * 1000, 2) if total else 0.0,
+    }
+
+
+def drive(base_url, build_request, total, concurrency, on_response=None):
+    """
+    Sends `total` requests from `concurrency` worker threads. build_request(worker, i)
+    returns (path, json_body). Worker w only ever gets indices with i % concurrency == w,
+    so per-user state (e.g. Stellar sequence numbers) never races between workers.
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def worker(worker_id):
+        session = requests.Session()
+        for i in range(worker_id, total, concurrency):
+            path, body = build_request(worker_id, i)
+            started = time.perf_counter()
+            try:
+                response = session.post(f'{base_url}{path}', json=body, timeout=120)
+                ok = 200 <= response.status_code < 300
+            except requests.RequestException:
+                response, ok = None, False
+            duration = time.perf_counter() - started
+            with lock:
+                latencies.append(duration)
+                if not ok:
+                    errors[0] += 1
+            if ok and on_response is not None:
+                on_response(i, response)
+
+    threads = [threading.Thread(target=worker, args=(w,)) for w in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, errors[0], time.perf_counter() - started)
+
+
+def wait_for_app(base_url, process, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'App exited during startup with code {process.returncode}')
+        try:
+            if requests.get(f'{base_url}/', timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError('App did not become ready in time')
+
+
+def run_benchmark(args):
+    ctx = multiprocessing.get_context('spawn')
+    ready = ctx.Queue()
+    stub_process = ctx.Process(
+        target=stubs.serve,
+        args=('127.0.0.1', (0, 0, 0), args.latency_ms / 1000, ready, args.stub_rate_limit, args.stub_surge_fee),
+        daemon=True
+    )
+    stub_process.start()
+    env = ready.get(timeout=30)
+
+    admin = Keypair.random()
+    requests.get(f"{env['FRIENDBOT_URL']}?addr={admin.public_key}").raise_for_status()
+
+    app_port = free_port()
+    base_url = f'http://127.0.0.1:{app_port}'
+    state_dir = tempfile.mkdtemp()
+    app_env = dict(os.environ, **env, ADMIN_RECEIVER_KEY=admin.public_key,
+                   SETTLEMENT_LOG_PATH=os.path.join(state_dir, 'settlements.jsonl'),
+                   LEDGER_INDEX_PATH=os.path.join(state_dir, 'ledger_index.sqlite3'),
+                   PRICE_HISTORY_DIR=os.path.join(state_dir, 'price_history'),
+                   OUTBOUND_RATE_LIMITS=args.outbound_limits)
+    firestore_manager = None
+    if args.workers:
+        # gunicorn workers are separate processes, so they share one fake Firestore through a manager
+        if args.firestore_emulator:
+            app_env['FIRESTORE_EMULATOR_HOST'] = args.firestore_emulator
+        else:
+            authkey = os.urandom(16)
+            firestore_manager = FirestoreManager(address=os.path.join(state_dir, 'firestore.sock'),
+                                                 authkey=authkey, ctx=ctx)
+            firestore_manager.start()
+            app_env.update(BENCH_FIRESTORE_ADDRESS=firestore_manager.address, BENCH_FIRESTORE_AUTHKEY=authkey.hex())
+        app_env.pop('SHARED_CACHE_SOCKET', None)
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--bind', f'127.0.0.1:{app_port}',
+                   '--workers', str(args.workers), 'bench.serve_app:create_app()']
+    else:
+        command = [sys.executable, '-m', 'bench.serve_app', '--port', str(app_port)]
+        if args.firestore_emulator:
+            command += ['--firestore-emulator', args.firestore_emulator]
+    app_process = subprocess.Popen(command, cwd=BACKEND_DIR, env=app_env,
+                                   stdout=subprocess.DEVNULL, stderr=None if args.verbose else subprocess.DEVNULL)
+
+    results = {}
+    try:
+        wait_for_app(base_url, app_process)
+        concurrency = args.concurrency
+        user_count = max(args.users, concurrency)
+        run_id = datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')
+        users = [None] * user_count
+
+        def create_wallet_request(worker, i):
+            email = f'bench-{run_id}-{i}@transcrypt.local'
+            return '/create_wallet', {'name': f'Bench {i}', 'email': email, 'password': 'bench'}
+
+        def record_user(i, response):
+            users[i] = {
+                'email': f'bench-{run_id}-{i}@transcrypt.local',
+                'password': 'bench',
+                'wallet_addresses': response.json()['wallet_addresses']
+            }
+
+        endpoints = [e for e in ENDPOINTS if e in args.endpoints]
+        # Every other scenario needs accounts, so wallets are always created first
+        results['create_wallet'] = drive(base_url, create_wallet_request, user_count, concurrency, record_user)
+        users = [u for u in users if u is not None]
+        if len(users) < concurrency:
+            raise RuntimeError(f'Only {len(users)} of {user_count} wallets were created; see --verbose output')
+
+        def user_for(worker, i):
+            owned = users[worker::concurrency]
+            return owned[(i // concurrency) % len(owned)]
+
+        def other_user(user, i):
+            candidate = users[i % len(users)]
+            return candidate if candidate is not user else users[(i + 1) % len(users)]
+
+        scenarios = {
+            'balance': lambda w, i: ('/balance', {'wallet_addresses': user_for(w, i)['wallet_addresses']}),
+            'send': lambda w, i: ('/send', {
+                'sender_email': user_for(w, i)['email'],
+                'password': 'bench',
+                'destination_email': other_user(user_for(w, i), i)['email'],
+                'amount': '0.01',
+                'wallet_type': 'btc'
+            }),
+            'convert': lambda w, i: ('/convert', {
+                'sender_email': user_for(w, i)['email'],
+                'password': 'bench',
+                'crypto_symbol': ['BTC', 'ETH', 'SOL'][i % 3],
+                'amount': '0.01',
+                'target_currency': ['INR', 'USD'][i % 2]
+            }),
+            'transactions': lambda w, i: ('/transactions', {'email': user_for(w, i)['email'], 'password': 'bench'}),
+            'generate-qr': lambda w, i: ('/generate-qr', {'address': user_for(w, i)['wallet_addresses']['btc']}),
+        }
+        for endpoint in endpoints:
+            if endpoint in scenarios:
+                results[endpoint] = drive(base_url, scenarios[endpoint], args.requests, concurrency)
+        if 'create_wallet' not in endpoints:
+            del results['create_wallet']
+    finally:
+        app_process.terminate()
+        app_process.wait()
+        stub_process.terminate()
+        if firestore_manager is not None:
+            firestore_manager.shutdown()
+
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'config': {
+            'concurrency': args.concurrency,
+            'requests': args.requests,
+            'users': args.users,
+            'upstream_latency_ms': args.latency_ms,
+            'stub_rate_limit': args.stub_rate_limit,
+            'stub_surge_fee': args.stub_surge_fee,
+            'outbound_limits': args.outbound_limits,
+            'firestore': args.firestore_emulator or 'in-memory',
+            'server': f'gunicorn x{args.workers}' if args.workers else 'werkzeug',
+            'workers': args.workers or 1,
+        },
+        'results': results,
+    }
+
+
+def print_report(report, baseline=None):
+    base_results = baseline['results'] if baseline else {}
+    header = f"{'endpoint':<14}{'reqs':>7}{'errs':>6}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    if baseline:
+        header += f"{'rps Δ':>10}{'p95 Δ':>10}"
+    print(header)
+    for endpoint, stats in report['results'].items():
+        line = (f"{endpoint:<14}{stats['requests']:>7}{stats['errors']:>6}{stats['rps']:>10.1f}"
+                f"{stats['p50_ms']:>10.1f}{stats['p95_ms']:>10.1f}{stats['p99_ms']:>10.1f}")
+        previous = base_results.get(endpoint)
+        if previous:
+            def delta(key):
+                return f"{(stats[key] - previous[key]) / previous[key] * 100:+.1f}%" if previous[key] else 'n/a'
+            line += f"{delta('rps'):>10}{delta('p95_ms'):>10}"
+        print(line)
+
+
+def print_scaling(reports):
+    counts = [report['config']['workers'] for report in reports]
+    header = f"{'endpoint':<14}" + ''.join(f"{f'rps x{n}':>11}" for n in counts) + f"{'speedup':>10}"
+    print(header)
+    for endpoint, stats in reports[0]['results'].items():
+        rps = [report['results'][endpoint]['rps'] for report in reports]
+        speedup = f"{rps[-1] / rps[0]:.2f}x" if rps[0] else 'n/a'
+        print(f"{endpoint:<14}" + ''.join(f"{value:>11.1f}" for value in rps) + f"{speedup:>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the TransCrypt backend against local stubs')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint')
+    parser.add_argument('--users', type=int, default=16, help='wallets created before the other endpoints run')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='artificial latency added by every stub')
+    parser.add_argument('--endpoints', type=lambda s: s.split(','), default=ENDPOINTS,
+                        help=f"comma separated subset of {','.join(ENDPOINTS)}")
+    parser.add_argument('--workers', type=int, default=0,
+                        help='serve with gunicorn and this many worker processes (default: one werkzeug process)')
+    parser.add_argument('--scale', type=lambda s: [int(n) for n in s.split(',')],
+                        help='comma separated worker counts; runs the benchmark once per count and compares throughput')
+    parser.add_argument('--stub-rate-limit', type=int, help='requests/second each stub serves before answering 429')
+    parser.add_argument('--stub-surge-fee', type=int,
+                        help='simulate surge pricing: stroops per operation the stub Horizon requires for inclusion')
+    parser.add_argument('--outbound-limits', default=UNLIMITED_OUTBOUND,
+                        help='OUTBOUND_RATE_LIMITS for the app; defaults to no client-side limits')
+    parser.add_argument('--firestore-emulator', help='host:port of a Firestore emulator instead of the in-memory fake')
+    parser.add_argument('--output', help='write results JSON here')
+    parser.add_argument('--baseline', help='previous results JSON to compare against')
+    parser.add_argument('--verbose', action='store_true', help='show app server stderr')
+    args = parser.parse_args()
+
+    if args.scale:
+        reports = []
+        for workers in args.scale:
+            args.workers = workers
+            print(f"--- {workers} worker(s), {os.cpu_count()} CPU(s) ---")
+            reports.append(run_benchmark(args))
+            print_report(reports[-1])
+        print()
+        print_scaling(reports)
+        if args.output:
+            os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+            with open(args.output, 'w') as f:
+                json.dump({'cpu_count': os.cpu_count(), 'runs': reports}, f, indent=2)
+        return
+
+    report = run_benchmark(args)
+    baseline = None
+    if args.baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    if args.output:
+        os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
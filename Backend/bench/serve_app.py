@@ -0,0 +1,59 @@
+import os
+import sys
+import argparse
+import firebase_admin
+from firebase_admin import credentials, firestore
+from werkzeug.serving import run_simple, WSGIRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.fake_firestore import FakeFirestore, connect_store
+
+# Serves app.py for benchmarking. Upstream URLs come from the environment (see
+# bench/stubs.py); Firestore is either the in-memory fake or, with
+# --firestore-emulator, the real client pointed at a local emulator.
+# Under gunicorn (bench.run --workers) the app comes from create_app(), and the fake
+# Firestore is shared between workers through BENCH_FIRESTORE_ADDRESS.
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def install_fake_firestore(store=None):
+    fake_db = FakeFirestore(store)
+    credentials.Certificate = lambda *args, **kwargs: None
+    firebase_admin.initialize_app = lambda *args, **kwargs: None
+    firestore.client = lambda *args, **kwargs: fake_db
+    return fake_db
+
+
+def create_app():
+    """gunicorn entry point: bench.serve_app:create_app()"""
+    if not os.getenv('FIRESTORE_EMULATOR_HOST'):
+        address = os.getenv('BENCH_FIRESTORE_ADDRESS')
+        store = connect_store(address, bytes.fromhex(os.environ['BENCH_FIRESTORE_AUTHKEY'])) if address else None
+        install_fake_firestore(store)
+    from app import app
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve the TransCrypt API against local stubs')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--firestore-emulator', help='host:port of a running Firestore emulator')
+    args = parser.parse_args()
+
+    if args.firestore_emulator:
+        os.environ['FIRESTORE_EMULATOR_HOST'] = args.firestore_emulator
+    else:
+        install_fake_firestore()
+
+    from app import app
+    run_simple(args.host, args.port, app, threaded=True, request_handler=QuietRequestHandler)
+
+
+if __name__ == '__main__':
+    main()
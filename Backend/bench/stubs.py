@@ -0,0 +1,443 @@
+import sys
+import json
+import time
+import random
+import threading
+from decimal import Decimal
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from stellar_sdk import Network, Payment, FeeBumpTransactionEnvelope, xdr
+from stellar_sdk.helpers import parse_transaction_envelope_from_xdr
+
+# Local stand-ins for Horizon (incl. friendbot), CoinGecko and exchangerate-api.
+# Each runs on its own port so the backend can be pointed at them through
+# HORIZON_URL / FRIENDBOT_URL / COINGECKO_API_URL / EXCHANGE_API_URL.
+
+STROOP = Decimal('0.0000001')
+BASE_FEE = 100
+FEE_STATS_WINDOW = 500
+ASYNC_RESULT_CODES = {
+    'tx_no_source_account': xdr.TransactionResultCode.txNO_ACCOUNT,
+    'tx_bad_seq': xdr.TransactionResultCode.txBAD_SEQ,
+    'tx_insufficient_fee': xdr.TransactionResultCode.txINSUFFICIENT_FEE,
+}
+FRIENDBOT_AMOUNT = Decimal('10000')
+FRIENDBOT_ACCOUNT = 'GAIH3ULLFQ4DGSECF2AR555KZ4KNDGEKN4AFI4SU2M7B43MGK3QJZNSR'
+
+COINGECKO_PRICES_INR = {
+    'bitcoin': 8500000.0,
+    'ethereum': 300000.0,
+    'solana': 12500.0,
+    'cardano': 60.0,
+    'ripple': 190.0,
+    'dogecoin': 15.0,
+}
+USD_RATES = {
+    'USD': 1.0,
+    'INR': 85.0,
+    'EUR': 0.92,
+    'GBP': 0.79,
+}
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, handler_class, latency=0.0, rate_limit=None):
+        super().__init__(address, handler_class)
+        self.latency = latency
+        # Requests allowed per one-second window before answering 429, like the public APIs
+        self.rate_limit = rate_limit
+        self.window = (0, 0)
+        self.window_lock = threading.Lock()
+
+    def admit(self):
+        if not self.rate_limit:
+            return True
+        second = int(time.time())
+        with self.window_lock:
+            start, count = self.window
+            self.window = (second, count + 1) if start == second else (second, 1)
+            return self.window[1] <= self.rate_limit
+
+    def handle_error(self, request, client_address):
+        # App workers stopped between benchmark runs drop their keep-alive connections
+        if isinstance(sys.exc_info()[1], ConnectionResetError):
+            return
+        super().handle_error(request, client_address)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def simulate_latency(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+    def admit(self):
+        """Answers 429 with Retry-After when the stub's rate limit is exceeded."""
+        if self.server.admit():
+            return True
+        body = b'{"status": 429, "title": "Rate Limit Exceeded"}'
+        self.send_response(429)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Retry-After', '1')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return False
+
+    def read_form(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()}
+
+
+class FakeHorizon:
+    def __init__(self, network_passphrase=Network.TESTNET_NETWORK_PASSPHRASE, surge_fee=None):
+        self.network_passphrase = network_passphrase
+        self.accounts = {}
+        self.transactions = {}
+        self.payments = []
+        self.ledger = 1
+        self.lock = threading.Lock()
+        # Minimum fee per operation for inclusion; lower bids wait in self.pending
+        self.surge_fee = surge_fee
+        self.pending = {}       # source account -> queued transaction
+        self.charged_fees = []  # per-operation fees of recent transactions, for /fee_stats
+
+    def account_json(self, account_id):
+        account = self.accounts[account_id]
+        return {
+            'id': account_id,
+            'account_id': account_id,
+            'sequence': str(account['sequence']),
+            'subentry_count': 0,
+            'balances': [{'asset_type': 'native', 'balance': f"{account['balance']:.7f}"}],
+            'data': {}
+        }
+
+    def fund(self, account_id):
+        with self.lock:
+            if account_id in self.accounts:
+                return None
+            self.ledger += 1
+            self.accounts[account_id] = {'balance': FRIENDBOT_AMOUNT, 'sequence': self.ledger << 32}
+            tx_hash = f'{random.getrandbits(256):064x}'
+            self._add_payment({
+                'type': 'create_account',
+                'transaction_hash': tx_hash,
+                'funder': FRIENDBOT_ACCOUNT,
+                'account': account_id,
+                'starting_balance': f'{FRIENDBOT_AMOUNT:.7f}'
+            })
+            return {'hash': tx_hash, 'ledger': self.ledger, 'successful': True}
+
+    def _add_payment(self, record):
+        token = str(len(self.payments) + 1)
+        record.update({
+            'id': token,
+            'paging_token': token,
+            'created_at': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'transaction_successful': True
+        })
+        self.payments.append(record)
+
+    def payments_page(self, query, account=None):
+        cursor = query.get('cursor', [None])[0]
+        limit = int(query.get('limit', ['10'])[0])
+        descending = query.get('order', ['asc'])[0] == 'desc'
+        with self.lock:
+            records = self.payments
+            if account:
+                records = [r for r in records if account in (r.get('from'), r.get('to'), r.get('funder'), r.get('account'))]
+            if cursor == 'now':
+                records = []
+            elif cursor:
+                records = [r for r in records if (int(r['paging_token']) < int(cursor) if descending else int(r['paging_token']) > int(cursor))]
+            if descending:
+                records = records[::-1]
+            return {'_embedded': {'records': records[:limit]}}
+
+    def _parse(self, tx_xdr):
+        """Returns (envelope, inner transaction, fee source, fee bid per operation)."""
+        envelope = parse_transaction_envelope_from_xdr(tx_xdr, self.network_passphrase)
+        if isinstance(envelope, FeeBumpTransactionEnvelope):
+            bump = envelope.transaction
+            inner = bump.inner_transaction_envelope.transaction
+            # A fee bump counts as one more operation when its fee rate is compared
+            return envelope, inner, bump.fee_source.account_id, bump.fee // (len(inner.operations) + 1)
+        tx = envelope.transaction
+        return envelope, tx, tx.source.account_id, tx.fee // len(tx.operations)
+
+    def _inner_hash(self, envelope):
+        if isinstance(envelope, FeeBumpTransactionEnvelope):
+            return envelope.transaction.inner_transaction_envelope.hash_hex()
+        return envelope.hash_hex()
+
+    def _check(self, envelope, tx, fee_source, bid):
+        """Returns a Horizon result code if the transaction can't be accepted right now, else None."""
+        source = tx.source.account_id
+        if source not in self.accounts or fee_source not in self.accounts:
+            return 'tx_no_source_account'
+        if tx.sequence != self.accounts[source]['sequence'] + 1:
+            return 'tx_bad_seq'
+        pending = self.pending.get(source)
+        if pending is not None:
+            if pending['inner_hash'] != self._inner_hash(envelope):
+                # stellar-core queues one transaction per source account
+                return 'try_again_later'
+            if bid < pending['bid'] * 10:
+                # Replacing a queued transaction takes a fee bump with 10x its fee rate
+                return 'tx_insufficient_fee'
+        for op in tx.operations:
+            if not isinstance(op, Payment) or not op.asset.is_native():
+                return 'op_not_supported'
+            op_source = op.source.account_id if op.source else source
+            if op.destination.account_id not in self.accounts or op_source not in self.accounts:
+                return 'op_no_destination'
+        return None
+
+    def _apply(self, envelope, tx, fee_source, bid, tx_xdr):
+        """Applies an accepted transaction and returns its Horizon record, or an error code."""
+        source = tx.source.account_id
+        ops = len(tx.operations) + (1 if isinstance(envelope, FeeBumpTransactionEnvelope) else 0)
+        # Surge pricing charges every included transaction the ledger's clearing fee, not its bid
+        fee_charged = min(bid, max(BASE_FEE, self.surge_fee or 0)) * ops
+        debits = {fee_source: Decimal(fee_charged) * STROOP}
+        for op in tx.operations:
+            op_source = op.source.account_id if op.source else source
+            debits[op_source] = debits.get(op_source, Decimal(0)) + Decimal(op.amount)
+        if any(amount > self.accounts[acc]['balance'] for acc, amount in debits.items()):
+            return 'op_underfunded'
+
+        self.pending.pop(source, None)
+        self.accounts[source]['sequence'] = tx.sequence
+        self.accounts[fee_source]['balance'] -= Decimal(fee_charged) * STROOP
+        tx_hash = envelope.hash_hex()
+        tx_summary = {'hash': tx_hash, 'source_account': source, 'fee_charged': str(fee_charged)}
+        for op in tx.operations:
+            op_source = op.source.account_id if op.source else source
+            self.accounts[op_source]['balance'] -= Decimal(op.amount)
+            self.accounts[op.destination.account_id]['balance'] += Decimal(op.amount)
+            self._add_payment({
+                'type': 'payment',
+                'transaction_hash': tx_hash,
+                'from': op_source,
+                'to': op.destination.account_id,
+                'amount': f'{Decimal(op.amount):.7f}',
+                'asset_type': 'native',
+                'transaction': tx_summary
+            })
+        self.ledger += 1
+        self.charged_fees.append(fee_charged // ops)
+        del self.charged_fees[:-FEE_STATS_WINDOW]
+        result = {'hash': tx_hash, 'ledger': self.ledger, 'successful': True, 'envelope_xdr': tx_xdr,
+                  'fee_account': fee_source, 'fee_charged': str(fee_charged), 'max_fee': str(bid * ops)}
+        inner_hash = self._inner_hash(envelope)
+        if inner_hash != tx_hash:
+            result['inner_transaction'] = {'hash': inner_hash, 'max_fee': str(tx.fee)}
+            result['fee_bump_transaction'] = {'hash': tx_hash}
+            # Horizon serves a fee-bumped transaction under its inner hash as well
+            self.transactions[inner_hash] = result
+        self.transactions[tx_hash] = result
+        return result
+
+    def _accept(self, tx_xdr):
+        """Returns (error code, record); record is None while the transaction waits in the queue."""
+        envelope, tx, fee_source, bid = self._parse(tx_xdr)
+        error = self._check(envelope, tx, fee_source, bid)
+        if error is not None:
+            return error, None
+        if self.surge_fee and bid < self.surge_fee:
+            # Outbid while the network is full: wait in the queue for a fee bump
+            self.pending[tx.source.account_id] = {'hash': envelope.hash_hex(), 'inner_hash': self._inner_hash(envelope), 'bid': bid}
+            return None, None
+        result = self._apply(envelope, tx, fee_source, bid, tx_xdr)
+        return (result, None) if isinstance(result, str) else (None, result)
+
+    def submit(self, tx_xdr):
+        with self.lock:
+            error, result = self._accept(tx_xdr)
+        if error is not None:
+            if error.startswith('op_'):
+                return 400, {'extras': {'result_codes': {'transaction': 'tx_failed', 'operations': [error]}}}
+            return 400, {'extras': {'result_codes': {'transaction': error}}}
+        if result is None:
+            # Horizon gives up waiting on a queued transaction after its own timeout
+            return 504, {'status': 504, 'title': 'Timeout'}
+        return 200, result
+
+    def submit_async(self, tx_xdr):
+        envelope = parse_transaction_envelope_from_xdr(tx_xdr, self.network_passphrase)
+        tx_hash = envelope.hash_hex()
+        with self.lock:
+            queued = any(pending['hash'] == tx_hash for pending in self.pending.values())
+            if tx_hash in self.transactions or queued:
+                return 409, {'tx_status': 'DUPLICATE', 'hash': tx_hash}
+            error, _ = self._accept(tx_xdr)
+        if error == 'try_again_later':
+            return 503, {'tx_status': 'TRY_AGAIN_LATER', 'hash': tx_hash}
+        if error is not None:
+            code = ASYNC_RESULT_CODES.get(error, xdr.TransactionResultCode.txFAILED)
+            result = xdr.TransactionResult(
+                fee_charged=xdr.Int64(0),
+                result=xdr.TransactionResultResult(code=code, results=[] if code == xdr.TransactionResultCode.txFAILED else None),
+                ext=xdr.TransactionResultExt(0)
+            )
+            return 400, {'tx_status': 'ERROR', 'hash': tx_hash, 'error_result_xdr': result.to_xdr()}
+        return 201, {'tx_status': 'PENDING', 'hash': tx_hash}
+
+    def fee_stats(self):
+        with self.lock:
+            charged = sorted(self.charged_fees) or [BASE_FEE]
+        surge = max(BASE_FEE, self.surge_fee or 0)
+
+        def distribution(values):
+            stats = {'min': str(values[0]), 'max': str(values[-1]), 'mode': str(values[len(values) // 2])}
+            for pct in (10, 20, 30, 40, 50, 60, 70, 80, 90, 95, 99):
+                stats[f'p{pct}'] = str(values[min(len(values) - 1, len(values) * pct // 100)])
+            return stats
+        # Bids spread above the clearing fee, steeper at the top like real surges
+        bids = sorted(int(surge * (1 + i / 50) ** 2) for i in range(100))
+        return {
+            'last_ledger': str(self.ledger),
+            'last_ledger_base_fee': str(BASE_FEE),
+            'ledger_capacity_usage': '1.0' if self.surge_fee else '0.2',
+            'fee_charged': distribution(charged),
+            'max_fee': distribution(bids)
+        }
+
+
+def make_horizon_handler(horizon):
+    class HorizonHandler(StubHandler):
+        def do_GET(self):
+            self.simulate_latency()
+            if not self.admit():
+                return
+            url = urlparse(self.path)
+            parts = url.path.strip('/').split('/')
+            if parts[0] == 'friendbot':
+                addr = parse_qs(url.query).get('addr', [None])[0]
+                result = horizon.fund(addr) if addr else None
+                if result is None:
+                    return self.send_json(400, {'detail': 'createAccountAlreadyExist'})
+                return self.send_json(200, result)
+            if parts == ['fee_stats']:
+                return self.send_json(200, horizon.fee_stats())
+            if parts == ['payments']:
+                return self.send_json(200, horizon.payments_page(parse_qs(url.query)))
+            if parts[0] == 'accounts' and len(parts) == 3 and parts[2] == 'payments':
+                return self.send_json(200, horizon.payments_page(parse_qs(url.query), account=parts[1]))
+            if parts[0] == 'transactions' and len(parts) == 2:
+                with horizon.lock:
+                    if parts[1] not in horizon.transactions:
+                        return self.send_json(404, {'status': 404, 'title': 'Resource Missing'})
+                    return self.send_json(200, horizon.transactions[parts[1]])
+            if parts[0] == 'accounts' and len(parts) == 2:
+                with horizon.lock:
+                    if parts[1] not in horizon.accounts:
+                        return self.send_json(404, {'status': 404, 'title': 'Resource Missing'})
+                    return self.send_json(200, horizon.account_json(parts[1]))
+            self.send_json(404, {'status': 404, 'title': 'Resource Missing'})
+
+        def do_POST(self):
+            self.simulate_latency()
+            if not self.admit():
+                return
+            path = urlparse(self.path).path.rstrip('/')
+            if path == '/transactions':
+                status, payload = horizon.submit(self.read_form()['tx'])
+            elif path == '/transactions_async':
+                status, payload = horizon.submit_async(self.read_form()['tx'])
+            else:
+                status, payload = 404, {'status': 404, 'title': 'Resource Missing'}
+            self.send_json(status, payload)
+
+    return HorizonHandler
+
+
+class CoinGeckoHandler(StubHandler):
+    def do_GET(self):
+        self.simulate_latency()
+        if not self.admit():
+            return
+        url = urlparse(self.path)
+        if not url.path.endswith('/simple/price'):
+            return self.send_json(404, {'error': 'Not found'})
+        query = parse_qs(url.query)
+        ids = query.get('ids', [''])[0].split(',')
+        currencies = query.get('vs_currencies', ['inr'])[0].split(',')
+        include_change = query.get('include_24hr_change', ['false'])[0] == 'true'
+        payload = {}
+        for coin_id in ids:
+            if coin_id not in COINGECKO_PRICES_INR:
+                continue
+            entry = {}
+            for currency in currencies:
+                rate = USD_RATES.get(currency.upper(), 1.0) / USD_RATES['INR']
+                entry[currency] = round(COINGECKO_PRICES_INR[coin_id] * rate * random.uniform(0.99, 1.01), 2)
+                if include_change:
+                    entry[f'{currency}_24h_change'] = random.uniform(-5, 5)
+            payload[coin_id] = entry
+        self.send_json(200, payload)
+
+
+class ExchangeRateHandler(StubHandler):
+    def do_GET(self):
+        self.simulate_latency()
+        if not self.admit():
+            return
+        parts = urlparse(self.path).path.strip('/').split('/')
+        if len(parts) < 2 or parts[-2] != 'latest' or parts[-1].upper() not in USD_RATES:
+            return self.send_json(404, {'result': 'error', 'error-type': 'unsupported-code'})
+        base = USD_RATES[parts[-1].upper()]
+        rates = {code: rate / base for code, rate in USD_RATES.items()}
+        self.send_json(200, {'result': 'success', 'base_code': parts[-1].upper(), 'conversion_rates': rates})
+
+
+def start_stubs(host='127.0.0.1', horizon_port=0, coingecko_port=0, exchange_port=0, latency=0.0, rate_limit=None,
+                surge_fee=None):
+    """Starts the three stub servers on background threads and returns (horizon, servers)."""
+    horizon = FakeHorizon(surge_fee=surge_fee)
+    servers = {
+        'horizon': StubServer((host, horizon_port), make_horizon_handler(horizon), latency, rate_limit),
+        'coingecko': StubServer((host, coingecko_port), CoinGeckoHandler, latency, rate_limit),
+        'exchange': StubServer((host, exchange_port), ExchangeRateHandler, latency, rate_limit),
+    }
+    for server in servers.values():
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    return horizon, servers
+
+
+def stub_env(servers):
+    """Environment variables that point the backend at the running stubs."""
+    def base(name):
+        host, port = servers[name].server_address[:2]
+        return f'http://{host}:{port}'
+    return {
+        'HORIZON_URL': base('horizon'),
+        'FRIENDBOT_URL': f"{base('horizon')}/friendbot",
+        'COINGECKO_API_URL': base('coingecko'),
+        'EXCHANGE_API_URL': base('exchange'),
+        'EXCHANGE_API_KEY': 'bench',
+    }
+
+
+def serve(host, ports, latency, ready=None, rate_limit=None, surge_fee=None):
+    """multiprocessing entry point: runs the stubs until the process is terminated."""
+    _, servers = start_stubs(host, *ports, latency=latency, rate_limit=rate_limit, surge_fee=surge_fee)
+    if ready is not None:
+        ready.put(stub_env(servers))
+    threading.Event().wait()
@@ -0,0 +1,243 @@
+import json
+import time
+import threading
+from stellar_sdk import TransactionBuilder, Network, exceptions, xdr
+from metrics import track_upstream, fee_base_fee, fee_bumps_total, transaction_confirm_duration
+from outbound import use_priority, BACKGROUND
+from shared_cache import CacheStore
+
+# Stellar closes a ledger roughly every 5 seconds
+LEDGER_SECONDS = 5
+
+# Network minimum fee per operation, in stroops, used until fee_stats has been fetched
+MIN_BASE_FEE = 100
+
+# Below this share of ledger capacity every transaction gets in at the minimum fee
+SURGE_CAPACITY = 0.9
+
+# During surge pricing, the fee_charged percentile to bid for inclusion within N ledgers
+TARGET_PERCENTILES = ((1, 'p95'), (2, 'p80'), (3, 'p60'))
+FALLBACK_PERCENTILE = 'p50'
+
+# stellar-core only replaces a queued transaction with a fee bump paying 10x its fee rate
+BUMP_MULTIPLIER = 10
+
+# TRY_AGAIN_LATER means the source already has a transaction queued; resend the same
+# envelope after a ledger, doubling the wait up to this
+MAX_RESEND_BACKOFF = 4 * LEDGER_SECONDS
+
+
+class TransactionNotConfirmed(Exception):
+    """
+    Raised when a transaction definitely won't be paid: rejected before it was queued, failed
+    in a ledger, or expired. Any other exception from submit() leaves the outcome unknown.
+    """
+
+
+def result_code(result_xdr):
+    """Name of the result code in a TransactionResult XDR, e.g. txBAD_SEQ."""
+    try:
+        return xdr.TransactionResult.from_xdr(result_xdr).result.code.name
+    except Exception:
+        return 'unknown error'
+
+
+class FeeStrategy:
+    """
+    Picks per-operation fees from Horizon's fee_stats and sees transactions through to a
+    ledger within target_seconds.
+
+    A background thread polls fee_stats and publishes it in `cache` (see shared_cache), so
+    one worker polls for the whole deployment. While ledgers have spare capacity base_fee()
+    is the network minimum; during surge pricing it bids the fee_charged percentile recent
+    ledgers cleared at for the target latency.
+
+    submit() uses Horizon's async endpoint and polls for the result once per ledger instead
+    of holding a synchronous submission open. A transaction still queued after target_seconds is
+    resubmitted as a fee bump, up to max_fee. The inner transaction and its hash stay the
+    same, so it can't be included twice and a logged hash still finds it after a restart.
+    A TRY_AGAIN_LATER answer is not a fee problem, so the same envelope is resent after a
+    backoff instead.
+    """
+
+    def __init__(self, server, cache=None, network_passphrase=Network.TESTNET_NETWORK_PASSPHRASE,
+                 target_seconds=10.0, poll_interval=5.0, max_fee=100_000, tx_timeout=60,
+                 confirm_poll=LEDGER_SECONDS):
+        self.server = server
+        self.cache = cache or CacheStore()
+        self.network_passphrase = network_passphrase
+        self.target_seconds = target_seconds
+        self.target_ledgers = max(1, int(target_seconds // LEDGER_SECONDS))
+        self.poll_interval = poll_interval
+        self.max_fee = max_fee
+        self.tx_timeout = tx_timeout
+        self.confirm_poll = confirm_poll
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def share_stats(self, cache):
+        self.cache = cache
+
+    # ---- fee_stats polling -------------------------------------------------
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='fee-stats', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    @use_priority(BACKGROUND)
+    def _run(self):
+        while not self._stopping.is_set():
+            # Whichever worker takes the lease polls for all of them this interval
+            if self.cache.add('fees:poll', b'1', ttl=self.poll_interval):
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print("Fee stats error:", e)
+            self._stopping.wait(self.poll_interval)
+
+    def refresh(self):
+        with track_upstream('horizon', 'fee_stats'):
+            stats = self.server.fee_stats().call()
+        # Outlives a few missed polls, then base_fee() falls back to the minimum
+        self.cache.set_json('fees:stats', stats, ttl=self.poll_interval * 3)
+        fee_base_fee.set(value=self.base_fee(stats))
+        return stats
+
+    def stats(self):
+        return self.cache.get_json('fees:stats')
+
+    # ---- fee selection -----------------------------------------------------
+
+    def base_fee(self, stats=None):
+        """Per-operation fee, in stroops, for inclusion within target_seconds."""
+        stats = stats or self.stats()
+        if stats is None:
+            return MIN_BASE_FEE
+        floor = int(stats['last_ledger_base_fee'])
+        if float(stats['ledger_capacity_usage']) < SURGE_CAPACITY:
+            return floor
+        percentile = next((p for ledgers, p in TARGET_PERCENTILES if self.target_ledgers <= ledgers),
+                          FALLBACK_PERCENTILE)
+        return min(max(int(stats['fee_charged'][percentile]), floor), self.max_fee)
+
+    def bump_fee(self, current, operations=1, budget=None):
+        """
+        Fee rate for a fee bump replacing a queued transaction of `operations` operations
+        bidding `current`. None past max_fee, or if the bump would cost the fee source more
+        than `budget` stroops; a fee bump is charged for one more operation than it wraps.
+        """
+        fee = max(current * BUMP_MULTIPLIER, self.base_fee())
+        if fee > self.max_fee or (budget is not None and fee * (operations + 1) > budget):
+            return None
+        return fee
+
+    # ---- submission --------------------------------------------------------
+
+    def _send(self, envelope):
+        """Submits asynchronously; False if the network asked us to try again later."""
+        try:
+            with track_upstream('horizon', 'submit_transaction'):
+                self.server.submit_transaction_async(envelope)
+        except (exceptions.BadRequestError, exceptions.BadResponseError) as e:
+            try:
+                body = json.loads(e.message)
+            except ValueError:
+                raise e
+            status = body.get('tx_status')
+            if status == 'DUPLICATE':
+                return True
+            if status == 'TRY_AGAIN_LATER':
+                return False
+            if status == 'ERROR':
+                raise TransactionNotConfirmed(f"Transaction rejected: {result_code(body.get('error_result_xdr'))}")
+            raise
+        return True
+
+    def _lookup(self, tx_hash):
+        try:
+            with track_upstream('horizon', 'transactions'):
+                return self.server.transactions().transaction(tx_hash).call()
+        except exceptions.NotFoundError:
+            return None
+
+    def submit(self, transaction, fee_source, fee_budget=None):
+        """
+        Submits a signed TransactionEnvelope and returns Horizon's transaction record once
+        it is in a ledger. fee_source is the Keypair that pays for fee bumps, and fee_budget
+        the most, in stroops, a bump may cost it (None for no limit besides max_fee).
+        """
+        started = time.time()
+        tx = transaction.transaction
+        tx_hash = transaction.hash_hex()
+        operations = len(tx.operations)
+        fee = tx.fee // operations
+        time_bounds = tx.preconditions.time_bounds if tx.preconditions else None
+        valid_until = time_bounds.max_time if time_bounds else 0
+
+        queued = False
+
+        def send(envelope):
+            nonlocal queued
+            try:
+                accepted = self._send(envelope)
+            except TransactionNotConfirmed as e:
+                if not queued:
+                    raise
+                # Only this envelope was refused, e.g. a fee bump; the one already queued may still land
+                print(f"Resubmission of {tx_hash} rejected, waiting for the queued one:", e)
+                return True
+            queued = queued or accepted
+            return accepted
+
+        envelope = transaction
+        backoff = LEDGER_SECONDS
+        resend_at = None if send(envelope) else started + backoff
+        bump_at = started + self.target_seconds
+        while True:
+            # A transaction can only show up when a ledger closes, so look once per ledger
+            time.sleep(self.confirm_poll)
+            record = self._lookup(tx_hash)
+            if record is not None:
+                outcome = 'success' if record.get('successful') else 'failed'
+                transaction_confirm_duration.observe(time.time() - started, outcome)
+                if outcome == 'failed':
+                    raise TransactionNotConfirmed(f"Transaction {tx_hash} failed: {result_code(record.get('result_xdr'))}")
+                return record
+
+            now = time.time()
+            if valid_until and now > valid_until + LEDGER_SECONDS:
+                transaction_confirm_duration.observe(now - started, 'expired')
+                raise TransactionNotConfirmed(f"Transaction {tx_hash} was not included before it expired")
+            if resend_at is not None:
+                if now >= resend_at:
+                    if send(envelope):
+                        resend_at = None
+                        backoff = LEDGER_SECONDS
+                        bump_at = now + self.target_seconds
+                    else:
+                        backoff = min(backoff * 2, MAX_RESEND_BACKOFF)
+                        resend_at = now + backoff
+                continue
+            if now >= bump_at:
+                bump_at = now + self.target_seconds
+                bumped = self.bump_fee(fee, operations, fee_budget)
+                if bumped is None:
+                    continue
+                envelope = TransactionBuilder.build_fee_bump_transaction(
+                    fee_source, bumped, transaction, self.network_passphrase
+                )
+                envelope.sign(fee_source)
+                print(f"Fee-bumping {tx_hash} from {fee} to {bumped} stroops per operation")
+                fee_bumps_total.inc()
+                fee = bumped
+                if not send(envelope):
+                    resend_at = now + backoff
@@ -0,0 +1,28 @@
+"""
+Advisory locks that give each file on disk a single owner among the workers of a
+multi-process deployment (see gunicorn.conf.py).
+
+fcntl is Unix-only. Without it the app can only run as one process (python app.py), which
+owns every file anyway, so locks are granted immediately.
+"""
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def try_lock(lock_file):
+    """Takes an exclusive lock on an open file without waiting; False if another process holds it."""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+
+def lock(lock_file):
+    """Takes an exclusive lock on an open file, waiting for the holder to release it."""
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
@@ -0,0 +1,101 @@
+# Multi-process deployment of the TransCrypt API.
+#
+#     cd Backend
+#     gunicorn -c gunicorn.conf.py app:app
+#
+# Every worker is a separate process with its own Horizon clients and background threads.
+# Hot state lives in one shared cache daemon (shared_cache.py) that the master starts before
+# forking workers and stops on exit:
+#
+#   - price snapshots, refetched once per PRICE_SNAPSHOT_TTL_SECONDS across all workers
+#   - quotes, so /live-rates on one worker and /convert on another agree on the rate
+#   - the wallet directory (email -> wallet id and addresses)
+#   - rendered QR codes
+#   - Idempotency-Key records for /send and /convert, pinned so cache pressure never evicts them
+#   - outbound rate-limit buckets, so OUTBOUND_RATE_LIMITS applies to the whole deployment
+#   - what each account owes to pending settlements, one share per settlement log, so the
+#     balance checks in /convert and /send see transfers queued by every worker
+#   - Horizon fee_stats, polled by one worker at a time (see fees.py)
+#
+# State on disk has a single owner per file:
+#
+#   - each worker claims its own settlement log (settlements.jsonl, settlements.jsonl.1, ...).
+#     A replacement worker takes over and replays the log of the worker it replaces. Logs
+#     no running worker holds, e.g. after WEB_CONCURRENCY is lowered, are merged into a
+#     running worker's log and settled from there.
+#   - one worker at a time ingests into the ledger index; the others read it and take
+#     over if that worker exits.
+#   - price history writes are serialized with a lock file.
+#
+# Each worker also publishes its metrics to METRICS_DIR, so /metrics on whichever worker
+# serves the scrape reports the deployment total (see metrics.MetricsDirectory).
+#
+# Environment:
+#   WEB_CONCURRENCY       workers (default: one per CPU)
+#   GUNICORN_THREADS      threads per worker (default 4)
+#   BIND                  listen address (default 0.0.0.0:5000)
+#   SHARED_CACHE_SOCKET   use an already running cache daemon instead of starting one
+#   SHARED_CACHE_MAX_MB   memory cap of the started daemon (default 64)
+#   METRICS_DIR           where workers publish metrics (default: a new temporary directory)
+import os
+import sys
+import time
+import shutil
+import socket
+import tempfile
+import subprocess
+import multiprocessing
+
+bind = os.getenv('BIND', '0.0.0.0:5000')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
+worker_class = 'gthread'
+timeout = 60
+graceful_timeout = 30
+
+# Must stay off: the app is imported in each worker so every worker claims its own
+# settlement log and opens its own connections after the fork
+preload_app = False
+
+_cache_daemon = None
+_metrics_dir = None
+
+
+def on_starting(server):
+    global _cache_daemon, _metrics_dir
+    if not os.getenv('METRICS_DIR'):
+        # Fresh per run, since counters restart with the deployment
+        _metrics_dir = tempfile.mkdtemp(prefix='transcrypt-metrics-')
+        os.environ['METRICS_DIR'] = _metrics_dir
+    if os.getenv('SHARED_CACHE_SOCKET'):
+        return
+    socket_path = os.path.join(tempfile.mkdtemp(prefix='transcrypt-'), 'cache.sock')
+    _cache_daemon = subprocess.Popen(
+        [sys.executable, '-m', 'shared_cache', '--socket', socket_path],
+        cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    _wait_for_socket(socket_path)
+    # Inherited by every worker forked after this point
+    os.environ['SHARED_CACHE_SOCKET'] = socket_path
+    server.log.info('Shared cache listening on %s (pid %s)', socket_path, _cache_daemon.pid)
+
+
+def _wait_for_socket(socket_path, timeout=10.0):
+    # Polls with a bare socket so the master never imports the app's modules
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(socket_path)
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f'Shared cache did not start on {socket_path}')
+
+
+def on_exit(server):
+    if _cache_daemon is not None:
+        _cache_daemon.terminate()
+        _cache_daemon.wait(timeout=10)
+    if _metrics_dir is not None:
+        shutil.rmtree(_metrics_dir, ignore_errors=True)
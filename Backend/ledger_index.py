@@ -0,0 +1,315 @@
+import os
+import json
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from decimal import Decimal
+from datetime import datetime
+from stellar_sdk import Server
+from metrics import track_upstream
+from outbound import horizon_client, use_priority, BACKGROUND
+from file_locks import try_lock
+
+STROOPS_PER_XLM = 10_000_000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS accounts (
+    account TEXT PRIMARY KEY,
+    email TEXT,
+    wallet_key TEXT
+);
+CREATE TABLE IF NOT EXISTS payments (
+    account TEXT NOT NULL,
+    op_id TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    kind TEXT NOT NULL,
+    direction TEXT NOT NULL,
+    counterparty TEXT,
+    amount INTEGER NOT NULL,
+    asset TEXT NOT NULL,
+    tx_hash TEXT NOT NULL,
+    PRIMARY KEY (account, op_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS payments_by_time ON payments (account, created_at);
+CREATE TABLE IF NOT EXISTS fees (
+    tx_hash TEXT PRIMARY KEY,
+    account TEXT NOT NULL,
+    fee INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS fees_by_account ON fees (account);
+CREATE TABLE IF NOT EXISTS cursors (
+    stream TEXT PRIMARY KEY,
+    cursor TEXT NOT NULL
+);
+"""
+
+
+def to_stroops(amount):
+    return int(Decimal(amount) * STROOPS_PER_XLM)
+
+
+def parse_horizon_time(value):
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+
+
+def payment_rows(record):
+    """
+    Flattens one Horizon payments-collection record into (account, direction, counterparty,
+    amount, asset) legs. Operations that don't move value between two accounts yield nothing.
+    """
+    kind = record.get('type')
+    if kind == 'create_account':
+        amount = record['starting_balance']
+        return kind, [
+            (record['funder'], 'sent', record['account'], amount, 'XLM'),
+            (record['account'], 'received', record['funder'], amount, 'XLM'),
+        ]
+    if kind in ('payment', 'path_payment_strict_send', 'path_payment_strict_receive'):
+        asset = 'XLM' if record.get('asset_type') == 'native' else f"{record.get('asset_code')}:{record.get('asset_issuer')}"
+        sent_amount = record.get('source_amount', record['amount'])
+        return kind, [
+            (record['from'], 'sent', record['to'], sent_amount, asset),
+            (record['to'], 'received', record['from'], record['amount'], asset),
+        ]
+    return kind, []
+
+
+class LedgerIndex:
+    """
+    Local SQLite index of on-chain payments touching TransCrypt-managed accounts,
+    keyed by (account, created_at). Writes come from the ingestion worker; request
+    threads read through their own short-lived connections.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._managed = set()
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(SCHEMA)
+            self._managed.update(row[0] for row in conn.execute('SELECT account FROM accounts'))
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def is_managed(self, account):
+        with self._lock:
+            return account in self._managed
+
+    def register_accounts(self, email, wallet_addresses):
+        """Adds a user's Stellar addresses; returns the ones that were not known before."""
+        rows = [(address, email, key) for key, address in wallet_addresses.items()
+                if address and address.startswith('G') and len(address) == 56]
+        with self._connect() as conn:
+            conn.executemany('INSERT OR REPLACE INTO accounts (account, email, wallet_key) VALUES (?, ?, ?)', rows)
+        with self._lock:
+            new = [row[0] for row in rows if row[0] not in self._managed]
+            self._managed.update(row[0] for row in rows)
+        return new
+
+    def refresh_accounts(self):
+        """Picks up accounts registered by other processes; returns the ones new to this one."""
+        with self._connect() as conn:
+            accounts = [row[0] for row in conn.execute('SELECT account FROM accounts')]
+        with self._lock:
+            new = [account for account in accounts if account not in self._managed]
+            self._managed.update(new)
+        return new
+
+    def get_cursor(self, stream):
+        with self._connect() as conn:
+            row = conn.execute('SELECT cursor FROM cursors WHERE stream = ?', (stream,)).fetchone()
+        return row[0] if row else None
+
+    def ingest(self, records, stream=None, cursor=None):
+        """
+        Stores the legs of `records` that touch managed accounts. Idempotent, so re-reading
+        a page after a crash is harmless. The stream cursor is saved in the same transaction.
+        """
+        with self._lock:
+            managed = set(self._managed)
+        payments, fees = [], []
+        for record in records:
+            kind, legs = payment_rows(record)
+            created_at = parse_horizon_time(record['created_at'])
+            for account, direction, counterparty, amount, asset in legs:
+                if account in managed:
+                    payments.append((account, record['id'], created_at, kind, direction, counterparty,
+                                     to_stroops(amount), asset, record['transaction_hash']))
+            tx = record.get('transaction')
+            if tx and tx.get('source_account') in managed:
+                fees.append((tx['hash'], tx['source_account'], int(tx['fee_charged'])))
+
+        with self._connect() as conn:
+            conn.executemany('INSERT OR IGNORE INTO payments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', payments)
+            conn.executemany('INSERT OR IGNORE INTO fees VALUES (?, ?, ?)', fees)
+            if stream is not None and cursor is not None:
+                conn.execute('INSERT OR REPLACE INTO cursors (stream, cursor) VALUES (?, ?)', (stream, cursor))
+        return len(payments)
+
+    def history(self, accounts, start=None, end=None, limit=500):
+        """Payments for any of `accounts`, newest first, with counterparty emails resolved."""
+        accounts = list(accounts)
+        if not accounts:
+            return []
+        placeholders = ','.join('?' * len(accounts))
+        query = (f'SELECT p.account, p.op_id, p.created_at, p.kind, p.direction, p.counterparty, p.amount, '
+                 f'p.asset, p.tx_hash, a.email FROM payments p LEFT JOIN accounts a ON a.account = p.counterparty '
+                 f'WHERE p.account IN ({placeholders}) AND p.created_at >= ? AND p.created_at < ? '
+                 f'ORDER BY p.created_at DESC LIMIT ?')
+        params = accounts + [start if start is not None else 0, end if end is not None else 1e18, limit]
+        with self._connect() as conn:
+            rows = conn.execute(query, params).fetchall()
+        keys = ('account', 'op_id', 'created_at', 'kind', 'direction', 'counterparty', 'amount',
+                'asset', 'tx_hash', 'counterparty_email')
+        history = []
+        for row in rows:
+            item = dict(zip(keys, row))
+            item['amount'] = Decimal(item['amount']) / STROOPS_PER_XLM
+            history.append(item)
+        return history
+
+    def indexed_balance(self, account):
+        """Native balance implied by indexed flows: received - sent - fees paid."""
+        with self._connect() as conn:
+            received, sent = conn.execute(
+                "SELECT COALESCE(SUM(CASE WHEN direction = 'received' THEN amount END), 0), "
+                "COALESCE(SUM(CASE WHEN direction = 'sent' THEN amount END), 0) "
+                "FROM payments WHERE account = ? AND asset = 'XLM'", (account,)
+            ).fetchone()
+            fees = conn.execute('SELECT COALESCE(SUM(fee), 0) FROM fees WHERE account = ?', (account,)).fetchone()[0]
+        return Decimal(received - sent - fees) / STROOPS_PER_XLM
+
+
+class LedgerIngestor:
+    """
+    Follows Horizon's payments collection by paging token and feeds the index.
+
+    One cursor covers every managed account: the worker reads the network-wide payments
+    feed and keeps only legs touching managed accounts, so load does not grow with the
+    number of wallets. Newly registered accounts are backfilled once from their own
+    payments endpoint. With fixture_path set, records are tailed from a JSON-lines file
+    of Horizon payment records instead.
+
+    When several workers share the index, only the one holding its lock file ingests; the
+    rest wait on the lock and take over if that worker exits.
+    """
+
+    def __init__(self, index, horizon_url=None, fixture_path=None, load_accounts=None,
+                 poll_interval=2.0, page_size=200):
+        self.index = index
+        self.server = Server(horizon_url=horizon_url, client=horizon_client) if horizon_url else Server(client=horizon_client)
+        self.fixture_path = fixture_path
+        self.load_accounts = load_accounts
+        self.poll_interval = poll_interval
+        self.page_size = page_size
+        self._backfill = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='ledger-ingestor', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def request_backfill(self, accounts):
+        for account in accounts:
+            self._backfill.put(account)
+
+    @use_priority(BACKGROUND)
+    def _run(self):
+        with open(f'{self.index.db_path}.lock', 'a') as lock_file:
+            while not try_lock(lock_file):
+                if self._stopping.wait(self.poll_interval):
+                    return
+            self._ingest()
+
+    def _ingest(self):
+        if self.load_accounts is not None:
+            try:
+                for email, wallet_addresses in self.load_accounts():
+                    self.request_backfill(self.index.register_accounts(email, wallet_addresses))
+            except Exception as e:
+                print("Ledger account sync error:", e)
+
+        while not self._stopping.is_set():
+            try:
+                self.request_backfill(self.index.refresh_accounts())
+                while not self._backfill.empty():
+                    self._backfill_account(self._backfill.get_nowait())
+                caught_up = self._poll_fixture() if self.fixture_path else self._poll_horizon()
+            except Exception as e:
+                print("Ledger ingestion error:", e)
+                caught_up = True
+            if caught_up:
+                self._stopping.wait(self.poll_interval)
+
+    def _fetch_page(self, builder):
+        with track_upstream('horizon', 'payments'):
+            response = builder.limit(self.page_size).order(desc=False).join('transactions').call()
+        return response['_embedded']['records']
+
+    def _poll_horizon(self):
+        stream = 'horizon:payments'
+        cursor = self.index.get_cursor(stream)
+        if cursor is None:
+            # First run: start from the newest payment; older history comes from backfills
+            with track_upstream('horizon', 'payments'):
+                latest = self.server.payments().order(desc=True).limit(1).call()['_embedded']['records']
+            cursor = latest[0]['paging_token'] if latest else '0'
+            self.index.ingest([], stream=stream, cursor=cursor)
+        records = self._fetch_page(self.server.payments().cursor(cursor))
+        if records:
+            self.index.ingest(records, stream=stream, cursor=records[-1]['paging_token'])
+        return len(records) < self.page_size
+
+    def _backfill_account(self, account):
+        if self.fixture_path:
+            return
+        cursor = None
+        while not self._stopping.is_set():
+            builder = self.server.payments().for_account(account)
+            if cursor:
+                builder = builder.cursor(cursor)
+            records = self._fetch_page(builder)
+            if records:
+                self.index.ingest(records)
+                cursor = records[-1]['paging_token']
+            if len(records) < self.page_size:
+                return
+
+    def _poll_fixture(self):
+        stream = f'fixture:{os.path.abspath(self.fixture_path)}'
+        offset = int(self.index.get_cursor(stream) or 0)
+        if not os.path.exists(self.fixture_path):
+            return True
+        records = []
+        with open(self.fixture_path) as fixture:
+            fixture.seek(offset)
+            while len(records) < self.page_size:
+                line = fixture.readline()
+                if not line.endswith('\n'):
+                    # Partially written line; pick it up on the next poll
+                    break
+                offset = fixture.tell()
+                if line.strip():
+                    records.append(json.loads(line))
+        if records:
+            self.index.ingest(records, stream=stream, cursor=str(offset))
+        return len(records) < self.page_size
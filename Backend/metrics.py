@@ -0,0 +1,385 @@
+import os
+import glob
+import json
+import time
+import uuid
+import atexit
+import threading
+from contextlib import contextmanager
+from flask import request, g, Response, has_request_context
+from file_locks import try_lock
+
+# Latency buckets (seconds) shared by route and upstream histograms
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Optional JSON-lines file for per-request trace spans, disabled when unset
+TRACE_LOG_PATH = os.getenv('TRACE_LOG_PATH')
+
+# Directory where every process of a multi-process deployment publishes its metrics, so
+# /metrics on any worker reports the deployment total (gunicorn.conf.py sets it). Unset
+# means a single process, which reports its own.
+METRICS_DIR = os.getenv('METRICS_DIR')
+METRICS_PUBLISH_SECONDS = float(os.getenv('METRICS_PUBLISH_SECONDS', '5'))
+
+_trace_lock = threading.Lock()
+
+
+def _format_labels(label_names, label_values, extra=None):
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(f'{name}="{value}"')
+    return '{' + ','.join(escaped) + '}'
+
+
+class _Metric:
+    # Whether the last values of exited processes still count towards the total
+    keep_exited = True
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(label_values), value] for label_values, value in self._values.items()]
+
+    def merged(self, snapshots=()):
+        """This process's values combined with other processes' snapshot() output."""
+        with self._lock:
+            values = {label_values: self._copy(value) for label_values, value in self._values.items()}
+        for snapshot in snapshots:
+            for label_values, value in snapshot:
+                label_values = tuple(label_values)
+                current = values.get(label_values)
+                values[label_values] = value if current is None else self._combine(current, value)
+        return values
+
+
+class Counter(_Metric):
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def _copy(self, value):
+        return value
+
+    def _combine(self, total, value):
+        return total + value
+
+    def render(self, snapshots=()):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        for label_values, value in sorted(self.merged(snapshots).items()):
+            lines.append(f'{self.name}{_format_labels(self.label_names, label_values)} {value}')
+        return lines
+
+
+class Gauge(Counter):
+    """Summed across processes, or with aggregate=max for values every process sets alike."""
+
+    keep_exited = False
+
+    def __init__(self, name, help_text, label_names=(), aggregate=sum):
+        super().__init__(name, help_text, label_names)
+        self.aggregate = aggregate
+
+    def dec(self, *label_values, amount=1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, *label_values, value):
+        with self._lock:
+            self._values[label_values] = value
+
+    def _combine(self, total, value):
+        return self.aggregate((total, value))
+
+    def render(self, snapshots=()):
+        lines = super().render(snapshots)
+        lines[1] = f'# TYPE {self.name} gauge'
+        return lines
+
+
+class Histogram(_Metric):
+    def __init__(self, name, help_text, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        # label values -> [per-bucket counts..., sum, count]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = [0] * len(self.buckets) + [0.0, 0]
+                self._values[label_values] = series
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def _copy(self, series):
+        return list(series)
+
+    def _combine(self, total, series):
+        return [a + b for a, b in zip(total, series)]
+
+    def render(self, snapshots=()):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        for label_values, series in sorted(self.merged(snapshots).items()):
+            for bound, count in zip(self.buckets, series):
+                labels = _format_labels(self.label_names, label_values, ('le', bound))
+                lines.append(f'{self.name}_bucket{labels} {count}')
+            labels = _format_labels(self.label_names, label_values, ('le', '+Inf'))
+            lines.append(f'{self.name}_bucket{labels} {series[-1]}')
+            labels = _format_labels(self.label_names, label_values)
+            lines.append(f'{self.name}_sum{labels} {series[-2]}')
+            lines.append(f'{self.name}_count{labels} {series[-1]}')
+        return lines
+
+
+http_request_duration = Histogram(
+    'transcrypt_http_request_duration_seconds',
+    'Latency of API requests by route.',
+    ('method', 'route')
+)
+http_requests_total = Counter(
+    'transcrypt_http_requests_total',
+    'API requests by route and status code.',
+    ('method', 'route', 'status')
+)
+http_requests_in_flight = Gauge(
+    'transcrypt_http_requests_in_flight',
+    'API requests currently being served.',
+    ('method', 'route')
+)
+upstream_duration = Histogram(
+    'transcrypt_upstream_duration_seconds',
+    'Latency of calls to external services.',
+    ('upstream', 'operation')
+)
+upstream_errors_total = Counter(
+    'transcrypt_upstream_errors_total',
+    'Failed calls to external services.',
+    ('upstream', 'operation')
+)
+upstream_in_flight = Gauge(
+    'transcrypt_upstream_in_flight',
+    'Calls to external services currently waiting on a response.',
+    ('upstream', 'operation')
+)
+outbound_queue_depth = Gauge(
+    'transcrypt_outbound_queue_depth',
+    'Outbound calls waiting for rate-limit capacity.',
+    ('upstream', 'priority')
+)
+outbound_wait = Histogram(
+    'transcrypt_outbound_wait_seconds',
+    'Time outbound calls spent queued before being sent.',
+    ('upstream', 'priority')
+)
+outbound_throttled_total = Counter(
+    'transcrypt_outbound_throttled_total',
+    'Outbound calls delayed by an upstream Retry-After or rejected as busy.',
+    ('upstream', 'reason')
+)
+fee_base_fee = Gauge(
+    'transcrypt_fee_base_fee_stroops',
+    'Per-operation fee bid for new transactions, from Horizon fee_stats.',
+    aggregate=max
+)
+fee_bumps_total = Counter(
+    'transcrypt_fee_bumps_total',
+    'Stuck transactions resubmitted as fee bumps.'
+)
+transaction_confirm_duration = Histogram(
+    'transcrypt_transaction_confirm_seconds',
+    'Time from submitting a transaction to finding it in a ledger.',
+    ('outcome',)
+)
+
+REGISTRY = [
+    http_request_duration,
+    http_requests_total,
+    http_requests_in_flight,
+    upstream_duration,
+    upstream_errors_total,
+    upstream_in_flight,
+    outbound_queue_depth,
+    outbound_wait,
+    outbound_throttled_total,
+    fee_base_fee,
+    fee_bumps_total,
+    transaction_confirm_duration,
+]
+
+
+def render_metrics(processes=()):
+    """Renders this process's metrics plus (snapshot, running) pairs read from other processes."""
+    lines = []
+    for metric in REGISTRY:
+        snapshots = [snapshot[metric.name] for snapshot, running in processes
+                     if metric.name in snapshot and (running or metric.keep_exited)]
+        lines.extend(metric.render(snapshots))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsDirectory:
+    """
+    Publishes this process's metrics to `directory` as <id>.json every `interval` seconds
+    and reads the other processes' files back. Each process holds a lock on <id>.lock for
+    its lifetime; an exited process's counters and histograms keep counting towards the
+    totals, so they never go backwards, but its gauges are dropped.
+    """
+
+    def __init__(self, directory, interval=METRICS_PUBLISH_SECONDS):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.interval = interval
+        self.process_id = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self.path = os.path.join(directory, f'{self.process_id}.json')
+        self._lock_file = open(os.path.join(directory, f'{self.process_id}.lock'), 'w')
+        try_lock(self._lock_file)
+
+    def start(self):
+        self.publish()
+        atexit.register(self.publish)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.publish()
+            except OSError as e:
+                print("Metrics publish error:", e)
+
+    def publish(self):
+        snapshot = {metric.name: metric.snapshot() for metric in REGISTRY}
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as snapshot_file:
+            json.dump(snapshot, snapshot_file)
+        os.replace(tmp_path, self.path)
+
+    def others(self):
+        """(snapshot, running) for every other process that has published."""
+        processes = []
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            if path == self.path:
+                continue
+            try:
+                with open(path) as snapshot_file:
+                    snapshot = json.load(snapshot_file)
+                with open(f'{path[:-len(".json")]}.lock', 'a') as lock_file:
+                    running = not try_lock(lock_file)
+            except (OSError, ValueError):
+                continue
+            processes.append((snapshot, running))
+        return processes
+
+
+def _record_span(upstream, operation, started, duration, error):
+    if not TRACE_LOG_PATH or not has_request_context() or 'trace_spans' not in g:
+        return
+    span = {
+        'upstream': upstream,
+        'operation': operation,
+        'offset_ms': round((started - g.trace_started) * 1000, 3),
+        'duration_ms': round(duration * 1000, 3)
+    }
+    if error:
+        span['error'] = error
+    g.trace_spans.append(span)
+
+
+@contextmanager
+def track_upstream(upstream, operation):
+    """
+    Times a block that talks to an external service (CoinGecko, Horizon, Firestore, ...).
+    Any exception raised inside the block is counted as an upstream error and re-raised.
+    """
+    upstream_in_flight.inc(upstream, operation)
+    started = time.perf_counter()
+    error = None
+    try:
+        yield
+    except Exception as e:
+        error = type(e).__name__
+        upstream_errors_total.inc(upstream, operation)
+        raise
+    finally:
+        duration = time.perf_counter() - started
+        upstream_in_flight.dec(upstream, operation)
+        upstream_duration.observe(duration, upstream, operation)
+        _record_span(upstream, operation, started, duration, error)
+
+
+def _route_labels():
+    # Use the URL rule rather than the raw path so label cardinality stays bounded
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    return request.method, route
+
+
+def init_metrics(app):
+    """
+    Registers request timing middleware and the /metrics endpoint on the Flask app. With
+    METRICS_DIR set, /metrics reports the total of all processes publishing there.
+    """
+    directory = MetricsDirectory(METRICS_DIR) if METRICS_DIR else None
+    if directory is not None:
+        directory.start()
+
+    @app.before_request
+    def _start_request_timer():
+        g.request_started = time.perf_counter()
+        g.request_labels = _route_labels()
+        http_requests_in_flight.inc(*g.request_labels)
+        if TRACE_LOG_PATH:
+            g.trace_id = request.headers.get('X-Trace-Id') or uuid.uuid4().hex
+            g.trace_started = g.request_started
+            g.trace_spans = []
+
+    @app.after_request
+    def _record_status(response):
+        if 'request_labels' in g:
+            http_requests_total.inc(*g.request_labels, str(response.status_code))
+            if 'trace_id' in g:
+                response.headers['X-Trace-Id'] = g.trace_id
+        return response
+
+    @app.teardown_request
+    def _finish_request(exc):
+        if 'request_labels' not in g:
+            return
+        duration = time.perf_counter() - g.request_started
+        http_requests_in_flight.dec(*g.request_labels)
+        # Statuses are counted in _record_status, which Flask also runs on the 500 it
+        # generates for an unhandled exception
+        http_request_duration.observe(duration, *g.request_labels)
+        if 'trace_id' in g:
+            method, route = g.request_labels
+            entry = {
+                'trace_id': g.trace_id,
+                'method': method,
+                'route': route,
+                'duration_ms': round(duration * 1000, 3),
+                'spans': g.trace_spans
+            }
+            with _trace_lock, open(TRACE_LOG_PATH, 'a') as trace_log:
+                trace_log.write(json.dumps(entry) + '\n')
+
+    @app.route('/metrics')
+    def metrics():
+        processes = directory.others() if directory is not None else ()
+        return Response(render_metrics(processes), mimetype='text/plain; version=0.0.4')
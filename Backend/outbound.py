@@ -0,0 +1,312 @@
+import os
+import time
+import heapq
+import itertools
+import threading
+import contextvars
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+import requests
+from stellar_sdk.client.requests_client import RequestsClient
+from metrics import track_upstream, upstream_errors_total, outbound_queue_depth, outbound_wait, outbound_throttled_total
+
+# Priority classes, most urgent first. When an upstream is saturated, queued payment calls
+# are released before balance refreshes, and those before price polls.
+PAYMENT, BALANCE, PRICE, BACKGROUND = range(4)
+PRIORITY_NAMES = ('payment', 'balance', 'price', 'background')
+
+# Sustained requests/second and burst per upstream, roughly the published public limits
+# (Horizon testnet allows 3600 requests/hour per IP, CoinGecko's free tier ~30/minute).
+# Override with e.g. OUTBOUND_RATE_LIMITS="horizon=5/20,coingecko=off"
+DEFAULT_RATE_LIMITS = 'horizon=1/60,friendbot=0.5/5,coingecko=0.5/5,exchangerate_api=1/5'
+
+# Share of each burst that background calls (e.g. the ledger ingestor) may not take, so
+# user-facing calls arriving after a busy background stretch still go out without waiting
+BACKGROUND_HEADROOM = 0.5
+
+# Priority used when the caller didn't set one with use_priority()
+DEFAULT_PRIORITIES = {'coingecko': PRICE, 'exchangerate_api': PRICE, 'friendbot': PAYMENT}
+
+# Statuses an upstream uses to ask us to slow down
+THROTTLE_STATUSES = (429, 503)
+
+_current_priority = contextvars.ContextVar('outbound_priority', default=None)
+
+
+class UpstreamBusy(Exception):
+    """Raised when an outbound call can't be made within the caller's wait budget."""
+
+    def __init__(self, upstream, retry_after):
+        super().__init__(f"{upstream} is rate limiting requests, retry in {retry_after:.0f}s")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+def parse_rate_limits(spec):
+    """Parses "upstream=rate/burst,..." into {upstream: (rate, burst)}; "off" means unlimited."""
+    limits = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        upstream, _, value = item.strip().partition('=')
+        if value == 'off':
+            limits[upstream] = None
+            continue
+        rate, _, burst = value.partition('/')
+        try:
+            limits[upstream] = (float(rate), float(burst or 1))
+        except ValueError:
+            raise ValueError(f"Invalid OUTBOUND_RATE_LIMITS entry: {item!r}")
+    return limits
+
+
+def load_rate_limits():
+    limits = parse_rate_limits(DEFAULT_RATE_LIMITS)
+    limits.update(parse_rate_limits(os.getenv('OUTBOUND_RATE_LIMITS', '')))
+    return limits
+
+
+def retry_after_seconds(headers):
+    """Reads a Retry-After header (delta-seconds or HTTP date); None if absent or unreadable."""
+    value = next((v for k, v in headers.items() if k.lower() == 'retry-after'), None)
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+@contextmanager
+def use_priority(priority):
+    """Sets the priority class for outbound calls made inside the block (or decorated function)."""
+    token = _current_priority.set(priority)
+    try:
+        yield
+    finally:
+        _current_priority.reset(token)
+
+
+class TokenBucket:
+    """Not thread-safe; OutboundScheduler only touches it under the upstream's lock."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now, keep=0.0):
+        """Seconds until a call may go out leaving `keep` tokens behind; 0 means now."""
+        if now < self.paused_until:
+            return self.paused_until - now
+        if self.rate is None:
+            return 0.0
+        self._refill(now)
+        needed = 1 + keep
+        return 0.0 if self.tokens >= needed else (needed - self.tokens) / self.rate
+
+    def try_take(self, now, keep=0.0):
+        """Takes a token if one is available beyond `keep` and returns 0, else the seconds to wait."""
+        delay = self.delay(now, keep)
+        if delay == 0 and self.rate is not None:
+            self.tokens -= 1
+        return delay
+
+    def pause(self, until):
+        if until > self.paused_until:
+            self.paused_until = until
+            if self.rate is not None:
+                # After the pause, allow one probe and then refill at the normal rate
+                self.tokens = min(self.tokens, 1.0)
+                self.updated = max(self.updated, until)
+
+
+class _SharedBucket:
+    """A TokenBucket kept in the shared cache daemon, so the limit holds across all workers."""
+
+    def __init__(self, cache, upstream, limit):
+        self.cache = cache
+        self.key = f'outbound:{upstream}'
+        self.rate, self.burst = limit or (None, None)
+
+    def try_take(self, now, keep=0.0):
+        return self.cache.take_token(self.key, self.rate, self.burst, keep)
+
+    def pause(self, until):
+        self.cache.pause_bucket(self.key, until - time.monotonic(), self.rate, self.burst)
+
+
+class _Lane:
+    def __init__(self, limit, shared=None, upstream=None):
+        if not limit:
+            self.bucket = TokenBucket(None, None)
+        elif shared is not None:
+            self.bucket = _SharedBucket(shared, upstream, limit)
+        else:
+            self.bucket = TokenBucket(*limit)
+        # Tokens background calls leave for the other classes; at least one must be usable
+        self.background_keep = min(limit[1] * BACKGROUND_HEADROOM, limit[1] - 1) if limit else 0.0
+        self.waiting = []   # heap of (priority, seq)
+        self.cond = threading.Condition()
+
+
+class OutboundScheduler:
+    """
+    Central gate for calls to rate-limited public APIs.
+
+    Each upstream has a token bucket and a priority queue of waiting callers; only the
+    head of the queue may take a token, so a payment that arrives behind a queue of price
+    polls goes out first. Background calls may not take the last BACKGROUND_HEADROOM of the
+    burst, so they can't use up the tokens of callers in other workers. A 429 (or 503 with Retry-After) pauses the whole upstream for
+    the advertised time and the call is retried. Callers that can't be served within
+    max_wait get UpstreamBusy instead of an error from the upstream.
+
+    After share_buckets(cache), tokens and pauses come from the shared cache daemon, so
+    the limits apply to all workers together; queue order is still per worker.
+    """
+
+    def __init__(self, limits, max_wait=10.0, max_retries=3, default_backoff=1.0):
+        self.limits = limits
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.default_backoff = default_backoff
+        self._shared = None
+        self._lanes = {}
+        self._lanes_lock = threading.Lock()
+        self._seq = itertools.count()
+
+    def share_buckets(self, cache):
+        with self._lanes_lock:
+            self._shared = cache
+            self._lanes = {}
+
+    def _lane(self, upstream):
+        lane = self._lanes.get(upstream)
+        if lane is None:
+            with self._lanes_lock:
+                lane = self._lanes.get(upstream)
+                if lane is None:
+                    lane = _Lane(self.limits.get(upstream), self._shared, upstream)
+                    self._lanes[upstream] = lane
+        return lane
+
+    def queue_depth(self, upstream):
+        lane = self._lane(upstream)
+        with lane.cond:
+            return len(lane.waiting)
+
+    def acquire(self, upstream, priority, deadline):
+        lane = self._lane(upstream)
+        label = PRIORITY_NAMES[priority]
+        entry = (priority, next(self._seq))
+        keep = lane.background_keep if priority == BACKGROUND else 0.0
+        started = time.monotonic()
+        with lane.cond:
+            heapq.heappush(lane.waiting, entry)
+            outbound_queue_depth.inc(upstream, label)
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = lane.bucket.try_take(now, keep) if lane.waiting[0] == entry else None
+                    if delay == 0:
+                        heapq.heappop(lane.waiting)
+                        lane.cond.notify_all()
+                        break
+                    if now + (delay or 0) > deadline or now >= deadline:
+                        raise UpstreamBusy(upstream, max(delay or 0, 1.0))
+                    lane.cond.wait(delay if delay is not None else deadline - now)
+            except BaseException:
+                if entry in lane.waiting:
+                    lane.waiting.remove(entry)
+                    heapq.heapify(lane.waiting)
+                    lane.cond.notify_all()
+                outbound_throttled_total.inc(upstream, 'busy')
+                raise
+            finally:
+                outbound_queue_depth.dec(upstream, label)
+        outbound_wait.observe(time.monotonic() - started, upstream, label)
+
+    def pause(self, upstream, seconds):
+        lane = self._lane(upstream)
+        with lane.cond:
+            lane.bucket.pause(time.monotonic() + seconds)
+            lane.cond.notify_all()
+
+    def call(self, upstream, send, priority=None, default=BALANCE):
+        """
+        Runs send() once the upstream has capacity and returns its response. Priority is
+        the explicit argument, else the one set by use_priority(), else `default`.
+        """
+        if priority is None:
+            priority = _current_priority.get()
+        if priority is None:
+            priority = DEFAULT_PRIORITIES.get(upstream, default)
+        deadline = time.monotonic() + self.max_wait
+        for attempt in range(self.max_retries + 1):
+            self.acquire(upstream, priority, deadline)
+            response = send()
+            if response.status_code not in THROTTLE_STATUSES:
+                return response
+            delay = retry_after_seconds(response.headers)
+            if delay is None:
+                if response.status_code != 429:
+                    return response
+                delay = self.default_backoff * 2 ** attempt
+            outbound_throttled_total.inc(upstream, 'retry_after')
+            self.pause(upstream, delay)
+            if time.monotonic() + delay > deadline:
+                raise UpstreamBusy(upstream, delay)
+        raise UpstreamBusy(upstream, delay)
+
+
+scheduler = OutboundScheduler(
+    load_rate_limits(),
+    max_wait=float(os.getenv('OUTBOUND_MAX_WAIT_SECONDS', '10'))
+)
+
+
+def timed_get(upstream, operation, url, priority=None, **kwargs):
+    """
+    requests.get through the outbound scheduler, with each attempt timed by track_upstream.
+    Non-2xx responses also count as errors.
+    """
+    def send():
+        with track_upstream(upstream, operation):
+            response = requests.get(url, **kwargs)
+        if response.status_code >= 400:
+            upstream_errors_total.inc(upstream, operation)
+        return response
+    return scheduler.call(upstream, send, priority)
+
+
+class HorizonClient(RequestsClient):
+    """
+    stellar_sdk HTTP client that sends every Horizon request through the scheduler.
+    Submissions default to the payment class and reads to the balance class. The SDK's
+    own urllib3 retries are disabled so 429s reach the scheduler instead of sleeping
+    inside a worker thread.
+    """
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('num_retries', 0)
+        super().__init__(**kwargs)
+
+    def get(self, url, params=None):
+        return scheduler.call('horizon', lambda: super(HorizonClient, self).get(url, params), default=BALANCE)
+
+    def post(self, url, data=None, json_data=None):
+        return scheduler.call('horizon', lambda: super(HorizonClient, self).post(url, data, json_data), default=PAYMENT)
+
+
+horizon_client = HorizonClient()
@@ -0,0 +1,127 @@
+import os
+import time
+import threading
+import numpy as np
+from file_locks import lock
+
+# One fixed-size record per sample. Raw samples have open == high == low == close;
+# downsampled rows carry the OHLC of the bucket they replaced, so both tiers
+# aggregate the same way.
+RECORD_DTYPE = np.dtype([('ts', '<f8'), ('open', '<f8'), ('high', '<f8'), ('low', '<f8'), ('close', '<f8')])
+
+
+class PriceHistory:
+    """
+    Append-only, memory-mapped INR price history per asset.
+
+    Each asset has two files under `directory`: SYMBOL.raw (every recorded snapshot) and
+    SYMBOL.ds (older samples downsampled into downsample_interval OHLC buckets). Samples
+    older than raw_retention are folded into the downsampled tier, and downsampled rows
+    older than retention are dropped. Timestamps only ever increase within a file, so
+    range lookups are a binary search on the mapped array. Writers in different processes
+    serialize on a lock file in the directory, so workers can share one history.
+    """
+
+    def __init__(self, directory, raw_retention=7 * 86400, downsample_interval=300,
+                 retention=365 * 86400, compaction_interval=600):
+        self.directory = directory
+        self.raw_retention = raw_retention
+        self.downsample_interval = downsample_interval
+        self.retention = retention
+        self.compaction_interval = compaction_interval
+        self._last_compaction = 0.0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, symbol, tier):
+        return os.path.join(self.directory, f'{symbol}.{tier}')
+
+    def _load(self, symbol, tier):
+        path = self._path(symbol, tier)
+        if not os.path.exists(path) or os.path.getsize(path) < RECORD_DTYPE.itemsize:
+            return np.empty(0, dtype=RECORD_DTYPE)
+        count = os.path.getsize(path) // RECORD_DTYPE.itemsize
+        return np.memmap(path, dtype=RECORD_DTYPE, mode='r', shape=(count,))
+
+    def _rewrite(self, symbol, tier, records):
+        path = self._path(symbol, tier)
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(np.ascontiguousarray(records, dtype=RECORD_DTYPE).tobytes())
+        os.replace(tmp_path, path)
+
+    def record(self, prices_inr, ts=None):
+        """
+        Appends one sample per asset from a {SYMBOL: price_inr} mapping. A sample older than
+        the asset's last row, e.g. from a worker whose clock is behind, is dropped.
+        """
+        with self._lock, open(os.path.join(self.directory, '.lock'), 'a') as lock_file:
+            lock(lock_file)
+            # Read under the lock, so workers append in the order they stamp
+            ts = time.time() if ts is None else ts
+            for symbol, price in prices_inr.items():
+                if price is None or not np.isfinite(price):
+                    continue
+                raw = self._load(symbol, 'raw')
+                if len(raw) and raw['ts'][-1] > ts:
+                    continue
+                row = np.array([(ts, price, price, price, price)], dtype=RECORD_DTYPE)
+                with open(self._path(symbol, 'raw'), 'ab') as f:
+                    f.write(row.tobytes())
+            if ts - self._last_compaction >= self.compaction_interval:
+                self._compact(ts)
+                self._last_compaction = ts
+
+    def symbols(self):
+        return sorted({name.rsplit('.', 1)[0] for name in os.listdir(self.directory)
+                       if name.endswith('.raw') or name.endswith('.ds')})
+
+    def _compact(self, now):
+        # Only whole buckets move to the downsampled tier, so a bucket is never split across tiers
+        cutoff = (now - self.raw_retention) // self.downsample_interval * self.downsample_interval
+        oldest_kept = now - self.retention
+        for symbol in self.symbols():
+            raw = self._load(symbol, 'raw')
+            split = int(np.searchsorted(raw['ts'], cutoff, side='left'))
+            if split:
+                buckets = aggregate(raw[:split], self.downsample_interval)
+                with open(self._path(symbol, 'ds'), 'ab') as f:
+                    f.write(buckets.tobytes())
+                self._rewrite(symbol, 'raw', raw[split:])
+
+            downsampled = self._load(symbol, 'ds')
+            expired = int(np.searchsorted(downsampled['ts'], oldest_kept, side='left'))
+            if expired:
+                self._rewrite(symbol, 'ds', downsampled[expired:])
+
+    def range(self, symbol, start, end):
+        """All stored rows for symbol with start <= ts < end, downsampled tier first."""
+        parts = []
+        for tier in ('ds', 'raw'):
+            records = self._load(symbol, tier)
+            lo, hi = np.searchsorted(records['ts'], [start, end], side='left')
+            if hi > lo:
+                parts.append(np.array(records[lo:hi]))
+        if not parts:
+            return np.empty(0, dtype=RECORD_DTYPE)
+        return np.concatenate(parts)
+
+    def ohlc(self, symbol, start, end, interval):
+        return aggregate(self.range(symbol, start, end), interval)
+
+
+def aggregate(records, interval):
+    """Folds rows into OHLC buckets of `interval` seconds aligned to the epoch."""
+    if len(records) == 0:
+        return np.empty(0, dtype=RECORD_DTYPE)
+    bucket_ids = np.floor(records['ts'] / interval)
+    starts = np.flatnonzero(np.r_[True, bucket_ids[1:] != bucket_ids[:-1]])
+    ends = np.r_[starts[1:], len(records)] - 1
+
+    buckets = np.empty(len(starts), dtype=RECORD_DTYPE)
+    buckets['ts'] = bucket_ids[starts] * interval
+    buckets['open'] = records['open'][starts]
+    buckets['high'] = np.maximum.reduceat(records['high'], starts)
+    buckets['low'] = np.minimum.reduceat(records['low'], starts)
+    buckets['close'] = records['close'][ends]
+    return buckets
@@ -0,0 +1,157 @@
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from assets import ConversionMatrix, BASE_FIAT
+
+# Snapshots a worker keeps built in memory, keyed by id, for quotes issued elsewhere
+MAX_LOCAL_SNAPSHOTS = 8
+
+
+class Quote:
+    __slots__ = ('id', 'snapshot', 'crypto_symbol', 'target_currency', 'rate', 'expires_at')
+
+    def __init__(self, snapshot, crypto_symbol, target_currency, expires_at, quote_id=None):
+        self.id = quote_id or uuid.uuid4().hex
+        self.snapshot = snapshot
+        self.crypto_symbol = crypto_symbol
+        self.target_currency = target_currency
+        self.rate = snapshot.price(crypto_symbol, target_currency)
+        self.expires_at = expires_at
+
+    @property
+    def price_inr(self):
+        return self.snapshot.price(self.crypto_symbol, BASE_FIAT)
+
+
+class QuoteStore:
+    """
+    Hands out short-lived quotes locked to a shared price snapshot (a ConversionMatrix).
+
+    fetch_snapshot() returns the (crypto_data, fiat_rates) pair the matrix is built from.
+    Snapshots and quotes are kept in `cache` (see shared_cache). With a cache daemon shared
+    by several workers, the snapshot is refetched at most once per snapshot_ttl across all
+    of them, and a quote issued by one worker can be redeemed on another. Quotes are
+    single-use: take() pops them from the cache, and the cache's TTL expires the rest.
+    """
+
+    def __init__(self, fetch_snapshot, cache, quote_ttl=30, snapshot_ttl=10, refresh_timeout=10):
+        self.fetch_snapshot = fetch_snapshot
+        self.cache = cache
+        self.quote_ttl = quote_ttl
+        self.snapshot_ttl = snapshot_ttl
+        self.refresh_timeout = refresh_timeout
+        self._snapshot = None
+        self._snapshot_lock = threading.Lock()
+        self._matrices = OrderedDict()
+        self._matrices_lock = threading.Lock()
+
+    def _fresh(self, snapshot):
+        return snapshot is not None and time.time() - snapshot.taken_at < self.snapshot_ttl
+
+    def current_snapshot(self):
+        snapshot = self._snapshot
+        if self._fresh(snapshot):
+            return snapshot
+        # Only one thread per worker goes to the cache; the rest wait and reuse its result
+        with self._snapshot_lock:
+            snapshot = self._snapshot
+            if not self._fresh(snapshot):
+                snapshot = self._latest_shared() or self._refresh()
+                self._snapshot = snapshot
+            return snapshot
+
+    def _latest_shared(self):
+        record = self.cache.get_json('prices:latest')
+        if record is None or time.time() - record['taken_at'] >= self.snapshot_ttl:
+            return None
+        return self._matrix(record)
+
+    def _refresh(self):
+        # Only one worker refetches; the others poll for the snapshot it publishes
+        deadline = time.time() + self.refresh_timeout
+        while not self.cache.add('prices:refresh', b'1', ttl=self.refresh_timeout):
+            time.sleep(0.05)
+            snapshot = self._latest_shared()
+            if snapshot is not None:
+                return snapshot
+            if time.time() >= deadline:
+                # The holder is stuck or gone; fetch without the lease
+                break
+        try:
+            crypto_data, fiat_rates = self.fetch_snapshot()
+            snapshot = ConversionMatrix(crypto_data, fiat_rates)
+            record = {
+                'id': snapshot.id,
+                'taken_at': snapshot.taken_at,
+                'crypto_data': crypto_data,
+                'fiat_rates': fiat_rates
+            }
+            # Kept as long as any quote locked to it can still be redeemed
+            ttl = self.quote_ttl + self.snapshot_ttl
+            self.cache.set_json(f'prices:snapshot:{snapshot.id}', record, ttl)
+            self.cache.set_json('prices:latest', record, ttl)
+        finally:
+            self.cache.delete('prices:refresh')
+        self._remember(snapshot)
+        return snapshot
+
+    def _matrix(self, record):
+        snapshot = self._matrices.get(record['id'])
+        if snapshot is None:
+            snapshot = ConversionMatrix(record['crypto_data'], record['fiat_rates'],
+                                        snapshot_id=record['id'], taken_at=record['taken_at'])
+            self._remember(snapshot)
+        return snapshot
+
+    def _remember(self, snapshot):
+        with self._matrices_lock:
+            self._matrices[snapshot.id] = snapshot
+            while len(self._matrices) > MAX_LOCAL_SNAPSHOTS:
+                self._matrices.popitem(last=False)
+
+    def _snapshot_by_id(self, snapshot_id):
+        snapshot = self._matrices.get(snapshot_id)
+        if snapshot is not None:
+            return snapshot
+        record = self.cache.get_json(f'prices:snapshot:{snapshot_id}')
+        return self._matrix(record) if record is not None else None
+
+    def create(self, crypto_symbol, target_currency):
+        snapshot = self.current_snapshot()
+        quote = Quote(snapshot, crypto_symbol, target_currency, time.time() + self.quote_ttl)
+        self.cache.set_json(f'quote:{quote.id}', {
+            'snapshot': snapshot.id,
+            'crypto_symbol': crypto_symbol,
+            'target_currency': target_currency,
+            'expires_at': quote.expires_at
+        }, self.quote_ttl)
+        return quote
+
+    def _load(self, quote_id, record):
+        if record is None or record['expires_at'] <= time.time():
+            return None
+        snapshot = self._snapshot_by_id(record['snapshot'])
+        if snapshot is None:
+            return None
+        return Quote(snapshot, record['crypto_symbol'], record['target_currency'], record['expires_at'],
+                     quote_id=quote_id)
+
+    def peek(self, quote_id):
+        """Returns a quote without using it up, or None if it is unknown, used or expired."""
+        return self._load(quote_id, self.cache.get_json(f'quote:{quote_id}'))
+
+    def take(self, quote_id):
+        """Removes and returns a quote, or None if it is unknown, used or expired."""
+        return self._load(quote_id, self.cache.pop_json(f'quote:{quote_id}'))
+
+    def restore(self, quote):
+        """Puts back a quote taken for a conversion that was then refused."""
+        ttl = quote.expires_at - time.time()
+        if ttl > 0:
+            self.cache.set_json(f'quote:{quote.id}', {
+                'snapshot': quote.snapshot.id,
+                'crypto_symbol': quote.crypto_symbol,
+                'target_currency': quote.target_currency,
+                'expires_at': quote.expires_at
+            }, ttl)
@@ -0,0 +1,555 @@
+import os
+import json
+import time
+import uuid
+import threading
+from decimal import Decimal
+from stellar_sdk import Server, Keypair, TransactionBuilder, Network, Asset, Account, exceptions
+from metrics import track_upstream
+from outbound import horizon_client, use_priority, PAYMENT
+from fees import FeeStrategy, TransactionNotConfirmed, MIN_BASE_FEE, LEDGER_SECONDS
+from file_locks import try_lock
+from shared_cache import CacheStore
+
+# Stellar caps a transaction envelope at 20 signatures, so one settlement
+# transaction can net transfers from at most this many distinct accounts.
+MAX_SIGNERS_PER_TX = 20
+STROOP = Decimal('0.0000001')
+
+# Two base reserves, what an account with no subentries must always hold
+ACCOUNT_RESERVE = Decimal('1')
+
+# Failed settlement attempts before a transfer is given up on and handed to on_dead
+MAX_ATTEMPTS = 5
+
+
+def min_account_balance(max_fee):
+    """
+    XLM a wallet has to keep back: the reserve plus the largest fee bump of a transaction
+    paying only for its own single operation, max_fee for it and again for the bump itself.
+    A wallet never pays fees for other wallets' transfers (see SettlementEngine).
+    """
+    return ACCOUNT_RESERVE + 2 * max_fee * STROOP
+
+
+def claim_log_slot(base_path):
+    """
+    Picks this process's settlement log when several workers share a directory: the first of
+    base_path, base_path.1, base_path.2, ... whose lock no live process holds. A worker that
+    replaces a dead one therefore takes over, and replays, the log it left behind.
+    Returns (log_path, lock_file); the lock is held for as long as lock_file stays open.
+    """
+    slot = 0
+    while True:
+        path = base_path if slot == 0 else f'{base_path}.{slot}'
+        lock_file = open(f'{path}.lock', 'a')
+        if try_lock(lock_file):
+            return path, lock_file
+        lock_file.close()
+        slot += 1
+
+
+def orphaned_log_slots(base_path, own_path):
+    """
+    Yields (log_path, lock_file) for each non-empty settlement log of base_path whose lock
+    no live process holds, other than own_path; e.g. the higher slots left behind when the
+    worker count goes down. The caller holds each lock until it closes lock_file.
+    """
+    directory = os.path.dirname(os.path.abspath(base_path))
+    name = os.path.basename(base_path)
+    for entry in sorted(os.listdir(directory)):
+        if entry != name and not (entry.startswith(f'{name}.') and entry[len(name) + 1:].isdigit()):
+            continue
+        path = os.path.join(directory, entry)
+        if os.path.abspath(path) == os.path.abspath(own_path):
+            continue
+        lock_file = open(f'{path}.lock', 'a')
+        # Checked under the lock: another worker may have adopted or claimed it meanwhile
+        if try_lock(lock_file) and os.path.exists(path) and os.path.getsize(path) > 0:
+            yield path, lock_file
+        lock_file.close()
+
+
+class SettlementEngine:
+    """
+    Nets pending crypto transfers to the admin account and settles them on a time/size
+    window as multi-op Stellar transactions.
+
+    Every state change is appended to a JSON-lines log before it takes effect, so pending
+    transfers survive a restart and are retried. Secrets are never written to the log;
+    resolve_secret(wallet_id, crypto_symbol) looks them up again at flush time. Each
+    process writes its own log, claimed with claim_log_slot() when the engine starts, and
+    adopts logs no live process holds any more (see orphaned_log_slots()).
+
+    Without fee_secret every account settles in a transaction of its own and pays only its
+    own fees. With it, that operator-funded account is the source of multi-account batches
+    and pays their fees and fee bumps.
+
+    What each account owes is published to `cache` as this log's share of a per-account
+    total, so with the shared cache daemon enqueue() checks a balance against transfers
+    pending in every worker's log, not just its own.
+
+    A transfer that fails max_attempts times on its own account is moved to the dead state
+    and no longer retried. on_dead(record) is called for it until it returns without
+    raising, also after a restart, so the caller can undo whatever the transfer paid for.
+    """
+
+    def __init__(self, log_path, destination, resolve_secret, on_settled=None, horizon_url=None,
+                 network_passphrase=Network.TESTNET_NETWORK_PASSPHRASE, window_seconds=5.0,
+                 max_batch=100, fee_strategy=None, tx_timeout=None, max_attempts=MAX_ATTEMPTS,
+                 on_dead=None, cache=None, fee_secret=None):
+        self.log_path = log_path
+        self.base_path = log_path
+        self.cache = cache or CacheStore()
+        self.fee_keypair = Keypair.from_secret(fee_secret) if fee_secret else None
+        self.destination = destination
+        self.resolve_secret = resolve_secret
+        self.on_settled = on_settled
+        self.on_dead = on_dead
+        self.max_attempts = max_attempts
+        self.server = Server(horizon_url=horizon_url, client=horizon_client) if horizon_url else Server(client=horizon_client)
+        self.network_passphrase = network_passphrase
+        self.window_seconds = window_seconds
+        self.max_batch = max_batch
+        self.fee_strategy = fee_strategy or FeeStrategy(self.server, network_passphrase=network_passphrase)
+        self.tx_timeout = tx_timeout or self.fee_strategy.tx_timeout
+
+        self._pending = {}      # id -> pending record
+        self._in_flight = {}    # batch id -> submitting record, only populated during recovery
+        self._dead = {}         # id -> dead record that on_dead hasn't handled yet
+        self._published = set()  # sources this log holds a non-zero share for in cache
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._slot_lock = None
+        self._stopping = False
+
+    # ---- durable log -------------------------------------------------------
+
+    def _append(self, event):
+        with open(self.log_path, 'a') as log:
+            log.write(json.dumps(event) + '\n')
+            log.flush()
+            os.fsync(log.fileno())
+
+    def _compact(self):
+        # Rewrite the log with only the records that are still outstanding
+        tmp_path = f'{self.log_path}.tmp'
+        with open(tmp_path, 'w') as log:
+            for record in self._pending.values():
+                log.write(json.dumps(record) + '\n')
+            for record in self._in_flight.values():
+                log.write(json.dumps(record) + '\n')
+            for record in self._dead.values():
+                log.write(json.dumps(record) + '\n')
+            log.flush()
+            os.fsync(log.fileno())
+        os.replace(tmp_path, self.log_path)
+
+    def _replay(self, path=None):
+        path = path or self.log_path
+        if not os.path.exists(path):
+            return
+        with open(path) as log:
+            for line in log:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # A torn final line from a crash mid-write; everything before it is intact
+                    continue
+                kind = event['event']
+                if kind == 'pending':
+                    self._pending[event['id']] = event
+                elif kind == 'submitting':
+                    for entry_id in event['ids']:
+                        self._pending.pop(entry_id, None)
+                    self._in_flight[event['batch']] = event
+                elif kind == 'settled':
+                    self._in_flight.pop(event['batch'], None)
+                    for entry_id in event['ids']:
+                        self._pending.pop(entry_id, None)
+                elif kind == 'failed':
+                    counted = event.get('counted', True)
+                    submitting = self._in_flight.pop(event['batch'], None)
+                    if submitting:
+                        for record in submitting['entries']:
+                            if counted:
+                                record['attempts'] = record.get('attempts', 0) + 1
+                            self._pending[record['id']] = record
+                    elif counted:
+                        for entry_id in event['ids']:
+                            if entry_id in self._pending:
+                                self._pending[entry_id]['attempts'] = self._pending[entry_id].get('attempts', 0) + 1
+                elif kind == 'dead':
+                    self._pending.pop(event['id'], None)
+                    self._dead[event['id']] = event
+                elif kind == 'resolved':
+                    self._dead.pop(event['id'], None)
+
+    def _recover_in_flight(self):
+        """
+        Resolves batches whose outcome isn't known: submitted before a restart, or whose
+        submission broke off after the envelope may have reached the network. Once a batch's
+        time bound has passed it can't be included any more, so looking up its hash settles
+        the question for good; until then it is left alone, so its entries aren't paid twice.
+        """
+        resolved = False
+        for batch_id, record in list(self._in_flight.items()):
+            if time.time() <= record['valid_until'] + LEDGER_SECONDS:
+                continue
+            try:
+                with track_upstream('horizon', 'transactions'):
+                    tx = self.server.transactions().transaction(record['hash']).call()
+                settled = tx.get('successful', False)
+            except exceptions.NotFoundError:
+                settled = False
+            except Exception as e:
+                print(f"Settlement batch {batch_id} lookup failed, retrying later:", e)
+                continue
+            buried = []
+            with self._lock:
+                del self._in_flight[batch_id]
+                if settled:
+                    self._append({'event': 'settled', 'batch': batch_id, 'ids': record['ids'], 'hash': record['hash']})
+                else:
+                    error = 'not included before it expired'
+                    counted = record.get('count_failure', True)
+                    self._append({'event': 'failed', 'batch': batch_id, 'ids': record['ids'], 'error': error,
+                                  'counted': counted})
+                    for entry in record['entries']:
+                        self._pending[entry['id']] = entry
+                    buried = self._count_failure(record['ids'], error) if counted else []
+            if settled and self.on_settled:
+                self.on_settled(record['entries'], record['hash'])
+            self._report_dead(buried)
+            resolved = True
+        if resolved:
+            with self._lock:
+                self._compact()
+
+    def _adopting_path(self):
+        return f'{self.log_path}.adopting'
+
+    def _adopt_orphans(self):
+        """Merges logs no live worker holds into this one. Returns True if any were adopted."""
+        adopted = False
+        for path, lock_file in orphaned_log_slots(self.base_path, self.log_path):
+            # Moved aside before merging, so after a crash its records are in exactly one
+            # place, which start() replays ahead of this log
+            os.replace(path, self._adopting_path())
+            lock_file.close()
+            with self._lock:
+                self._replay(self._adopting_path())
+                self._compact()
+                os.remove(self._adopting_path())
+                self._sync_reservations()
+            self.cache.release(path)
+            print(f"Adopted settlement log {path}")
+            adopted = True
+        return adopted
+
+    # ---- cross-worker reservations -----------------------------------------
+
+    def _owed(self):
+        """{source: amount not yet settled} over pending and in-flight transfers. Needs self._lock."""
+        owed = {}
+        records = list(self._pending.values())
+        for batch in self._in_flight.values():
+            records.extend(batch['entries'])
+        for record in records:
+            owed[record['source']] = owed.get(record['source'], Decimal(0)) + Decimal(record['amount'])
+        return owed
+
+    @staticmethod
+    def _reservation(source_public):
+        return f'settlement:owed:{source_public}'
+
+    def _sync_reservations(self):
+        """
+        Publishes this log's share of what each account owes, including zeros for accounts it
+        no longer owes anything for. Runs every window, which also restores the shares after
+        a cache daemon restart. Needs self._lock.
+        """
+        owed = self._owed()
+        sources = set(owed) | self._published
+        if sources:
+            self.cache.hold(self.log_path, {self._reservation(source): str(owed.get(source, Decimal(0)))
+                                            for source in sources})
+        self._published = {source for source, amount in owed.items() if amount}
+
+    # ---- public API --------------------------------------------------------
+
+    def start(self):
+        """Replays the log and starts the flush thread. Safe to call more than once."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.log_path, self._slot_lock = claim_log_slot(self.base_path)
+            # An adoption interrupted by a crash; its records predate everything in this log
+            adopting = os.path.exists(self._adopting_path())
+            if adopting:
+                self._replay(self._adopting_path())
+            self._replay()
+            # Entries that reached the limit just before a crash, before their dead record
+            exhausted = [r['id'] for r in self._pending.values() if r.get('attempts', 0) >= self.max_attempts]
+            self._bury(exhausted, 'attempt limit reached before restart')
+            self._compact()
+            if adopting:
+                os.remove(self._adopting_path())
+            # Shares left by the slot's previous owner are replaced by what this replay found
+            self.cache.release(self.log_path)
+            self._sync_reservations()
+            self._thread = threading.Thread(target=self._run, name='settlement-engine', daemon=True)
+            self._thread.start()
+
+    def stop(self, flush=True):
+        with self._lock:
+            self._stopping = True
+            self._wakeup.notify()
+        if self._thread is not None:
+            self._thread.join()
+        if flush:
+            self.flush()
+
+    def enqueue(self, wallet_id, crypto_symbol, source_public, amount, reference=None, balance=None):
+        """
+        Durably records a transfer of `amount` XLM from source_public to the admin account and
+        returns its settlement id. If `balance` is given, the transfer is refused (returns None)
+        when it plus what the account already owes, in any worker's log, would exceed it.
+        """
+        if not Decimal(str(amount)).is_finite() or Decimal(str(amount)) <= 0:
+            raise ValueError(f"Settlement amount must be positive, got {amount}")
+        record = {
+            'event': 'pending',
+            'id': uuid.uuid4().hex,
+            'wallet_id': wallet_id,
+            'crypto_symbol': crypto_symbol,
+            'source': source_public,
+            'amount': str(Decimal(str(amount)).quantize(STROOP)),
+            'reference': reference,
+            'created_at': time.time(),
+            'attempts': 0
+        }
+        with self._lock:
+            if balance is not None:
+                held = self._owed().get(source_public, Decimal(0))
+                if self.cache.reserve(self._reservation(source_public), self.log_path, str(held),
+                                      record['amount'], str(balance)) is None:
+                    return None
+                self._published.add(source_public)
+            self._append(record)
+            self._pending[record['id']] = record
+            if len(self._pending) >= self.max_batch:
+                self._wakeup.notify()
+        return record['id']
+
+    def pending_amount(self, source_public):
+        """Total not-yet-settled amount owed by an account, across every worker's log."""
+        name = self._reservation(source_public)
+        with self._lock:
+            held = self._owed().get(source_public, Decimal(0))
+            total = self.cache.hold(self.log_path, {name: str(held)})[name]
+            if held:
+                self._published.add(source_public)
+        return Decimal(total)
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    def dead_entries(self):
+        """Dead transfers that on_dead hasn't handled yet, for operators."""
+        with self._lock:
+            return list(self._dead.values())
+
+    @use_priority(PAYMENT)
+    def flush(self):
+        """Settles everything pending now. Returns the number of entries settled."""
+        with self._flush_lock:
+            return self._flush()
+
+    # ---- internals ---------------------------------------------------------
+
+    def _flush(self):
+        with self._lock:
+            entries = list(self._pending.values())
+            unreported = list(self._dead.values())
+        # Retries on_dead calls that failed earlier, e.g. while Firestore was unreachable
+        self._report_dead(unreported)
+        if not entries:
+            return 0
+
+        # Net all transfers from the same account into a single payment op
+        groups = {}
+        for entry in entries:
+            groups.setdefault(entry['source'], []).append(entry)
+        sources = list(groups)
+
+        # The fee account signs too, so it leaves room for one account fewer
+        per_tx = MAX_SIGNERS_PER_TX - 1 if self.fee_keypair else 1
+        settled = 0
+        for start in range(0, len(sources), per_tx):
+            chunk = {source: groups[source] for source in sources[start:start + per_tx]}
+            # A failure with several accounts in the transaction isn't counted against any of them
+            outcome = self._settle(chunk, count_failure=len(chunk) == 1)
+            if outcome:
+                settled += sum(len(group) for group in chunk.values())
+            elif outcome is False and len(chunk) > 1:
+                # One bad account fails the whole transaction; isolate it by settling individually
+                for source, group in chunk.items():
+                    if self._settle({source: group}):
+                        settled += len(group)
+
+        with self._lock:
+            self._compact()
+        return settled
+
+    @use_priority(PAYMENT)
+    def _run(self):
+        self._adopt_orphans()
+        while True:
+            with self._lock:
+                if not self._stopping and len(self._pending) < self.max_batch:
+                    self._wakeup.wait(self.window_seconds)
+                if self._stopping:
+                    return
+            try:
+                self._recover_in_flight()
+                self.flush()
+                with self._lock:
+                    self._sync_reservations()
+                self._adopt_orphans()
+            except Exception as e:
+                print("Settlement flush error:", e)
+
+    def _settle(self, groups, count_failure=True):
+        """True once the batch is in a ledger, False if it definitely wasn't paid, None if that isn't known yet."""
+        batch_id = uuid.uuid4().hex
+        entries = [entry for group in groups.values() for entry in group]
+        ids = [entry['id'] for entry in entries]
+        try:
+            keypairs = []
+            for source, group in groups.items():
+                secret = self.resolve_secret(group[0]['wallet_id'], group[0]['crypto_symbol'])
+                keypair = Keypair.from_secret(secret)
+                if keypair.public_key != source:
+                    raise Exception(f"Wallet secret does not match settlement source {source}")
+                keypairs.append(keypair)
+
+            # The fee account, or else the only source, pays the fees; they are capped at what
+            # it can spare beyond the reserve and its own transfer
+            fee_keypair = self.fee_keypair or keypairs[0]
+            fee_source = fee_keypair.public_key
+            with track_upstream('horizon', 'load_account'):
+                account = self.server.accounts().account_id(fee_source).call()
+            tx_source = Account(fee_source, int(account['sequence']))
+            native = next(Decimal(b['balance']) for b in account['balances'] if b['asset_type'] == 'native')
+            own = sum((Decimal(entry['amount']) for entry in groups.get(fee_source, [])), Decimal(0))
+            fee_budget = int((native - ACCOUNT_RESERVE - own) / STROOP)
+            if self.fee_keypair and fee_budget < MIN_BASE_FEE * len(groups):
+                # The operator's account is short, not the users'; don't count it against them
+                self._mark_failed(batch_id, ids, f"Fee account {fee_source} can't pay the fee", False)
+                return False
+            base_fee = max(min(self.fee_strategy.base_fee(), fee_budget // len(groups)), MIN_BASE_FEE)
+            builder = TransactionBuilder(
+                source_account=tx_source,
+                network_passphrase=self.network_passphrase,
+                base_fee=base_fee
+            ).add_text_memo("TransCrypt settlement")
+            for source, group in groups.items():
+                total = sum((Decimal(entry['amount']) for entry in group), Decimal(0))
+                builder.append_payment_op(destination=self.destination, amount=str(total),
+                                          asset=Asset.native(), source=source)
+            transaction = builder.set_timeout(self.tx_timeout).build()
+            for keypair in keypairs:
+                transaction.sign(keypair)
+            if self.fee_keypair and self.fee_keypair.public_key not in groups:
+                transaction.sign(self.fee_keypair)
+        except Exception as e:
+            self._mark_failed(batch_id, ids, e, count_failure)
+            return False
+
+        submitting = {
+            'event': 'submitting',
+            'batch': batch_id,
+            'ids': ids,
+            'entries': entries,
+            'hash': transaction.hash_hex(),
+            'valid_until': transaction.transaction.preconditions.time_bounds.max_time,
+            'count_failure': count_failure
+        }
+        with self._lock:
+            self._append(submitting)
+        try:
+            # A fee bump keeps the inner hash logged above, so recovery still finds it
+            response = self.fee_strategy.submit(transaction, fee_keypair, fee_budget)
+        except TransactionNotConfirmed as e:
+            # Rejected, failed in a ledger or expired: nothing was paid
+            self._mark_failed(batch_id, ids, e, count_failure)
+            return False
+        except Exception as e:
+            # The envelope may be in a ledger or still queued; building a new transaction for
+            # these entries could pay them twice, so they wait for _recover_in_flight()
+            print(f"Settlement batch {batch_id} outcome unknown, looking it up after it expires:", e)
+            with self._lock:
+                for entry_id in ids:
+                    self._pending.pop(entry_id, None)
+                self._in_flight[batch_id] = submitting
+            return None
+
+        with self._lock:
+            self._append({'event': 'settled', 'batch': batch_id, 'ids': ids, 'hash': response['hash']})
+            for entry_id in ids:
+                self._pending.pop(entry_id, None)
+        print(f"Settled {len(ids)} conversions from {len(groups)} accounts in {response['hash']}")
+        if self.on_settled:
+            self.on_settled(entries, response['hash'])
+        return True
+
+    def _mark_failed(self, batch_id, ids, error, count_failure=True):
+        print(f"Settlement batch {batch_id} failed:", error)
+        with self._lock:
+            self._append({'event': 'failed', 'batch': batch_id, 'ids': ids, 'error': str(error),
+                          'counted': count_failure})
+            buried = self._count_failure(ids, error) if count_failure else []
+        self._report_dead(buried)
+
+    def _count_failure(self, ids, error):
+        """Adds a failed attempt to each pending entry and buries those at the limit. Needs self._lock."""
+        exhausted = []
+        for entry_id in ids:
+            record = self._pending.get(entry_id)
+            if record is None:
+                continue
+            record['attempts'] = record.get('attempts', 0) + 1
+            if record['attempts'] >= self.max_attempts:
+                exhausted.append(entry_id)
+        return self._bury(exhausted, error)
+
+    def _bury(self, ids, error):
+        """Moves pending entries to the dead state and returns their dead records. Needs self._lock."""
+        buried = []
+        for entry_id in ids:
+            record = dict(self._pending.pop(entry_id), event='dead', error=str(error))
+            self._append(record)
+            self._dead[entry_id] = record
+            buried.append(record)
+            print(f"Settlement {entry_id} from {record['source']} abandoned after {record.get('attempts', 0)} attempts:", error)
+        return buried
+
+    def _report_dead(self, records):
+        if self.on_dead is None:
+            return
+        for record in records:
+            try:
+                self.on_dead(record)
+            except Exception as e:
+                print(f"Failed to report abandoned settlement {record['id']}:", e)
+                continue
+            with self._lock:
+                self._append({'event': 'resolved', 'id': record['id']})
+                self._dead.pop(record['id'], None)
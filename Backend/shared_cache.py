@@ -0,0 +1,378 @@
+"""
+Cache shared by all workers of a multi-process deployment.
+
+One daemon process owns the data and serves it over a local Unix socket; every worker
+talks to it through CacheClient. Without SHARED_CACHE_SOCKET, or on platforms without Unix
+sockets (Windows), the app uses a CacheStore in-process instead, which has the same interface.
+
+    python -m shared_cache --socket /tmp/transcrypt-cache.sock
+
+gunicorn.conf.py starts the daemon automatically.
+"""
+import os
+import sys
+import json
+import time
+import struct
+import signal
+import argparse
+import threading
+import socket
+import socketserver
+from decimal import Decimal
+from collections import OrderedDict
+from outbound import TokenBucket
+
+# Each message is a frame: header length, body length, JSON header, raw body bytes
+_FRAME = struct.Struct('!II')
+
+# How long a client keeps using its local fallback after the daemon stops answering
+RECONNECT_INTERVAL = 5.0
+
+# How often expired pinned keys are swept out, since LRU eviction never reaches them
+PINNED_SWEEP_INTERVAL = 60.0
+
+# False on Windows, where only the single-process, in-process cache is available
+UNIX_SOCKETS = hasattr(socket, 'AF_UNIX') and hasattr(socketserver, 'ThreadingUnixStreamServer')
+
+
+class _JsonMixin:
+    def get_json(self, key):
+        value = self.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set_json(self, key, value, ttl=None, pinned=False):
+        self.set(key, json.dumps(value).encode(), ttl, pinned)
+
+    def add_json(self, key, value, ttl=None, pinned=False):
+        return self.add(key, json.dumps(value).encode(), ttl, pinned)
+
+    def pop_json(self, key):
+        value = self.pop(key)
+        return json.loads(value) if value is not None else None
+
+
+class CacheStore(_JsonMixin):
+    """
+    LRU of byte values with optional per-key TTLs, bounded by total value size, plus named
+    token buckets for rate limits. Expired keys are dropped when read or evicted.
+
+    Keys written with pinned=True live outside the LRU: they are never evicted to make room
+    and only go away when their TTL runs out, for records that must not be lost to cache
+    pressure, such as Idempotency-Key results.
+
+    Reservations are named totals made of per-member shares, e.g. what one account owes
+    across every worker's settlement log. They are never evicted either.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()     # key -> (value, expires_at or None)
+        self._size = 0
+        self._pinned = {}               # key -> (value, expires_at or None), not counted in _size
+        self._next_sweep = 0.0
+        self._buckets = {}
+        self._reservations = {}         # name -> {member: Decimal}
+        self._lock = threading.Lock()
+
+    def _live(self, key, now):
+        item = self._items.get(key) or self._pinned.get(key)
+        if item is None:
+            return None
+        if item[1] is not None and item[1] <= now:
+            self._remove(key)
+            return None
+        if key in self._items:
+            self._items.move_to_end(key)
+        return item
+
+    def _remove(self, key):
+        if key in self._pinned:
+            del self._pinned[key]
+            return
+        value, _ = self._items.pop(key)
+        self._size -= len(value)
+
+    def _store(self, key, value, ttl, now, pinned=False):
+        if key in self._items or key in self._pinned:
+            self._remove(key)
+        item = (bytes(value), now + ttl if ttl else None)
+        if pinned:
+            self._pinned[key] = item
+            self._sweep_pinned(now)
+            return
+        self._items[key] = item
+        self._size += len(value)
+        while self._size > self.max_bytes and len(self._items) > 1:
+            self._remove(next(iter(self._items)))
+
+    def _sweep_pinned(self, now):
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + PINNED_SWEEP_INTERVAL
+        for key in [key for key, (_, expires_at) in self._pinned.items() if expires_at is not None and expires_at <= now]:
+            del self._pinned[key]
+
+    def get(self, key):
+        with self._lock:
+            item = self._live(key, time.time())
+            return item[0] if item else None
+
+    def set(self, key, value, ttl=None, pinned=False):
+        with self._lock:
+            self._store(key, value, ttl, time.time(), pinned)
+
+    def add(self, key, value, ttl=None, pinned=False):
+        """Stores value only if key is absent; True if it was stored."""
+        with self._lock:
+            now = time.time()
+            if self._live(key, now) is not None:
+                return False
+            self._store(key, value, ttl, now, pinned)
+            return True
+
+    def pop(self, key):
+        """Removes and returns a value in one step, so only one caller can get it."""
+        with self._lock:
+            item = self._live(key, time.time())
+            if item is None:
+                return None
+            self._remove(key)
+            return item[0]
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._items or key in self._pinned:
+                self._remove(key)
+
+    def _bucket(self, name, rate, burst):
+        bucket = self._buckets.get(name)
+        if bucket is None or (bucket.rate, bucket.burst) != (rate, burst):
+            bucket = TokenBucket(rate, burst)
+            self._buckets[name] = bucket
+        return bucket
+
+    def take_token(self, name, rate, burst, keep=0.0):
+        """Takes a token from the named bucket, leaving `keep`; returns 0, or the seconds until one is free."""
+        with self._lock:
+            return self._bucket(name, rate, burst).try_take(time.monotonic(), keep)
+
+    def pause_bucket(self, name, seconds, rate, burst):
+        with self._lock:
+            self._bucket(name, rate, burst).pause(time.monotonic() + seconds)
+
+    def _set_share(self, name, member, amount):
+        shares = self._reservations.setdefault(name, {})
+        if amount:
+            shares[member] = amount
+        else:
+            shares.pop(member, None)
+        total = sum(shares.values(), Decimal(0))
+        if not shares:
+            del self._reservations[name]
+        return total
+
+    def reserve(self, name, member, held, amount, limit):
+        """
+        Sets member's share of the named total to `held`, then adds `amount` to it unless
+        that takes the total of all shares past `limit`, in one step. Returns the new total,
+        or None if refused. Amounts are decimal strings, so they round-trip exactly.
+        """
+        with self._lock:
+            held, amount = Decimal(held), Decimal(amount)
+            total = self._set_share(name, member, held)
+            if total + amount > Decimal(limit):
+                return None
+            return str(self._set_share(name, member, held + amount))
+
+    def hold(self, member, shares):
+        """Sets member's share of several totals ({name: amount}, 0 drops it) and returns {name: total}."""
+        with self._lock:
+            return {name: str(self._set_share(name, member, Decimal(amount))) for name, amount in shares.items()}
+
+    def release(self, member):
+        """Drops every share a member holds, e.g. one whose worker is gone."""
+        with self._lock:
+            for name in list(self._reservations):
+                self._set_share(name, member, Decimal(0))
+
+    def stats(self):
+        with self._lock:
+            return {'keys': len(self._items), 'bytes': self._size, 'max_bytes': self.max_bytes,
+                    'pinned_keys': len(self._pinned)}
+
+
+# ---- daemon ----------------------------------------------------------------
+
+def _read_exact(stream, size):
+    data = stream.read(size) if size else b''
+    if len(data) != size:
+        raise EOFError
+    return data
+
+
+def _read_frame(stream):
+    header_size, body_size = _FRAME.unpack(_read_exact(stream, _FRAME.size))
+    return json.loads(_read_exact(stream, header_size)), _read_exact(stream, body_size)
+
+
+def _frame(header, body=b''):
+    header = json.dumps(header).encode()
+    return _FRAME.pack(len(header), len(body)) + header + body
+
+
+class _CacheRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        store = self.server.store
+        while True:
+            try:
+                request, body = _read_frame(self.rfile)
+            except (EOFError, ConnectionError):
+                return
+            op, args = request['op'], request.get('args', [])
+            try:
+                if op in ('set', 'add'):
+                    key, ttl, pinned = args
+                    result = getattr(store, op)(key, body, ttl, pinned)
+                elif op in ('get', 'pop', 'delete', 'take_token', 'pause_bucket', 'reserve', 'hold', 'release', 'stats'):
+                    result = getattr(store, op)(*args)
+                else:
+                    raise ValueError(f'Unknown operation: {op}')
+            except Exception as e:
+                self.wfile.write(_frame({'error': str(e)}))
+                continue
+            if isinstance(result, bytes):
+                self.wfile.write(_frame({'bytes': True}, result))
+            else:
+                self.wfile.write(_frame({'result': result}))
+
+
+class CacheServer(getattr(socketserver, 'ThreadingUnixStreamServer', socketserver.ThreadingMixIn)):
+    daemon_threads = True
+
+    def __init__(self, socket_path, store):
+        if not UNIX_SOCKETS:
+            raise RuntimeError('The shared cache daemon needs Unix domain sockets')
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        # Only the deploying user may connect; cached records include wallet data
+        previous_umask = os.umask(0o077)
+        try:
+            super().__init__(socket_path, _CacheRequestHandler)
+        finally:
+            os.umask(previous_umask)
+        self.store = store
+
+
+# ---- client ----------------------------------------------------------------
+
+class CacheClient(_JsonMixin):
+    """
+    Talks to the cache daemon with one persistent connection per thread. If the daemon is
+    unreachable, calls go to a worker-local CacheStore until it comes back, so a crashed
+    daemon degrades to per-worker caching instead of failing requests.
+    """
+
+    def __init__(self, socket_path, timeout=2.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.fallback = CacheStore()
+        self._local = threading.local()
+        self._down_until = 0.0
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            conn = (sock, sock.makefile('rb'))
+            self._local.conn = conn
+        return conn
+
+    def _disconnect(self):
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn is not None:
+            conn[1].close()
+            conn[0].close()
+
+    def _call(self, op, args, body=b'', fallback=None):
+        if time.monotonic() < self._down_until:
+            return fallback()
+        try:
+            sock, reader = self._connection()
+            sock.sendall(_frame({'op': op, 'args': args}, body))
+            response, value = _read_frame(reader)
+        except (OSError, EOFError) as e:
+            self._disconnect()
+            self._down_until = time.monotonic() + RECONNECT_INTERVAL
+            print("Shared cache unavailable, using worker-local cache:", e)
+            return fallback()
+        if 'error' in response:
+            raise RuntimeError(f"Shared cache error: {response['error']}")
+        return value if response.get('bytes') else response['result']
+
+    def get(self, key):
+        return self._call('get', [key], fallback=lambda: self.fallback.get(key))
+
+    def set(self, key, value, ttl=None, pinned=False):
+        self._call('set', [key, ttl, pinned], value, fallback=lambda: self.fallback.set(key, value, ttl, pinned))
+
+    def add(self, key, value, ttl=None, pinned=False):
+        return self._call('add', [key, ttl, pinned], value,
+                          fallback=lambda: self.fallback.add(key, value, ttl, pinned))
+
+    def pop(self, key):
+        return self._call('pop', [key], fallback=lambda: self.fallback.pop(key))
+
+    def delete(self, key):
+        self._call('delete', [key], fallback=lambda: self.fallback.delete(key))
+
+    def take_token(self, name, rate, burst, keep=0.0):
+        return self._call('take_token', [name, rate, burst, keep],
+                          fallback=lambda: self.fallback.take_token(name, rate, burst, keep))
+
+    def pause_bucket(self, name, seconds, rate, burst):
+        self._call('pause_bucket', [name, seconds, rate, burst],
+                   fallback=lambda: self.fallback.pause_bucket(name, seconds, rate, burst))
+
+    def reserve(self, name, member, held, amount, limit):
+        return self._call('reserve', [name, member, held, amount, limit],
+                          fallback=lambda: self.fallback.reserve(name, member, held, amount, limit))
+
+    def hold(self, member, shares):
+        return self._call('hold', [member, shares], fallback=lambda: self.fallback.hold(member, shares))
+
+    def release(self, member):
+        self._call('release', [member], fallback=lambda: self.fallback.release(member))
+
+    def stats(self):
+        return self._call('stats', [], fallback=self.fallback.stats)
+
+
+def open_cache():
+    """The shared daemon's client when SHARED_CACHE_SOCKET is set, else an in-process store."""
+    socket_path = os.getenv('SHARED_CACHE_SOCKET')
+    if socket_path and not UNIX_SOCKETS:
+        print("SHARED_CACHE_SOCKET ignored: Unix sockets are not available, using an in-process cache")
+        socket_path = None
+    return CacheClient(socket_path) if socket_path else CacheStore()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the TransCrypt shared cache daemon')
+    parser.add_argument('--socket', default=os.getenv('SHARED_CACHE_SOCKET', '/tmp/transcrypt-cache.sock'))
+    parser.add_argument('--max-mb', type=int, default=int(os.getenv('SHARED_CACHE_MAX_MB', '64')))
+    args = parser.parse_args()
+
+    server = CacheServer(args.socket, CacheStore(args.max_mb * 1024 * 1024))
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        os.unlink(args.socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+import json
+import unittest
+from unittest import mock
+from stellar_sdk import Keypair, Account, TransactionBuilder, Network, Asset, exceptions
+from stellar_sdk.client.response import Response
+from fees import FeeStrategy, TransactionNotConfirmed
+
+DESTINATION = Keypair.random().public_key
+
+
+def horizon_error(status, body):
+    error = exceptions.BadResponseError if status >= 500 else exceptions.BadRequestError
+    return error(Response(status, json.dumps(body), {}, ''))
+
+
+class FakeTransactions:
+    def __init__(self, server):
+        self.server = server
+        self.hash = None
+
+    def transaction(self, tx_hash):
+        self.hash = tx_hash
+        return self
+
+    def call(self):
+        if self.hash not in self.server.included:
+            raise exceptions.NotFoundError(Response(404, '{"status": 404}', {}, ''))
+        return {'hash': self.hash, 'successful': True}
+
+
+class FakeServer:
+    """Answers TRY_AGAIN_LATER `busy` times, then includes whatever bids at least min_fee per operation."""
+
+    def __init__(self, busy=0, min_fee=0, reject_bumps=False):
+        self.busy = busy
+        self.min_fee = min_fee
+        self.reject_bumps = reject_bumps
+        self.sent = []
+        self.included = set()
+
+    def submit_transaction_async(self, envelope):
+        self.sent.append(envelope)
+        if self.busy:
+            self.busy -= 1
+            raise horizon_error(503, {'tx_status': 'TRY_AGAIN_LATER', 'hash': envelope.hash_hex()})
+        tx = envelope.transaction
+        inner = getattr(tx, 'inner_transaction_envelope', envelope)
+        if self.reject_bumps and inner is not envelope:
+            raise horizon_error(400, {'tx_status': 'ERROR', 'hash': envelope.hash_hex()})
+        operations = len(inner.transaction.operations) + (inner is not envelope)
+        if tx.fee // operations >= self.min_fee:
+            self.included.add(inner.hash_hex())
+        return {'tx_status': 'PENDING'}
+
+    def transactions(self):
+        return FakeTransactions(self)
+
+
+def signed_payment(keypair, operations=1, base_fee=100, timeout=60):
+    builder = TransactionBuilder(Account(keypair.public_key, 1), Network.TESTNET_NETWORK_PASSPHRASE, base_fee)
+    for _ in range(operations):
+        builder.append_payment_op(DESTINATION, Asset.native(), '1')
+    transaction = builder.set_timeout(timeout).build()
+    transaction.sign(keypair)
+    return transaction
+
+
+@mock.patch('fees.LEDGER_SECONDS', 0.01)
+@mock.patch('fees.MAX_RESEND_BACKOFF', 0.04)
+class FeeStrategyTest(unittest.TestCase):
+    def strategy(self, server, target_seconds=10.0):
+        return FeeStrategy(server, target_seconds=target_seconds, confirm_poll=0.001)
+
+    def test_try_again_later_resends_same_envelope_without_bumping(self):
+        keypair = Keypair.random()
+        transaction = signed_payment(keypair)
+        server = FakeServer(busy=3)
+
+        record = self.strategy(server).submit(transaction, keypair)
+
+        self.assertEqual(record['hash'], transaction.hash_hex())
+        self.assertEqual(len(server.sent), 4)
+        self.assertTrue(all(sent is transaction for sent in server.sent))
+
+    def test_bump_fee_respects_budget(self):
+        strategy = self.strategy(FakeServer())
+        self.assertEqual(strategy.bump_fee(100, operations=20, budget=21_000), 1000)
+        self.assertIsNone(strategy.bump_fee(100, operations=20, budget=20_999))
+        self.assertIsNone(strategy.bump_fee(20_000))
+
+    def test_queued_transaction_is_bumped_within_budget(self):
+        keypair = Keypair.random()
+        transaction = signed_payment(keypair, operations=2)
+        server = FakeServer(min_fee=1000)
+
+        record = self.strategy(server, target_seconds=0.0).submit(transaction, keypair, fee_budget=3000)
+
+        self.assertEqual(record['hash'], transaction.hash_hex())
+        self.assertEqual(server.sent[-1].transaction.fee, 3000)
+
+    def test_no_bump_past_budget(self):
+        keypair = Keypair.random()
+        transaction = signed_payment(keypair, operations=2, timeout=1)
+        server = FakeServer(min_fee=1000)
+
+        with self.assertRaises(TransactionNotConfirmed):
+            self.strategy(server, target_seconds=0.0).submit(transaction, keypair, fee_budget=2999)
+        self.assertEqual(server.sent, [transaction])
+
+    def test_rejected_bump_keeps_waiting_for_queued_transaction(self):
+        keypair = Keypair.random()
+        transaction = signed_payment(keypair, timeout=1)
+        server = FakeServer(min_fee=1000, reject_bumps=True)
+
+        with self.assertRaisesRegex(TransactionNotConfirmed, 'expired'):
+            self.strategy(server, target_seconds=0.0).submit(transaction, keypair)
+        self.assertGreater(len(server.sent), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import tempfile
+import unittest
+from metrics import Counter, Gauge, Histogram, MetricsDirectory
+
+
+class MetricsMergeTest(unittest.TestCase):
+    def test_counters_and_histograms_add_up(self):
+        counter = Counter('requests_total', 'Requests.', ('route',))
+        histogram = Histogram('latency_seconds', 'Latency.', buckets=(0.1, 1.0))
+        counter.inc('/a')
+        histogram.observe(0.05)
+
+        self.assertEqual(counter.merged([[[['/a'], 2], [['/b'], 1]]]), {('/a',): 3, ('/b',): 1})
+        self.assertEqual(histogram.merged([[[[], [0, 1, 0.5, 1]]]]), {(): [1, 2, 0.55, 2]})
+        # Merging doesn't change this process's own values
+        self.assertEqual(counter.snapshot(), [[['/a'], 1]])
+
+    def test_gauge_aggregate(self):
+        in_flight = Gauge('in_flight', 'In flight.')
+        base_fee = Gauge('base_fee', 'Base fee.', aggregate=max)
+        in_flight.inc()
+        base_fee.set(value=100)
+
+        self.assertEqual(in_flight.merged([[[[], 2]]]), {(): 3})
+        self.assertEqual(base_fee.merged([[[[], 100]], [[[], 200]]]), {(): 200})
+
+    def test_directory_reads_other_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            first, second = MetricsDirectory(directory), MetricsDirectory(directory)
+            first.publish()
+            second.publish()
+
+            [(snapshot, running)] = second.others()
+            self.assertIn('transcrypt_http_requests_total', snapshot)
+            self.assertTrue(running)
+            first._lock_file.close()
+            self.assertEqual([running for _, running in second.others()], [False])
+            second._lock_file.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import time
+import threading
+import unittest
+from outbound import OutboundScheduler, UpstreamBusy, PAYMENT, BALANCE, BACKGROUND
+from shared_cache import CacheStore
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class OutboundSchedulerTest(unittest.TestCase):
+    def take_all(self, scheduler, priority):
+        """Acquires until the bucket refuses and returns how many tokens were taken."""
+        taken = 0
+        while True:
+            try:
+                scheduler.acquire('horizon', priority, time.monotonic() + 0.01)
+            except UpstreamBusy:
+                return taken
+            taken += 1
+
+    def test_queued_calls_go_out_in_priority_order(self):
+        scheduler = OutboundScheduler({'horizon': (10, 1)})
+        scheduler.pause('horizon', 0.2)
+        order = []
+
+        def call(priority):
+            scheduler.acquire('horizon', priority, time.monotonic() + 5)
+            order.append(priority)
+
+        threads = []
+        for depth, priority in enumerate((BACKGROUND, BALANCE, PAYMENT), start=1):
+            threads.append(threading.Thread(target=call, args=(priority,)))
+            threads[-1].start()
+            while scheduler.queue_depth('horizon') < depth:
+                time.sleep(0.001)
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(order, [PAYMENT, BALANCE, BACKGROUND])
+
+    def test_background_leaves_headroom(self):
+        for shared in (None, CacheStore()):
+            scheduler = OutboundScheduler({'horizon': (0.001, 10)})
+            if shared is not None:
+                scheduler.share_buckets(shared)
+            self.assertEqual(self.take_all(scheduler, BACKGROUND), 5)
+            self.assertEqual(self.take_all(scheduler, PAYMENT), 5)
+
+    def test_background_may_use_a_burst_of_one(self):
+        scheduler = OutboundScheduler({'horizon': (0.001, 1)})
+        self.assertEqual(self.take_all(scheduler, BACKGROUND), 1)
+
+    def test_deadline_raises_busy_and_leaves_queue(self):
+        scheduler = OutboundScheduler({'horizon': (0.001, 1)})
+        scheduler.acquire('horizon', PAYMENT, time.monotonic() + 1)
+
+        with self.assertRaises(UpstreamBusy) as raised:
+            scheduler.acquire('horizon', PAYMENT, time.monotonic() + 0.05)
+        self.assertGreater(raised.exception.retry_after, 60)
+        self.assertEqual(scheduler.queue_depth('horizon'), 0)
+
+    def test_retry_after_pauses_and_retries(self):
+        scheduler = OutboundScheduler({'horizon': None})
+        responses = [FakeResponse(429, {'Retry-After': '0.1'}), FakeResponse(200)]
+        started = time.monotonic()
+
+        response = scheduler.call('horizon', lambda: responses.pop(0), PAYMENT)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+
+    def test_retry_after_past_deadline_raises_busy(self):
+        scheduler = OutboundScheduler({'horizon': None}, max_wait=1)
+        sent = []
+
+        def send():
+            sent.append(1)
+            return FakeResponse(503, {'Retry-After': '30'})
+
+        with self.assertRaises(UpstreamBusy) as raised:
+            scheduler.call('horizon', send, PAYMENT)
+        self.assertEqual(raised.exception.retry_after, 30)
+        self.assertEqual(len(sent), 1)
+        with self.assertRaises(UpstreamBusy):
+            scheduler.acquire('horizon', BALANCE, time.monotonic() + 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,383 @@
+import os
+import json
+import time
+import tempfile
+import unittest
+from stellar_sdk import Keypair, exceptions
+from stellar_sdk.client.response import Response
+from file_locks import try_lock
+from shared_cache import CacheStore
+from fees import TransactionNotConfirmed
+from settlement import SettlementEngine
+
+DESTINATION = Keypair.random().public_key
+SOURCE = Keypair.random().public_key
+
+
+def pending(entry_id, amount='1.0000000', attempts=0, source=SOURCE):
+    return {'event': 'pending', 'id': entry_id, 'wallet_id': 'w1', 'crypto_symbol': 'btc', 'source': source,
+            'amount': amount, 'reference': f'ref-{entry_id}', 'created_at': 0, 'attempts': attempts}
+
+
+def submitting(batch_id, entries, tx_hash='a' * 64):
+    return {'event': 'submitting', 'batch': batch_id, 'ids': [e['id'] for e in entries], 'entries': entries,
+            'hash': tx_hash, 'valid_until': time.time() - 60}
+
+
+class FakeTransactions:
+    def __init__(self, records):
+        self.records = records
+        self.hash = None
+
+    def transaction(self, tx_hash):
+        self.hash = tx_hash
+        return self
+
+    def call(self):
+        if self.hash not in self.records:
+            raise exceptions.NotFoundError(Response(404, '{"status": 404}', {}, ''))
+        return self.records[self.hash]
+
+
+class FakeAccounts:
+    def account_id(self, account_id):
+        return self
+
+    def call(self):
+        return {'sequence': '1', 'balances': [{'asset_type': 'native', 'balance': '100.0000000'}]}
+
+
+class FakeServer:
+    def __init__(self, records=None):
+        self.records = records or {}
+
+    def transactions(self):
+        return FakeTransactions(self.records)
+
+    def accounts(self):
+        return FakeAccounts()
+
+
+class FakeFeeStrategy:
+    """Raises `error` from submit(), or confirms every transaction if it is None."""
+
+    tx_timeout = 60
+
+    def __init__(self, error=None):
+        self.error = error
+        self.submitted = []
+
+    def base_fee(self):
+        return 100
+
+    def submit(self, transaction, fee_source, fee_budget=None):
+        self.submitted.append((transaction, fee_source))
+        if self.error is not None:
+            raise self.error
+        return {'hash': transaction.hash_hex(), 'successful': True}
+
+
+class SettlementEngineTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.log_path = os.path.join(self.dir.name, 'settlements.jsonl')
+        self.settled = []
+        self.dead = []
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def engine(self, resolve_secret=None, on_dead=None, max_attempts=3, cache=None, fee_strategy=None,
+               fee_secret=None):
+        engine = SettlementEngine(
+            self.log_path, DESTINATION,
+            resolve_secret=resolve_secret or (lambda wallet_id, symbol: None),
+            on_settled=lambda entries, tx_hash: self.settled.append((entries, tx_hash)),
+            on_dead=on_dead or self.dead.append,
+            max_attempts=max_attempts,
+            cache=cache,
+            fee_strategy=fee_strategy,
+            fee_secret=fee_secret
+        )
+        engine.server = FakeServer()
+        return engine
+
+    def write_log(self, *events, torn_tail=None, path=None):
+        with open(path or self.log_path, 'w') as log:
+            for event in events:
+                log.write(json.dumps(event) + '\n')
+            if torn_tail:
+                log.write(torn_tail)
+
+    def log_events(self):
+        with open(self.log_path) as log:
+            return [json.loads(line) for line in log if line.strip()]
+
+    # ---- _replay -----------------------------------------------------------
+
+    def test_replay_restores_pending_and_in_flight(self):
+        a, b, c = pending('a'), pending('b'), pending('c')
+        self.write_log(a, b, c, submitting('batch-1', [a]),
+                       {'event': 'submitting', 'batch': 'batch-2', 'ids': ['b'], 'entries': [b], 'hash': 'b' * 64,
+                        'valid_until': 0},
+                       {'event': 'settled', 'batch': 'batch-2', 'ids': ['b'], 'hash': 'b' * 64},
+                       torn_tail='{"event": "pend')
+        engine = self.engine()
+        engine._replay()
+        self.assertEqual(list(engine._pending), ['c'])
+        self.assertEqual(list(engine._in_flight), ['batch-1'])
+        self.assertEqual(engine.pending_amount(SOURCE), 2)
+
+    def test_replay_counts_failed_attempts(self):
+        a, b = pending('a'), pending('b')
+        self.write_log(a, b, submitting('batch-1', [a]),
+                       {'event': 'failed', 'batch': 'batch-1', 'ids': ['a'], 'error': 'tx_failed'},
+                       {'event': 'failed', 'batch': 'batch-2', 'ids': ['b'], 'error': 'no secret'},
+                       {'event': 'failed', 'batch': 'batch-3', 'ids': ['a', 'b'], 'error': 'tx_failed',
+                        'counted': False})
+        engine = self.engine()
+        engine._replay()
+        self.assertEqual(engine._in_flight, {})
+        self.assertEqual(engine._pending['a']['attempts'], 1)
+        self.assertEqual(engine._pending['b']['attempts'], 1)
+
+    def test_replay_keeps_dead_entries_until_resolved(self):
+        a, b = pending('a'), pending('b')
+        self.write_log(a, b, dict(a, event='dead', error='tx_failed'), dict(b, event='dead', error='tx_failed'),
+                       {'event': 'resolved', 'id': 'b'})
+        engine = self.engine()
+        engine._replay()
+        self.assertEqual(engine._pending, {})
+        self.assertEqual([r['id'] for r in engine.dead_entries()], ['a'])
+        self.assertEqual(engine.pending_amount(SOURCE), 0)
+
+    # ---- _compact ----------------------------------------------------------
+
+    def test_compact_rewrites_only_outstanding_records(self):
+        a, b, c = pending('a'), pending('b'), pending('c')
+        self.write_log(a, b, c, submitting('batch-1', [a]),
+                       {'event': 'failed', 'batch': 'batch-9', 'ids': ['b'], 'error': 'no secret'},
+                       dict(c, event='dead', error='tx_failed'))
+        engine = self.engine()
+        engine._replay()
+        engine._compact()
+
+        self.assertEqual(sorted(e['event'] for e in self.log_events()), ['dead', 'pending', 'submitting'])
+        self.assertFalse(os.path.exists(f'{self.log_path}.tmp'))
+        replayed = self.engine()
+        replayed._replay()
+        self.assertEqual(replayed._pending, engine._pending)
+        self.assertEqual(replayed._in_flight, engine._in_flight)
+        self.assertEqual(replayed._dead, engine._dead)
+
+    # ---- _recover_in_flight ------------------------------------------------
+
+    def test_recover_in_flight_records_confirmed_batch(self):
+        a = pending('a')
+        self.write_log(a, submitting('batch-1', [a], tx_hash='f' * 64))
+        engine = self.engine()
+        engine._replay()
+        engine.server = FakeServer({'f' * 64: {'hash': 'f' * 64, 'successful': True}})
+        engine._recover_in_flight()
+
+        self.assertEqual(engine._in_flight, {})
+        self.assertEqual(engine._pending, {})
+        self.assertEqual(self.settled, [([a], 'f' * 64)])
+        self.assertEqual(self.log_events(), [])
+
+    def test_recover_in_flight_retries_missing_batch(self):
+        a = pending('a')
+        self.write_log(a, submitting('batch-1', [a]))
+        engine = self.engine()
+        engine._replay()
+        engine._recover_in_flight()
+
+        self.assertEqual(engine._pending['a']['attempts'], 1)
+        self.assertEqual(self.settled, [])
+        self.assertEqual([e['id'] for e in self.log_events()], ['a'])
+
+    def test_recover_in_flight_buries_entry_at_attempt_limit(self):
+        a = pending('a', attempts=2)
+        self.write_log(a, submitting('batch-1', [a]))
+        engine = self.engine(max_attempts=3)
+        engine._replay()
+        engine._recover_in_flight()
+
+        self.assertEqual(engine._pending, {})
+        self.assertEqual([(r['id'], r['attempts']) for r in self.dead], [('a', 3)])
+        self.assertEqual(engine.dead_entries(), [])
+        self.assertEqual(self.log_events(), [])
+
+    # ---- attempt limit -----------------------------------------------------
+
+    def test_flush_gives_up_after_max_attempts(self):
+        engine = self.engine(max_attempts=2)
+        entry_id = engine.enqueue('w1', 'btc', SOURCE, 1, reference='ref-1')
+
+        self.assertEqual(engine.flush(), 0)
+        self.assertEqual(engine._pending[entry_id]['attempts'], 1)
+        self.assertEqual(self.dead, [])
+
+        self.assertEqual(engine.flush(), 0)
+        self.assertEqual(engine._pending, {})
+        self.assertEqual([r['reference'] for r in self.dead], ['ref-1'])
+        self.assertEqual(engine.pending_amount(SOURCE), 0)
+
+        # Nothing is retried or reported again, including after a restart
+        engine.flush()
+        replayed = self.engine(max_attempts=2)
+        replayed._replay()
+        self.assertEqual(replayed._pending, {})
+        self.assertEqual(replayed.dead_entries(), [])
+        self.assertEqual(len(self.dead), 1)
+
+    def test_failed_on_dead_is_retried(self):
+        calls = []
+
+        def on_dead(record):
+            calls.append(record['id'])
+            if len(calls) == 1:
+                raise RuntimeError('firestore unavailable')
+
+        engine = self.engine(on_dead=on_dead, max_attempts=1)
+        entry_id = engine.enqueue('w1', 'btc', SOURCE, 1)
+        engine.flush()
+        self.assertEqual([r['id'] for r in engine.dead_entries()], [entry_id])
+
+        engine.flush()
+        self.assertEqual(calls, [entry_id, entry_id])
+        self.assertEqual(engine.dead_entries(), [])
+
+
+    # ---- submission outcome ------------------------------------------------
+
+    def signing_engine(self, fee_strategy, *keypairs, fee_secret=None):
+        secrets = {keypair.public_key: keypair.secret for keypair in keypairs}
+        engine = self.engine(resolve_secret=lambda wallet_id, symbol: secrets[wallet_id], fee_strategy=fee_strategy,
+                             fee_secret=fee_secret)
+        for keypair in keypairs:
+            engine.enqueue(keypair.public_key, 'btc', keypair.public_key, 1)
+        return engine
+
+    def test_unknown_outcome_waits_for_lookup_instead_of_paying_again(self):
+        keypair = Keypair.random()
+        fee_strategy = FakeFeeStrategy(ConnectionError('connection reset'))
+        engine = self.signing_engine(fee_strategy, keypair)
+
+        self.assertEqual(engine.flush(), 0)
+        self.assertEqual(engine._pending, {})
+        (batch_id, record), = engine._in_flight.items()
+        self.assertEqual(engine.pending_amount(keypair.public_key), 1)
+
+        # Neither another flush nor recovery before the time bound submits it again
+        engine.flush()
+        engine._recover_in_flight()
+        self.assertEqual(len(fee_strategy.submitted), 1)
+
+        record['valid_until'] = time.time() - 60
+        engine.server = FakeServer({record['hash']: {'hash': record['hash'], 'successful': True}})
+        engine._recover_in_flight()
+        self.assertEqual(engine._in_flight, {})
+        self.assertEqual(engine._pending, {})
+        self.assertEqual([tx_hash for _, tx_hash in self.settled], [record['hash']])
+        self.assertEqual(self.dead, [])
+
+    def test_unknown_outcome_of_shared_batch_is_not_split(self):
+        fee_strategy = FakeFeeStrategy(ConnectionError('connection reset'))
+        engine = self.signing_engine(fee_strategy, Keypair.random(), Keypair.random(), fee_secret=Keypair.random().secret)
+
+        engine.flush()
+        self.assertEqual(len(fee_strategy.submitted), 1)
+        self.assertEqual(len(engine._in_flight), 1)
+
+    def test_sources_pay_only_their_own_fees_without_fee_account(self):
+        first, second = Keypair.random(), Keypair.random()
+        fee_strategy = FakeFeeStrategy()
+        engine = self.signing_engine(fee_strategy, first, second)
+
+        self.assertEqual(engine.flush(), 2)
+        self.assertEqual(
+            sorted((tx.transaction.source.account_id, fee_source.public_key) for tx, fee_source in fee_strategy.submitted),
+            sorted((keypair.public_key, keypair.public_key) for keypair in (first, second)))
+
+    def test_fee_account_pays_for_shared_batch(self):
+        fee_keypair = Keypair.random()
+        fee_strategy = FakeFeeStrategy()
+        engine = self.signing_engine(fee_strategy, Keypair.random(), Keypair.random(), fee_secret=fee_keypair.secret)
+
+        self.assertEqual(engine.flush(), 2)
+        [(transaction, fee_source)] = fee_strategy.submitted
+        self.assertEqual(transaction.transaction.source.account_id, fee_keypair.public_key)
+        self.assertEqual(fee_source.public_key, fee_keypair.public_key)
+        self.assertEqual(len(transaction.signatures), 3)
+
+    def test_rejected_batch_is_requeued_and_counted(self):
+        keypair = Keypair.random()
+        fee_strategy = FakeFeeStrategy(TransactionNotConfirmed('Transaction rejected: txBAD_SEQ'))
+        engine = self.signing_engine(fee_strategy, keypair)
+
+        engine.flush()
+        self.assertEqual(engine._in_flight, {})
+        self.assertEqual([r['attempts'] for r in engine._pending.values()], [1])
+
+    # ---- cross-worker reservations and orphaned logs -----------------------
+
+    def test_enqueue_checks_balance_across_workers(self):
+        cache = CacheStore()
+        first, second = self.engine(cache=cache), self.engine(cache=cache)
+        second.log_path = f'{self.log_path}.1'
+
+        self.assertIsNotNone(first.enqueue('w1', 'btc', SOURCE, 6, balance=10))
+        self.assertIsNone(second.enqueue('w1', 'btc', SOURCE, 6, balance=10))
+        self.assertIsNotNone(second.enqueue('w1', 'btc', SOURCE, 4, balance=10))
+        self.assertEqual(first.pending_amount(SOURCE), 10)
+
+    def test_sync_releases_settled_share_and_restores_lost_ones(self):
+        cache = CacheStore()
+        first, second = self.engine(cache=cache), self.engine(cache=cache)
+        second.log_path = f'{self.log_path}.1'
+        first.enqueue('w1', 'btc', SOURCE, 6, balance=10)
+        second.enqueue('w1', 'btc', SOURCE, 3, balance=10)
+
+        first._pending.clear()
+        first._sync_reservations()
+        self.assertEqual(second.pending_amount(SOURCE), 3)
+
+        # A restarted cache daemon starts empty; the next sync puts the shares back
+        first.cache = second.cache = CacheStore()
+        first._sync_reservations()
+        second._sync_reservations()
+        self.assertIsNone(first.enqueue('w1', 'btc', SOURCE, 8, balance=10))
+
+    def test_adopts_logs_no_live_worker_holds(self):
+        cache = CacheStore()
+        orphan_path, held_path = f'{self.log_path}.1', f'{self.log_path}.2'
+        self.write_log(pending('a', amount='5.0000000'), path=orphan_path)
+        self.write_log(pending('b'), path=held_path)
+        cache.hold(orphan_path, {f'settlement:owed:{SOURCE}': '5'})
+        with open(f'{held_path}.lock', 'a') as held_lock:
+            self.assertTrue(try_lock(held_lock))
+            engine = self.engine(cache=cache)
+            self.assertTrue(engine._adopt_orphans())
+
+        self.assertEqual(list(engine._pending), ['a'])
+        self.assertEqual([e['id'] for e in self.log_events()], ['a'])
+        self.assertFalse(os.path.exists(orphan_path))
+        self.assertTrue(os.path.exists(held_path))
+        self.assertEqual(engine.pending_amount(SOURCE), 5)
+
+    def test_start_finishes_interrupted_adoption(self):
+        a, b = pending('a'), pending('b')
+        self.write_log(a, path=f'{self.log_path}.adopting')
+        self.write_log(a, b, submitting('batch-1', [a]),
+                       {'event': 'settled', 'batch': 'batch-1', 'ids': ['a'], 'hash': 'a' * 64})
+        engine = self.engine()
+        engine.start()
+        engine.stop(flush=False)
+
+        self.assertEqual(list(engine._pending), ['b'])
+        self.assertFalse(os.path.exists(f'{self.log_path}.adopting'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import time
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from shared_cache import CacheStore, CacheServer, CacheClient, UNIX_SOCKETS
+
+
+class CacheStoreTest(unittest.TestCase):
+    def test_lru_evicts_unpinned_keys_only(self):
+        store = CacheStore(max_bytes=10)
+        store.set('idempotency:a', b'record', pinned=True)
+        for i in range(5):
+            store.set(f'qr:{i}', b'12345')
+
+        self.assertEqual(store.get('idempotency:a'), b'record')
+        self.assertIsNone(store.get('qr:0'))
+        self.assertEqual(store.get('qr:4'), b'12345')
+        self.assertEqual(store.stats()['bytes'], 10)
+
+    def test_pinned_keys_expire(self):
+        store = CacheStore()
+        store.set('pinned', b'1', ttl=5, pinned=True)
+        store.set('other', b'1', ttl=50, pinned=True)
+        with mock.patch('shared_cache.time.time', return_value=time.time() + 10):
+            self.assertIsNone(store.get('pinned'))
+            self.assertTrue(store.add('pinned', b'2', pinned=True))
+            store.set('late', b'1', pinned=True)
+            self.assertEqual(store.stats()['pinned_keys'], 3)
+
+    def test_add_sees_pinned_and_unpinned_keys(self):
+        store = CacheStore()
+        store.set('key', b'1', pinned=True)
+        self.assertFalse(store.add('key', b'2'))
+        store.set('key', b'3')
+        self.assertEqual(store.stats()['pinned_keys'], 0)
+        self.assertEqual(store.pop('key'), b'3')
+
+    def test_reserve_checks_total_of_all_shares(self):
+        store = CacheStore()
+        self.assertEqual(store.reserve('owed', 'worker-0', '0', '6', '10'), '6')
+        self.assertIsNone(store.reserve('owed', 'worker-1', '0', '5', '10'))
+        self.assertEqual(store.reserve('owed', 'worker-1', '0', '4', '10'), '10')
+        # `held` resets the member's share first, e.g. after its transfers settled
+        self.assertEqual(store.reserve('owed', 'worker-0', '0', '2', '10'), '6')
+
+    def test_hold_and_release_shares(self):
+        store = CacheStore()
+        self.assertEqual(store.hold('worker-0', {'a': '1.5', 'b': '2'}), {'a': '1.5', 'b': '2'})
+        self.assertEqual(store.hold('worker-1', {'a': '1'}), {'a': '2.5'})
+        self.assertEqual(store.hold('worker-0', {'a': '0'}), {'a': '1'})
+        store.release('worker-1')
+        self.assertEqual(store.hold('worker-2', {'a': '0', 'b': '0'}), {'a': '0', 'b': '2'})
+
+
+@unittest.skipUnless(UNIX_SOCKETS, 'needs Unix domain sockets')
+class CacheClientTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.server = CacheServer(os.path.join(self.dir.name, 'cache.sock'), CacheStore(max_bytes=10))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = CacheClient(self.server.server_address)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.dir.cleanup()
+
+    def test_pinned_flag_reaches_daemon(self):
+        self.assertTrue(self.client.add_json('idempotency:a', {'state': 'in_progress'}, 60, pinned=True))
+        self.client.set('qr:0', b'1234567890')
+        self.client.set('qr:1', b'1234567890')
+
+        self.assertEqual(self.client.get_json('idempotency:a'), {'state': 'in_progress'})
+        self.assertIsNone(self.client.get('qr:0'))
+        self.assertEqual(self.server.store.stats()['pinned_keys'], 1)
+
+    def test_reservations_go_through_daemon(self):
+        other = CacheClient(self.server.server_address)
+        self.assertEqual(self.client.reserve('owed', 'worker-0', '0', '0.6', '1'), '0.6')
+        self.assertIsNone(other.reserve('owed', 'worker-1', '0', '0.5', '1'))
+        self.assertEqual(other.hold('worker-1', {'owed': '0.4'}), {'owed': '1.0'})
+        self.client.release('worker-0')
+        self.assertEqual(other.hold('worker-1', {'owed': '0.4'}), {'owed': '0.4'})
+
+
+if __name__ == '__main__':
+    unittest.main()
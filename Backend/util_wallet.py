@@ -2,76 +2,101 @@ from stellar_sdk import Server, Keypair, TransactionBuilder, Network, Asset, exc
 import requests
 import os
 from dotenv import load_dotenv
+from metrics import track_upstream
+from outbound import timed_get, horizon_client, use_priority, UpstreamBusy, PAYMENT
+from assets import ASSETS, BASE_FIAT, ConversionMatrix
+from fees import FeeStrategy
+import numpy as np
 
 load_dotenv()
 
-server = Server(horizon_url="https://horizon-testnet.stellar.org")
+# Upstream endpoints, overridable so the backend can run against local stand-ins
+HORIZON_URL = os.getenv("HORIZON_URL", "https://horizon-testnet.stellar.org")
+FRIENDBOT_URL = os.getenv("FRIENDBOT_URL", "https://friendbot.stellar.org/")
+COINGECKO_API_URL = os.getenv("COINGECKO_API_URL", "https://api.coingecko.com/api/v3")
+EXCHANGE_API_URL = os.getenv("EXCHANGE_API_URL", "https://v6.exchangerate-api.com/v6")
+
+server = Server(horizon_url=HORIZON_URL, client=horizon_client)
+
+# Fees follow Horizon's fee_stats; see fees.FeeStrategy
+fee_strategy = FeeStrategy(
+    server,
+    target_seconds=float(os.getenv('FEE_TARGET_SECONDS', '10')),
+    max_fee=int(os.getenv('FEE_MAX_STROOPS', '100000')),
+    tx_timeout=int(os.getenv('TX_TIMEOUT_SECONDS', '60'))
+)
 
 
 def get_stellar_balance(public_key):
     try:
-        account = server.accounts().account_id(public_key).call()
+        with track_upstream('horizon', 'accounts'):
+            account = server.accounts().account_id(public_key).call()
         for balance in account['balances']:
             if balance['asset_type'] == 'native':
                 return float(balance['balance'])
         return 0.0
+    except UpstreamBusy:
+        raise
     except Exception as e:
         print(f"Balance error ({public_key}):", e)
         return 0.0
 
-def get_exchange_rate(base_currency, target_currency):
+def get_exchange_rates(base_currency):
+    """
+    Returns every rate quoted against base_currency, e.g. {'USD': 0.0117, ...} for INR.
+    """
     api_key = os.getenv("EXCHANGE_API_KEY")
     base_currency = base_currency.upper()
-    target_currency = target_currency.upper()
-    url = f"https://v6.exchangerate-api.com/v6/{api_key}/latest/{base_currency}"
+    url = f"{EXCHANGE_API_URL}/{api_key}/latest/{base_currency}"
     # print(url)
     # url = "https://v6.exchangerate-api.com/v6/ad7554e3a0cbebf4c9f82525/latest/INR"
-    response = requests.get(url)
+    response = timed_get('exchangerate_api', 'latest', url)
     data = response.json()
     if response.status_code == 200 and data['result'] == 'success':
-        return data['conversion_rates'][target_currency]
+        return data['conversion_rates']
     else:
         raise Exception("Failed to fetch exchange rate.")
 
+def get_exchange_rate(base_currency, target_currency):
+    return get_exchange_rates(base_currency)[target_currency.upper()]
+
 # print(get_exchange_rate("USD", "INR"))
 
 def get_crypto_price_in_inr(crypto_symbol):
     """
     Retrieves the current INR price of the specified cryptocurrency using CoinGecko API.
     """
-    url = 'https://api.coingecko.com/api/v3/simple/price'
+    url = f'{COINGECKO_API_URL}/simple/price'
     params = {
         'ids': crypto_symbol.lower(),
         'vs_currencies': 'inr'
     }
-    response = requests.get(url, params=params)
+    response = timed_get('coingecko', 'simple_price', url, params=params)
     if response.status_code == 200:
         data = response.json()
         return data.get(crypto_symbol.lower(), {}).get('inr')
     return None
 
-def get_crypto_data():
-    url = 'https://api.coingecko.com/api/v3/simple/price'
+def get_crypto_data(assets=ASSETS):
+    """
+    Prices every registered asset in INR with one CoinGecko call.
+    Returns {SYMBOL: {'price_inr': ..., 'change_24h': ...}}; assets CoinGecko doesn't know are left out.
+    """
+    url = f'{COINGECKO_API_URL}/simple/price'
     params = {
-        'ids': 'bitcoin,ethereum,solana',
+        'ids': ','.join(asset.coingecko_id for asset in assets),
         'vs_currencies': 'inr',
         'include_24hr_change': 'true'
     }
-    response = requests.get(url, params=params)
+    response = timed_get('coingecko', 'simple_price', url, params=params)
     data = response.json()
     return {
-        'BTC': {
-            'price_inr': data['bitcoin']['inr'],
-            'change_24h': data['bitcoin']['inr_24h_change']
-        },
-        'ETH': {
-            'price_inr': data['ethereum']['inr'],
-            'change_24h': data['ethereum']['inr_24h_change']
-        },
-        'SOL': {
-            'price_inr': data['solana']['inr'],
-            'change_24h': data['solana']['inr_24h_change']
+        asset.symbol: {
+            'price_inr': data[asset.coingecko_id]['inr'],
+            'change_24h': data[asset.coingecko_id]['inr_24h_change']
         }
+        for asset in assets
+        if asset.coingecko_id in data
     }
 
 def calculate_inr_balances(wallet_addresses):
@@ -88,19 +113,28 @@ def calculate_inr_balances(wallet_addresses):
         }
     return balances_inr
 
-def calculate_crypto_amounts(total_inr=30000):
-    crypto_data = get_crypto_data()
+def calculate_crypto_amounts(total_inr=30000, matrix=None):
+    """
+    Splits total_inr evenly across the registered assets. Pass a ConversionMatrix to
+    reuse an existing price snapshot instead of fetching prices.
+    """
+    if matrix is None:
+        matrix = ConversionMatrix(get_crypto_data(), {})
 
-    num_coins = len(crypto_data)
-    per_coin_inr = total_inr / num_coins
+    per_coin_inr = total_inr / len(matrix.symbols)
+    prices_inr = matrix.prices[:, matrix.fiat_index[BASE_FIAT]]
+    missing = [symbol for symbol, price in zip(matrix.symbols, prices_inr) if np.isnan(price)]
+    if missing:
+        raise ValueError(f"No price available for {', '.join(missing)}")
+    coin_amounts = np.round(per_coin_inr / prices_inr, 8)
+    changes = np.round(matrix.change_24h, 2)
 
     amounts = {}
-    for coin, data in crypto_data.items():
-        amount = per_coin_inr / data['price_inr']
-        amounts[coin.lower()] = {
-            'amount': round(amount, 8),
-            'price_inr': data['price_inr'],
-            'change_24h': round(data['change_24h'], 2),
+    for i, symbol in enumerate(matrix.symbols):
+        amounts[symbol.lower()] = {
+            'amount': float(coin_amounts[i]),
+            'price_inr': float(prices_inr[i]),
+            'change_24h': float(changes[i]),
             'inr_equivalent': round(per_coin_inr, 2)
         }
     return amounts
@@ -109,12 +143,14 @@ def wait_for_account_activation(public_key, retries=5, delay=2):
     import time
     for _ in range(retries):
         try:
-            server.load_account(public_key)
+            with track_upstream('horizon', 'load_account'):
+                server.load_account(public_key)
             return True
         except exceptions.NotFoundError:
             time.sleep(delay)
     raise Exception(f"Account {public_key} was not activated after waiting.")
 
+@use_priority(PAYMENT)
 def keep_payment(sender_secret_key, receiver_public_key, retain_amount):
     from stellar_sdk import Server, Keypair, TransactionBuilder, Network, Asset, exceptions
     import requests
@@ -123,7 +159,7 @@ def keep_payment(sender_secret_key, receiver_public_key, retain_amount):
     # Convert retain_amount to float
     retain_amount = float(retain_amount)
 
-    server = Server("https://horizon-testnet.stellar.org")
+    server = Server(HORIZON_URL, client=horizon_client)
     network_passphrase = Network.TESTNET_NETWORK_PASSPHRASE
 
     sender_keypair = Keypair.from_secret(sender_secret_key)
@@ -134,7 +170,8 @@ def keep_payment(sender_secret_key, receiver_public_key, retain_amount):
         """Wait for an account to be activated on the network"""
         for attempt in range(max_attempts):
             try:
-                server.load_account(account_id)
+                with track_upstream('horizon', 'load_account'):
+                    server.load_account(account_id)
                 return True  # Account found
             except exceptions.NotFoundError:
                 time.sleep(delay)  # Wait before trying again
@@ -142,24 +179,27 @@ def keep_payment(sender_secret_key, receiver_public_key, retain_amount):
 
     # Ensure sender account exists
     try:
-        server.load_account(sender_public_key)
+        with track_upstream('horizon', 'load_account'):
+            server.load_account(sender_public_key)
     except exceptions.NotFoundError:
-        response = requests.get(f"https://friendbot.stellar.org/?addr={sender_public_key}")
+        response = timed_get('friendbot', 'fund', f"{FRIENDBOT_URL}?addr={sender_public_key}")
         if response.status_code != 200:
             raise Exception(f"Friendbot failed to fund the sender account: {response.text}")
         wait_for_account_activation(server, sender_public_key)
 
     # Ensure receiver account exists
     try:
-        server.load_account(receiver_public_key)
+        with track_upstream('horizon', 'load_account'):
+            server.load_account(receiver_public_key)
     except exceptions.NotFoundError:
-        response = requests.get(f"https://friendbot.stellar.org/?addr={receiver_public_key}")
+        response = timed_get('friendbot', 'fund', f"{FRIENDBOT_URL}?addr={receiver_public_key}")
         if response.status_code != 200:
             raise Exception(f"Friendbot failed to fund the receiver account: {response.text}")
         wait_for_account_activation(server, receiver_public_key)
 
     # Get sender account details and balance
-    sender_account_data = server.accounts().account_id(sender_public_key).call()
+    with track_upstream('horizon', 'accounts'):
+        sender_account_data = server.accounts().account_id(sender_public_key).call()
     subentry_count = int(sender_account_data.get('subentry_count', 0))  # Ensure integer type
 
     xlm_balance = next(
@@ -175,32 +215,33 @@ def keep_payment(sender_secret_key, receiver_public_key, retain_amount):
         raise Exception("Insufficient balance to retain the specified amount and meet minimum reserve requirements.")
 
     # Build and send the transaction
-    sender_account = server.load_account(account_id=sender_public_key)
+    with track_upstream('horizon', 'load_account'):
+        sender_account = server.load_account(account_id=sender_public_key)
 
     transaction = (
         TransactionBuilder(
             source_account=sender_account,
             network_passphrase=network_passphrase,
-            base_fee=100
+            base_fee=fee_strategy.base_fee()
         )
         .add_text_memo("Stellar Payment")
         .append_payment_op(destination=receiver_public_key, amount=str(transfer_amount), asset=Asset.native())
-        .set_timeout(30)
+        .set_timeout(fee_strategy.tx_timeout)
         .build()
     )
 
     transaction.sign(sender_keypair)
-    response = server.submit_transaction(transaction)
-    return response
+    return fee_strategy.submit(transaction, sender_keypair)
 
 
 # print(calculate_crypto_amounts(10000))
 
 from stellar_sdk import Server, Keypair, TransactionBuilder, Network, Asset
 
-def send_payment_and_show_balances(sender_secret, receiver_public, amount, asset_code="XLM", asset_issuer=None):
+@use_priority(PAYMENT)
+def send_payment_and_show_balances(sender_secret, receiver_public, amount, asset_code="XLM", asset_issuer=None, on_submit=None):
     # Initialize server and network
-    server = Server(horizon_url="https://horizon-testnet.stellar.org")  # Use testnet URL if needed
+    server = Server(horizon_url=HORIZON_URL, client=horizon_client)
     network_passphrase = Network.TESTNET_NETWORK_PASSPHRASE
 
     # Load sender keypair and public key
@@ -209,7 +250,8 @@ def send_payment_and_show_balances(sender_secret, receiver_public, amount, asset
 
     # Function to fetch and print balances
     def print_balances(account_id, label):
-        account_data = server.accounts().account_id(account_id).call()
+        with track_upstream('horizon', 'accounts'):
+            account_data = server.accounts().account_id(account_id).call()
         print(f"\n{label} Balances for {account_id}:")
         for balance in account_data['balances']:
             asset_type = balance.get('asset_type')
@@ -224,23 +266,26 @@ def send_payment_and_show_balances(sender_secret, receiver_public, amount, asset
     asset = Asset.native() if asset_code == "XLM" else Asset(code=asset_code, issuer=asset_issuer)
 
     # Load sender account
-    sender_account = server.load_account(account_id=sender_public)
+    with track_upstream('horizon', 'load_account'):
+        sender_account = server.load_account(account_id=sender_public)
 
     # Build transaction
     transaction = (
         TransactionBuilder(
             source_account=sender_account,
             network_passphrase=network_passphrase,
-            base_fee=100
+            base_fee=fee_strategy.base_fee()
         )
         .append_payment_op(destination=receiver_public, amount=str(amount), asset=asset)
-        .set_timeout(30)
+        .set_timeout(fee_strategy.tx_timeout)
         .build()
     )
 
-    # Sign and submit transaction
+    # Sign and submit transaction; from here on the payment may go through even if this call fails
     transaction.sign(sender_keypair)
-    response = server.submit_transaction(transaction)
+    if on_submit:
+        on_submit()
+    response = fee_strategy.submit(transaction, sender_keypair)
     print("\nTransaction Successful!")
     print(f"Transaction Hash: {response['hash']}")
 